@@ -3,7 +3,7 @@
 import socket
 import urllib.parse
 import time as _time
-from requests import Session, PreparedRequest
+from requests import PreparedRequest
 import os
 import logging
 import configparser
@@ -12,7 +12,11 @@ import time
 from uuid import uuid4
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
+import threading
 from threading import Thread
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from urllib.parse import urlparse, urlunparse
 from flask import Flask, request, jsonify
@@ -22,16 +26,28 @@ import logging
 import pg8000
 import requests
 from requests.exceptions import HTTPError
+from requests.adapters import HTTPAdapter
 from werkzeug.utils import secure_filename
-from enum import Enum
-from typing import Dict, Optional, Tuple
+from enum import Enum, IntEnum
+from typing import Dict, NamedTuple, Optional, Tuple
 import requests
 import mimetypes
 import os
 from urllib.parse import urlparse
 from supabase import create_client, Client
+from shared_http import SharedHttpClient
+from async_core import AsyncEventCore
+from template_registry import DEFAULT_COVER_URL, TemplateRegistry, safe_text
+from scheduler_outbox import SchedulerOutbox, ENQUEUE_SQL as OUTBOX_ENQUEUE_SQL, enqueue_params as outbox_enqueue_params
+from ttl_store import MemoryTTLStore, build_ttl_store
+from worker_state import WorkerState
 import hashlib
+import hmac
 import re
+import sqlite3
+import tempfile
+import heapq
+import random
 from enum import Enum
 import psycopg2
 from typing import Optional
@@ -48,14 +64,61 @@ ETD_COMPANY_IDS = {
 
 GRAPH_API_VERSION = (os.getenv("GRAPH_API_VERSION") or "v22.0").strip() or "v22.0"
 logger = logging.getLogger(__name__)
+
+# Cliente HTTP compartido (keep-alive por host, reintentos, latencias). Se reconfigura con [HTTP] al cargar la config.
+graph_http = SharedHttpClient()
+
+
+class TenantCredentials(NamedTuple):
+    """Credenciales WhatsApp resueltas de un tenant (inmutables; to_dict() da el formato legacy)"""
+    company_id: str
+    company_name: str
+    access_token: str
+    phone_number_id: str
+    business_id: str
+
+    @property
+    def base_url(self) -> str:
+        return f"https://graph.facebook.com/{GRAPH_API_VERSION}/{self.phone_number_id}/messages"
+
+    def to_dict(self) -> dict:
+        return {
+            "business_id":   self.business_id,
+            "access_token":  self.access_token,
+            "phone_number_id": self.phone_number_id,
+            "base_url":      self.base_url,
+            "headers":       {
+                "Authorization": f"Bearer {self.access_token}",
+                "Content-Type": "application/json"
+            },
+            "company_id":    self.company_id,
+            "company_name":  self.company_name,
+        }
+
+
 class CompanyConfigCache:
     """Cache manager for company configurations"""
-    def __init__(self):
+    def __init__(self, credentials_ttl: int = 300, negative_ttl: int = 60):
         self._cache = {}
         self._last_reload = None
         self.reload_interval = 3600  # 1 hora entre recargas forzadas
         self._logger = logging.getLogger(__name__)
 
+        # Credenciales WhatsApp por tenant: company_id -> (TenantCredentials, expires_at)
+        # negative: tenants sin credenciales propias -> expires_at (se sirven los DEFAULT_*)
+        self.credentials_ttl = credentials_ttl
+        self.negative_ttl = negative_ttl
+        self._credentials = {}
+        self._negative = {}
+        # Tenants cuyas credenciales ya salieron del snapshot: la siguiente vez van a BD (el snapshot
+        # puede tener un token rotado hasta el próximo preload)
+        self._from_config = set()
+        self._credentials_lock = threading.Lock()
+        self._credentials_stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'invalidations': 0}
+
+        self._refresh_thread = None
+        self._refresh_stop = threading.Event()
+
     def get(self, company_id: str) -> dict:
         """Get company config from cache"""
         return self._cache.get(company_id)
@@ -63,78 +126,211 @@ class CompanyConfigCache:
     def set(self, company_id: str, config: dict):
         """Set company config in cache"""
         self._cache[company_id] = config
+        self.invalidate_credentials(company_id)
+
+    # ---------- Credenciales por tenant ----------
+    def get_credentials(self, company_id: str) -> TenantCredentials | None:
+        """
+        Credenciales vigentes del tenant o None. Para tenants sin credenciales propias
+        (caché negativa) devuelve las de por defecto sin ir a BD.
+        """
+        now = time.time()
+        with self._credentials_lock:
+            for store, counter in ((self._credentials, 'hits'), (self._negative, 'negative_hits')):
+                entry = store.get(company_id)
+                if entry and entry[1] > now:
+                    self._credentials_stats[counter] += 1
+                    return entry[0]
+            self._credentials_stats['misses'] += 1
+            return None
+
+    def put_credentials(self, creds: TenantCredentials):
+        with self._credentials_lock:
+            self._credentials[creds.company_id] = (creds, time.time() + self.credentials_ttl)
+            self._negative.pop(creds.company_id, None)
+
+    def put_negative(self, default_creds: TenantCredentials):
+        with self._credentials_lock:
+            self._negative[default_creds.company_id] = (default_creds, time.time() + self.negative_ttl)
+            self._credentials.pop(default_creds.company_id, None)
+
+    def invalidate_credentials(self, company_id: str = None) -> int:
+        """Invalida un tenant (o todos si company_id es None). Devuelve cuántas entradas se borraron."""
+        with self._credentials_lock:
+            if company_id is None:
+                removed = len(self._credentials) + len(self._negative)
+                self._credentials.clear()
+                self._negative.clear()
+            else:
+                removed = int(self._credentials.pop(company_id, None) is not None) \
+                    + int(self._negative.pop(company_id, None) is not None)
+            self._credentials_stats['invalidations'] += removed
+            return removed
+
+    def credentials_from_config(self, company_id: str) -> TenantCredentials | None:
+        """
+        Construye credenciales desde custom_properties ya cacheadas (sin BD) si están completas.
+        Solo una vez por snapshot y tenant: tras caducar o invalidarse, se leen de BD.
+        """
+        entry = self._cache.get(company_id)
+        if not entry:
+            return None
+        with self._credentials_lock:
+            if company_id in self._from_config:
+                return None
+            self._from_config.add(company_id)
+        props = (entry.get('config') or {}).get('custom_properties') or {}
+        token = props.get('WHATSAPP_ACCESS_TOKEN')
+        pnid = props.get('WHATSAPP_PHONE_NUMBER_ID')
+        bid = props.get('WHATSAPP_BUSINESS_ID')
+        if not (token and pnid and bid):
+            return None
+        return TenantCredentials(
+            company_id=company_id,
+            company_name=props.get('COMPANY_NAME') or entry.get('name') or "Default",
+            access_token=token,
+            phone_number_id=str(pnid),
+            business_id=str(bid),
+        )
+
+    def credentials_stats(self) -> dict:
+        with self._credentials_lock:
+            return {
+                **self._credentials_stats,
+                'cached': len(self._credentials),
+                'negative': len(self._negative),
+                'ttl': self.credentials_ttl,
+                'negative_ttl': self.negative_ttl,
+            }
         
-    def preload_all_companies(self, db_manager):
-        """Load all company configurations into cache"""
+    def _fetch_all_company_configs(self, db_manager) -> dict:
+        """
+        Lee la config de todas las compañías activas en una sola query (set-returning).
+        Si falla, cae a una query por compañía pero sobre una única conexión.
+        """
+        bulk_query = """
+            SELECT c.id, c.name, public.get_company_data(c.id) AS config
+            FROM public.companies c
+            WHERE c.is_deleted = false
+        """
         try:
-            # Obtener todos los IDs de compañías activas
-            companies_query = """
-                SELECT id 
-                FROM public.companies 
-                WHERE is_deleted = false 
-            """
-            company_results = db_manager.execute_query(companies_query, fetch_all=True)
-            
-            if not company_results:
-                self._logger.warning("No se encontraron compañías activas")
-                return
-                
-            # Extraer los IDs de los resultados
-            company_ids = [str(row[0]) for row in company_results]
-            self._logger.info(f"Encontradas {len(company_ids)} compañías activas para cargar")
-            loaded = 0
-            for company_id in company_ids:
-                try:
-                    # Llamar directamente a get_company_data para cada compañía
-                    result = db_manager.execute_query(
-                        "SELECT public.get_company_data(%s) as config",
-                        [company_id],
-                        fetch_one=True
+            rows = db_manager.execute_query(bulk_query, fetch_all=True) or []
+        except Exception as e:
+            self._logger.warning(f"Bulk preload falló ({e}); usando carga por compañía")
+            rows = []
+            with db_manager.unit_of_work():
+                company_rows = db_manager.execute_query(
+                    "SELECT id, name FROM public.companies WHERE is_deleted = false",
+                    fetch_all=True
+                ) or []
+                for company_id, company_name in company_rows:
+                    try:
+                        result = db_manager.execute_query(
+                            "SELECT public.get_company_data(%s) as config",
+                            [str(company_id)],
+                            fetch_one=True
+                        )
+                        rows.append((company_id, company_name, result[0] if result else None))
+                    except Exception as inner:
+                        self._logger.error(f"Error cargando config para compañía {company_id}: {inner}")
+
+        entries = {}
+        for company_id, company_name, company_data in rows:
+            company_id = str(company_id)
+            if isinstance(company_data, dict) and company_data.get('id'):
+                entries[company_id] = {
+                    'id': company_id,
+                    'name': company_data.get('name') or company_name or 'Unknown',
+                    'config': company_data
+                }
+                custom_props = company_data.get('custom_properties', {})
+                if custom_props:
+                    self._logger.debug(
+                        f"   • WhatsApp config para {company_id}: "
+                        f"Business ID={custom_props.get('WHATSAPP_BUSINESS_ID')} "
+                        f"Phone ID={custom_props.get('WHATSAPP_PHONE_NUMBER_ID')}"
                     )
-                    
-                    if result and result[0]:
-                        company_data = result[0]
-                        
-                        # Verificar que tenemos los datos necesarios
-                        if isinstance(company_data, dict) and company_data.get('id'):
-                            self._cache[company_id] = {
-                                'id': company_id,
-                                'name': company_data.get('name', 'Unknown'),
-                                'config': company_data
-                            }
-                            loaded += 1
-                            
-                            # Log de configuración cargada
-                            self._logger.info(f"✅ Configuración cargada para {company_data.get('name')} (id: {company_id})")
-                            
-                            # Log de valores críticos de WhatsApp si existen
-                            custom_props = company_data.get('custom_properties', {})
-                            if custom_props:
-                                self._logger.debug(f"   • WhatsApp config para {company_id}:")
-                                self._logger.debug(f"     - Business ID: {custom_props.get('WHATSAPP_BUSINESS_ID')}")
-                                self._logger.debug(f"     - Phone ID: {custom_props.get('WHATSAPP_PHONE_NUMBER_ID')}")
-                                token = custom_props.get('WHATSAPP_ACCESS_TOKEN', '')
-                                if token:
-                                    self._logger.debug(f"     - Token: {token[:20]}...")
-                            else:
-                                self._logger.warning(f"   • No custom_properties encontradas para {company_id}")
-                        else:
-                            self._logger.warning(f"❌ Datos inválidos o incompletos para compañía {company_id}")
-                    else:
-                        self._logger.warning(f"❌ No se encontraron datos para compañía {company_id}")
-                            
-                except Exception as e:
-                    self._logger.error(f"Error cargando config para compañía {company_id}: {e}")
-                    continue
-            
+                else:
+                    self._logger.warning(f"   • No custom_properties encontradas para {company_id}")
+            else:
+                self._logger.warning(f"❌ Datos inválidos o incompletos para compañía {company_id}")
+        return entries
+
+    def preload_all_companies(self, db_manager) -> dict:
+        """
+        Load all company configurations into cache.
+        Construye un snapshot nuevo y lo intercambia de golpe; solo los tenants que cambian
+        (o desaparecen) pierden sus credenciales cacheadas.
+        """
+        try:
+            t0 = time.monotonic()
+            fresh = self._fetch_all_company_configs(db_manager)
+            if not fresh:
+                self._logger.warning("No se encontraron compañías activas")
+                return {'loaded': 0, 'changed': 0, 'removed': 0}
+
+            current = self._cache
+            changed = [cid for cid, entry in fresh.items() if current.get(cid) != entry]
+            removed = [cid for cid in current if cid not in fresh]
+
+            # Swap atómico: los lectores ven el dict viejo o el nuevo, nunca uno a medias
+            self._cache = fresh
+            with self._credentials_lock:
+                self._from_config.clear()
+            for cid in changed + removed:
+                self.invalidate_credentials(cid)
+
             self._last_reload = time.time()
-            self._logger.info(f"✅ Precargadas {loaded}/{len(company_ids)} configuraciones de compañías")
-            
-            # Log del estado final de la caché
-            self._logger.info(f"📦 Caché contiene {len(self._cache)} configuraciones en total")
-            
+            elapsed = time.monotonic() - t0
+            self._logger.info(
+                f"✅ Precargadas {len(fresh)} configuraciones de compañías en {elapsed:.2f}s "
+                f"(cambiadas: {len(changed)}, eliminadas: {len(removed)})"
+            )
+            return {'loaded': len(fresh), 'changed': len(changed), 'removed': len(removed)}
+
         except Exception as e:
             self._logger.exception(f"Error precargando configuraciones de compañías: {e}")
+            return {'loaded': 0, 'changed': 0, 'removed': 0, 'error': str(e)}
+
+    def refresh_company(self, db_manager, company_id: str) -> bool:
+        """Relee get_company_data de un tenant (p.ej. tras rotar su token) y sustituye su entrada."""
+        row = db_manager.execute_query(
+            "SELECT public.get_company_data(%s) as config", [str(company_id)], fetch_one=True
+        )
+        company_data = row[0] if row else None
+        if not (isinstance(company_data, dict) and company_data.get('id')):
+            self._logger.warning(f"❌ Datos inválidos o incompletos para compañía {company_id}")
+            return False
+        fresh = dict(self._cache)
+        fresh[str(company_id)] = {
+            'id': str(company_id),
+            'name': company_data.get('name') or 'Unknown',
+            'config': company_data
+        }
+        self._cache = fresh
+        with self._credentials_lock:
+            self._from_config.discard(str(company_id))
+        self.invalidate_credentials(str(company_id))
+        return True
+
+    def start_background_refresh(self, db_manager):
+        """Recarga periódica (cada reload_interval segundos) en un hilo daemon."""
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        self._refresh_stop.clear()
+
+        def _loop():
+            while not self._refresh_stop.wait(self.reload_interval):
+                if self._last_reload and time.time() - self._last_reload < self.reload_interval:
+                    continue
+                self.preload_all_companies(db_manager)
+
+        self._refresh_thread = Thread(target=_loop, name='company-config-refresh', daemon=True)
+        self._refresh_thread.start()
+        self._logger.info(f"🔄 Refresco de configuraciones cada {self.reload_interval}s")
+
+    def stop_background_refresh(self):
+        self._refresh_stop.set()
 
 
 
@@ -190,6 +386,328 @@ class CompanyConfigCache:
 # Instancia global de la caché
 company_cache = CompanyConfigCache()
 
+# Firmas (magic bytes) para deducir el MIME cuando Graph devuelve uno genérico
+MEDIA_MAGIC_SIGNATURES = (
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'OggS', 'audio/ogg'),
+    (b'#!AMR', 'audio/amr'),
+    (b'ID3', 'audio/mpeg'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+
+
+def sniff_media_content_type(head: bytes, declared: str | None = None) -> str:
+    """
+    Devuelve el content-type declarado salvo que sea vacío/genérico; en ese caso lo deduce
+    de los primeros bytes del fichero.
+    """
+    declared = (declared or '').split(';')[0].strip().lower()
+    if declared and declared != 'application/octet-stream':
+        return declared
+    head = head or b''
+    for magic, mime in MEDIA_MAGIC_SIGNATURES:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'audio/wav'
+    if head[4:8] == b'ftyp':
+        return 'audio/mp4' if head[8:11] == b'M4A' else 'video/mp4'
+    return declared or 'application/octet-stream'
+
+
+class SpooledMedia:
+    """
+    Media descargada en streaming. Se mantiene en memoria hasta `threshold` bytes y por encima
+    se vuelca a un fichero temporal, así el pico de memoria no depende del tamaño del fichero.
+    md5/sha256 se calculan chunk a chunk durante la descarga.
+    """
+    HEAD_SIZE = 512
+
+    def __init__(self, threshold: int, suffix: str = ''):
+        self.threshold = threshold
+        self.suffix = suffix
+        self.size = 0
+        self.head = b''
+        self.path = None
+        self.filename = None
+        self.content_type = None
+        self._buffer = bytearray()
+        self._fh = None
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self._md5.update(chunk)
+        self._sha256.update(chunk)
+        if len(self.head) < self.HEAD_SIZE:
+            self.head += chunk[:self.HEAD_SIZE - len(self.head)]
+        self.size += len(chunk)
+
+        if self._fh is None and self.size > self.threshold:
+            self._fh = tempfile.NamedTemporaryFile(prefix='wa_media_', suffix=self.suffix, delete=False)
+            self.path = self._fh.name
+            self._fh.write(self._buffer)
+            self._buffer = bytearray()
+
+        if self._fh is not None:
+            self._fh.write(chunk)
+        else:
+            self._buffer.extend(chunk)
+
+    def finish(self):
+        if self._fh is not None:
+            self._fh.close()
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path is None
+
+    @contextmanager
+    def open_upload_source(self):
+        """
+        bytes si sigue en memoria; si no, el temporal abierto en 'rb' para subirlo en streaming.
+        Se cierra aquí: con una ruta, storage3 hace open() y nunca cierra el descriptor.
+        """
+        if self.path is None:
+            yield bytes(self._buffer)
+            return
+        with open(self.path, 'rb') as fh:
+            yield fh
+
+    def read_bytes(self) -> bytes:
+        if self.path is None:
+            return bytes(self._buffer)
+        with open(self.path, 'rb') as fh:
+            return fh.read()
+
+    def close(self):
+        if self._fh is not None and not self._fh.closed:
+            self._fh.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class MediaDedupeIndex:
+    """
+    Índice de media direccionado por contenido (sha256).
+    - sha256 -> objeto ya subido a Storage (file_path, public_url, ...)
+    - (sha256, phone_number_id) -> media_id de Meta con su caducidad
+    - file_path -> sha256, para reenviar un fichero de Storage sin descargarlo otra vez
+    Acotado en memoria (LRU). Lleva aciertos/fallos y bytes que nos hemos ahorrado subir.
+    """
+    def __init__(self, max_entries: int = 20000, media_id_ttl: int = 29 * 24 * 3600):
+        self.max_entries = max_entries
+        # Meta conserva los media_id subidos 30 días; dejamos margen
+        self.media_id_ttl = media_id_ttl
+        self._storage: OrderedDict = OrderedDict()
+        self._meta: OrderedDict = OrderedDict()
+        self._paths: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'storage_hits': 0, 'storage_misses': 0, 'storage_bytes_saved': 0,
+            'meta_hits': 0, 'meta_misses': 0, 'meta_expired': 0, 'meta_bytes_saved': 0,
+        }
+
+    def _put(self, store: OrderedDict, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_entries:
+            store.popitem(last=False)
+
+    def get_storage(self, sha256: str) -> dict | None:
+        with self._lock:
+            entry = self._storage.get(sha256)
+            if entry is None:
+                self._counters['storage_misses'] += 1
+                return None
+            self._storage.move_to_end(sha256)
+            self._counters['storage_hits'] += 1
+            self._counters['storage_bytes_saved'] += entry.get('file_size') or 0
+            return dict(entry)
+
+    def put_storage(self, sha256: str, upload_result: dict, content_type: str = None):
+        entry = dict(upload_result)
+        entry['sha256'] = sha256
+        entry['content_type'] = content_type
+        with self._lock:
+            self._put(self._storage, sha256, entry)
+            self._put(self._paths, entry['file_path'], sha256)
+
+    def sha256_for_path(self, file_path: str) -> str | None:
+        with self._lock:
+            return self._paths.get(file_path)
+
+    def put_path(self, file_path: str, sha256: str):
+        """file_path de Storage -> sha256 (ficheros que no subimos nosotros: se hashean al descargarlos)"""
+        with self._lock:
+            self._put(self._paths, file_path, sha256)
+
+    def get_media_id(self, sha256: str, phone_number_id: str) -> str | None:
+        key = (sha256, str(phone_number_id))
+        with self._lock:
+            entry = self._meta.get(key)
+            if entry is None:
+                self._counters['meta_misses'] += 1
+                return None
+            if entry['expires_at'] <= time.time():
+                del self._meta[key]
+                self._counters['meta_expired'] += 1
+                self._counters['meta_misses'] += 1
+                return None
+            self._meta.move_to_end(key)
+            self._counters['meta_hits'] += 1
+            self._counters['meta_bytes_saved'] += entry.get('size') or 0
+            return entry['media_id']
+
+    def put_media_id(self, sha256: str, phone_number_id: str, media_id: str, size: int = 0):
+        with self._lock:
+            self._put(self._meta, (sha256, str(phone_number_id)), {
+                'media_id': media_id,
+                'size': size,
+                'expires_at': time.time() + self.media_id_ttl,
+            })
+
+    def forget_media_id(self, sha256: str, phone_number_id: str):
+        with self._lock:
+            self._meta.pop((sha256, str(phone_number_id)), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            c = dict(self._counters)
+            storage_total = c['storage_hits'] + c['storage_misses']
+            meta_total = c['meta_hits'] + c['meta_misses']
+            return {
+                **c,
+                'storage_entries': len(self._storage),
+                'meta_entries': len(self._meta),
+                'max_entries': self.max_entries,
+                'storage_hit_ratio': round(c['storage_hits'] / storage_total, 4) if storage_total else 0.0,
+                'meta_hit_ratio': round(c['meta_hits'] / meta_total, 4) if meta_total else 0.0,
+                'bytes_saved': c['storage_bytes_saved'] + c['meta_bytes_saved'],
+            }
+
+
+class WhatsAppMediaFetcher:
+    """
+    Acceso a media entrante de Graph con una sola resolución de credenciales por media:
+    - resolve_token(): company_id + token una vez por fetch
+    - get_media_url(): cache media_id -> URL durante su validez (Meta las firma ~5 min)
+    - Cliente keep-alive compartido (graph_http) para reutilizar TLS entre el GET del id y la descarga
+    """
+    GRAPH_URL = 'https://graph.facebook.com/v22.0'
+
+    def __init__(self, config, url_ttl: int = 240, pool_maxsize: int = 20, max_entries: int = 5000, http=None):
+        self.config = config
+        self.url_ttl = url_ttl
+        self.max_entries = max_entries
+        if http is not None:
+            self.session = http
+        else:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+            self.session.mount('https://', adapter)
+        self._urls: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.url_hits = 0
+        self.url_misses = 0
+        self.token_resolutions = 0
+
+    def resolve_token(self, phone: str = None, company_id: str = None) -> tuple[str, str | None]:
+        """(token, company_id) del tenant; token por defecto si no hay teléfono."""
+        self.token_resolutions += 1
+        if phone:
+            resolved_company_id = company_id or _resolve_company_id_from_phone(phone)
+            creds = get_whatsapp_credentials_for_phone(phone, company_id=resolved_company_id)
+            token = creds.get('access_token')
+        else:
+            resolved_company_id = company_id
+            token = self.config.whatsapp_config.get("access_token")
+
+        if not token:
+            raise RuntimeError("No WhatsApp access token available for media")
+        return token, resolved_company_id
+
+    def get_media_url(self, media_id: str, token: str) -> str:
+        now = time.time()
+        with self._lock:
+            entry = self._urls.get(media_id)
+            if entry and entry[1] > now:
+                self._urls.move_to_end(media_id)
+                self.url_hits += 1
+                return entry[0]
+            self.url_misses += 1
+
+        response = self.session.get(
+            f'{self.GRAPH_URL}/{media_id}',
+            headers={'Authorization': f'Bearer {token}'},
+            timeout=15
+        )
+        if not response.ok:
+            logger.error(f"[MEDIA DEBUG] Response text: {response.text}")
+        response.raise_for_status()
+
+        media_info = response.json()
+        logger.info(f"Media info retrieved for {media_id}: {media_info}")
+        url = media_info.get('url')
+        if url:
+            with self._lock:
+                self._urls[media_id] = (url, now + self.url_ttl)
+                self._urls.move_to_end(media_id)
+                while len(self._urls) > self.max_entries:
+                    self._urls.popitem(last=False)
+        return url
+
+    def invalidate(self, media_id: str):
+        with self._lock:
+            self._urls.pop(media_id, None)
+
+    def download(self, media_url: str, token: str, stream: bool = False, timeout=60):
+        return self.session.get(
+            media_url,
+            headers={'Authorization': f'Bearer {token}'},
+            timeout=timeout,
+            stream=stream
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.url_hits + self.url_misses
+            return {
+                'cached_urls': len(self._urls),
+                'url_hits': self.url_hits,
+                'url_misses': self.url_misses,
+                'url_hit_ratio': round(self.url_hits / total, 4) if total else 0.0,
+                'token_resolutions': self.token_resolutions,
+            }
+
+
 class ExtendedFileService:
     """
     Service para manejar uploads/downloads con soporte completo para todos los MIME types
@@ -305,6 +823,23 @@ class ExtendedFileService:
             raise RuntimeError("Supabase URL y KEY son requeridos")
             
         self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+
+        # Descarga en streaming (memoria acotada por chunk/umbral en lugar de por tamaño de fichero)
+        media_cfg = config.config['MEDIA'] if config.config.has_section('MEDIA') else {}
+        self.streaming_enabled = str(media_cfg.get('STREAMING', 'true')).strip().lower() in ('1', 'true', 'yes', 'y')
+        self.stream_chunk_size = int(media_cfg.get('STREAM_CHUNK_SIZE', 256 * 1024))
+        self.spool_threshold = int(media_cfg.get('SPOOL_THRESHOLD', 2 * 1024 * 1024))
+
+        # Dedupe por contenido: no volver a subir a Storage / Meta lo que ya está subido
+        self.media_index = MediaDedupeIndex(
+            max_entries=int(media_cfg.get('DEDUPE_MAX_ENTRIES', 20000)),
+            media_id_ttl=int(media_cfg.get('MEDIA_ID_TTL', 29 * 24 * 3600)),
+        )
+        self.media_fetcher = WhatsAppMediaFetcher(
+            config,
+            url_ttl=int(media_cfg.get('MEDIA_URL_TTL', 240)),
+            http=graph_http,
+        )
         logger.info(f"ExtendedFileService initialized with bucket: {self.storage_bucket}")
 
     def detect_media_type_from_content(self, content: bytes, filename: str, content_type: str) -> str:
@@ -350,12 +885,14 @@ class ExtendedFileService:
         # Si no se puede clasificar específicamente, es un documento
         return 'document'
 
-    def validate_file_extended(self, content: bytes, filename: str, content_type: str) -> dict:
+    def validate_file_extended(self, content: bytes, filename: str, content_type: str, file_size: int = None) -> dict:
         """
         Validación extendida que acepta cualquier MIME type válido,
         aplicando las reglas específicas de WhatsApp Cloud API.
+        file_size permite validar media en streaming pasando solo la cabecera en content.
         """
-        file_size = len(content)
+        if file_size is None:
+            file_size = len(content)
         
         # Detectar tipo de media
         media_type = self.detect_media_type_from_content(content, filename, content_type)
@@ -385,13 +922,33 @@ class ExtendedFileService:
             'valid': True
         }
 
-    def upload_to_supabase(self, file_content: bytes, filename: str, content_type: str = None) -> dict:
-        """Upload file to Supabase Storage with auto-generated path"""
+    def upload_to_supabase(self, file_content, filename: str, content_type: str = None) -> dict:
+        """
+        Upload file to Supabase Storage with auto-generated path.
+        file_content puede ser bytes o SpooledMedia (hash ya calculado; si está en disco se sube desde el fichero).
+        """
         try:
+            if isinstance(file_content, SpooledMedia):
+                file_hash = file_content.md5[:8]
+                sha256 = file_content.sha256
+                file_size = file_content.size
+                upload_source = file_content.open_upload_source()
+            else:
+                file_hash = hashlib.md5(file_content).hexdigest()[:8]
+                sha256 = hashlib.sha256(file_content).hexdigest()
+                file_size = len(file_content)
+                upload_source = nullcontext(file_content)
+
+            # Mismo contenido ya subido -> reutilizar el objeto existente
+            cached = self.media_index.get_storage(sha256)
+            if cached:
+                logger.info(f"Media dedupe hit ({sha256[:12]}): reusing {cached['file_path']}")
+                cached['deduplicated'] = True
+                return cached
+
             # Generate file path with date organization
             date_folder = datetime.now().strftime("%Y/%m/%d")
             safe_filename = filename
-            file_hash = hashlib.md5(file_content).hexdigest()[:8]
             file_path = f"whatsapp-media/{date_folder}/{file_hash}_{safe_filename}"
             
             # Upload options
@@ -401,9 +958,10 @@ class ExtendedFileService:
             }
             
             # Upload to Supabase
-            result = self.supabase.storage.from_(self.storage_bucket).upload(
-                file_path, file_content, file_options
-            )
+            with upload_source as body:
+                result = self.supabase.storage.from_(self.storage_bucket).upload(
+                    file_path, body, file_options
+                )
             
             if hasattr(result, 'error') and result.error:
                 raise RuntimeError(f"Supabase upload error: {result.error}")
@@ -418,68 +976,45 @@ class ExtendedFileService:
             
             logger.info(f"File uploaded successfully: {file_path}")
             
-            return {
+            upload_result = {
                 'file_path': file_path,
                 'public_url': public_url,
-                'file_size': len(file_content),
+                'file_size': file_size,
                 'upload_timestamp': datetime.now().isoformat()
             }
+            self.media_index.put_storage(sha256, upload_result, content_type)
+            return upload_result
             
         except Exception as e:
             logger.error(f"Error uploading to Supabase: {e}")
             raise
 
     # Firma: añade company_id opcional
-    def get_whatsapp_media_url(self, media_id: str, phone: str = None, company_id: str = None) -> str:
-        """Get media URL from WhatsApp API. If phone/company_id are provided, resolve token for that tenant."""
+    def get_whatsapp_media_url(self, media_id: str, phone: str = None, company_id: str = None, token: str = None) -> str:
+        """
+        Get media URL from WhatsApp API. If phone/company_id are provided, resolve token for that tenant.
+        Si se pasa token (ya resuelto) no se vuelve a consultar credenciales. URL cacheada mientras es válida.
+        """
         try:
             logger.info(f"[MEDIA DEBUG] Starting get_whatsapp_media_url - media_id: {media_id}, phone: {phone}, company_id: {company_id}")
 
-            token = None
-            # Resolver credenciales priorizando company_id si hay phone
-            if phone:
-                # si no viene company_id, intenta deducirlo por teléfono
-                resolved_company_id = company_id or _resolve_company_id_from_phone(phone)
-                creds = get_whatsapp_credentials_for_phone(phone, company_id=resolved_company_id)
-                token = creds.get('access_token')
-                logger.info(f"[MEDIA DEBUG] Token via creds: {token[:20] if token else 'None'}; resolved_company_id={resolved_company_id}")
-            else:
-                token = self.config.whatsapp_config.get("access_token")
-                logger.info(f"[MEDIA DEBUG] Default token: {token[:20] if token else 'None'}.")
-
             if not token:
-                raise RuntimeError("No WhatsApp access token available to fetch media URL")
+                token, resolved_company_id = self.media_fetcher.resolve_token(phone, company_id)
+                logger.info(f"[MEDIA DEBUG] Token: {token[:20]}; resolved_company_id={resolved_company_id}")
 
-            headers = {'Authorization': f'Bearer {token}'}
-            response = requests.get(f'https://graph.facebook.com/v22.0/{media_id}', headers=headers, timeout=15)
-            logger.info(f"[MEDIA DEBUG] Response status: {response.status_code}")
-            if not response.ok:
-                logger.error(f"[MEDIA DEBUG] Response text: {response.text}")
-            response.raise_for_status()
-
-            media_info = response.json()
-            logger.info(f"Media info retrieved for {media_id}: {media_info}")
-            return media_info.get('url')
+            return self.media_fetcher.get_media_url(media_id, token)
 
         except Exception as e:
             logger.error(f"Error getting media URL for {media_id}: {e}")
             raise
 
-    def download_whatsapp_media(self, media_url: str, phone: str = None, company_id: str = None) -> tuple[bytes, str, str]:
+    def download_whatsapp_media(self, media_url: str, phone: str = None, company_id: str = None, token: str = None) -> tuple[bytes, str, str]:
         """Download media from WhatsApp and return content, filename, mime_type. If phone/company_id provided, uses tenant token."""
         try:
-            if phone:
-                resolved_company_id = company_id or _resolve_company_id_from_phone(phone)
-                creds = get_whatsapp_credentials_for_phone(phone, company_id=resolved_company_id)
-                token = creds.get('access_token')
-            else:
-                token = self.config.whatsapp_config.get("access_token")
-
             if not token:
-                raise RuntimeError("No WhatsApp access token available to download media")
+                token, _ = self.media_fetcher.resolve_token(phone, company_id)
 
-            headers = {'Authorization': f'Bearer {token}'}
-            response = requests.get(media_url, headers=headers, timeout=60)
+            response = self.media_fetcher.download(media_url, token, timeout=60)
             response.raise_for_status()
 
             content_type = (response.headers.get('content-type', 'application/octet-stream').split(';')[0].strip().lower())
@@ -492,6 +1027,42 @@ class ExtendedFileService:
             raise
 
 
+    def download_whatsapp_media_stream(self, media_url: str, phone: str = None, company_id: str = None, token: str = None) -> SpooledMedia:
+        """
+        Descarga en streaming: chunks de stream_chunk_size -> hash incremental -> SpooledMedia
+        (memoria hasta spool_threshold, temporal en disco por encima). Corta la descarga si supera
+        el máximo de WhatsApp (100MB). El llamador debe cerrar el SpooledMedia (usar `with`).
+        """
+        if not token:
+            token, _ = self.media_fetcher.resolve_token(phone, company_id)
+
+        max_size = max(cfg['max_size'] for cfg in self.WHATSAPP_MEDIA_CONFIG.values())
+        media = None
+        try:
+            with self.media_fetcher.download(media_url, token, stream=True, timeout=(10, 60)) as response:
+                response.raise_for_status()
+                declared = response.headers.get('content-type', 'application/octet-stream')
+                media = SpooledMedia(self.spool_threshold)
+                for chunk in response.iter_content(chunk_size=self.stream_chunk_size):
+                    media.write(chunk)
+                    if media.size > max_size:
+                        raise ValueError(f"Archivo demasiado grande (> {max_size / (1024 * 1024):.0f}MB)")
+                media.finish()
+
+            media.content_type = sniff_media_content_type(media.head, declared)
+            media.filename = self._generate_filename_from_content_type(media.content_type)
+            logger.info(
+                f"Streamed media: {media.size} bytes, type: {media.content_type}, "
+                f"{'memory' if media.in_memory else 'spooled to disk'}"
+            )
+            return media
+
+        except Exception as e:
+            if media is not None:
+                media.close()
+            logger.error(f"Error streaming media from {media_url}: {e}", exc_info=True)
+            raise
+
     def _generate_filename_from_content_type(self, content_type: str) -> str:
         """Generate appropriate filename based on content type"""
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -534,8 +1105,10 @@ class ExtendedFileService:
             try:
                 resolved_company_id = company_id or (phone and _resolve_company_id_from_phone(phone)) or None
 
+                # Credenciales una sola vez para todo el pipeline (URL + descarga)
                 if phone:
                     creds = get_whatsapp_credentials_for_phone(phone, company_id=resolved_company_id)
+                    token = creds.get('access_token')
                     logger.info("=" * 80)
                     logger.info(f"🔐 Processing media {media_id} with credentials for phone {phone}:")
                     logger.info(f"📱 Company: {creds.get('company_name', 'Default')}")
@@ -544,19 +1117,51 @@ class ExtendedFileService:
                     logger.info(f"📞 Phone Number ID: {creds.get('phone_number_id', '')}")
                     logger.info(f"💼 Business ID: {creds.get('business_id', '')}")
                     logger.info("=" * 80)
+                else:
+                    token = self.config.whatsapp_config.get("access_token")
+                if not token:
+                    raise RuntimeError("No WhatsApp access token available for media")
 
-                media_url = self.get_whatsapp_media_url(media_id, phone, resolved_company_id)
+                media_url = self.get_whatsapp_media_url(media_id, token=token)
                 if not media_url:
                     raise ValueError("Could not get media URL from WhatsApp")
 
-                content, filename, content_type = self.download_whatsapp_media(media_url, phone, resolved_company_id)
-
+                sha256 = None
+                if self.streaming_enabled:
+                    try:
+                        media = self.download_whatsapp_media_stream(media_url, token=token)
+                    except requests.exceptions.HTTPError as e:
+                        # URL cacheada caducada/revocada: pedir una nueva y reintentar una vez
+                        if e.response is None or e.response.status_code not in (401, 403, 404):
+                            raise
+                        self.media_fetcher.invalidate(media_id)
+                        media_url = self.get_whatsapp_media_url(media_id, token=token)
+                        media = self.download_whatsapp_media_stream(media_url, token=token)
+
+                    with media:
+                        filename, content_type, sha256 = media.filename, media.content_type, media.sha256
+
+                        # 3. Validación extendida (tamaño ya conocido, solo necesita la cabecera)
+                        validation = self.validate_file_extended(media.head, filename, content_type, file_size=media.size)
+
+                        # 4. Subir a Supabase (desde memoria o desde el temporal)
+                        upload_result = self.upload_to_supabase(media, filename, content_type)
+                else:
+                    try:
+                        content, filename, content_type = self.download_whatsapp_media(media_url, token=token)
+                    except requests.exceptions.HTTPError as e:
+                        if e.response is None or e.response.status_code not in (401, 403, 404):
+                            raise
+                        self.media_fetcher.invalidate(media_id)
+                        media_url = self.get_whatsapp_media_url(media_id, token=token)
+                        content, filename, content_type = self.download_whatsapp_media(media_url, token=token)
+                    sha256 = hashlib.sha256(content).hexdigest()
 
-                # 3. Validación extendida
-                validation = self.validate_file_extended(content, filename, content_type)
+                    # 3. Validación extendida
+                    validation = self.validate_file_extended(content, filename, content_type)
 
-                # 4. Subir a Supabase
-                upload_result = self.upload_to_supabase(content, filename, content_type)
+                    # 4. Subir a Supabase
+                    upload_result = self.upload_to_supabase(content, filename, content_type)
 
                 # 5. Guardar metadata en base de datos
                 upload_result['original_filename'] = original_filename or filename
@@ -575,7 +1180,8 @@ class ExtendedFileService:
                     'whatsapp_type': validation['whatsapp_type'],
                     'file_size': validation['file_size'],
                     'supabase_path': upload_result['file_path'],
-                    'public_url': upload_result['public_url']
+                    'public_url': upload_result['public_url'],
+                    'sha256': sha256
                 }
 
                 logger.info(f"Media processed successfully: {media_id} -> {document_id} (type: {validation['media_type']})")
@@ -674,19 +1280,15 @@ class ExtendedFileService:
         Devuelve (success, wamid)
         """
         try:
-            # 1) Descargar el archivo desde Supabase
-            file_bytes = self.supabase.storage.from_(self.storage_bucket).download(file_path)
-            if not file_bytes:
-                raise ValueError("Could not download file from Supabase")
-
-            # 2) Detectar content-type
+            # 1) Detectar content-type
             content_type = self._detect_content_type_from_path(file_path)
 
-            # 3) Determinar tipo WhatsApp (normalizado)
+            # 2) Determinar tipo WhatsApp (normalizado)
             #    Tu método detect_media_type_from_content puede devolver 'voice'/'sticker';
             #    aquí normalizamos a lo que acepta /messages: image | video | document | audio
+            #    (solo usa content_type/filename, así que no hace falta descargar antes)
             detected_type = self.detect_media_type_from_content(
-                file_bytes, filename or file_path, content_type
+                b'', filename or file_path, content_type
             )
 
             # Config original (si lo usas) y tipo WA base
@@ -701,12 +1303,26 @@ class ExtendedFileService:
                 wa_message_type = "audio"
                 is_voice = True
 
-            # 4) Rama por tipo
+            # 3) Rama por tipo
             if wa_message_type in ("image", "video", "audio", "sticker"):
-                # Subir primero a WhatsApp (devuelve media_id)
-                media_id = self._upload_media_to_whatsapp_extended(
-                    file_bytes, wa_message_type, content_type
-                )
+                # Si ya subimos este contenido a este número, reutilizar el media_id sin descargar
+                media_id = None
+                sha256 = self.media_index.sha256_for_path(file_path)
+                if sha256:
+                    media_id = self.media_index.get_media_id(sha256, self.config.whatsapp_config.get("phone_number_id"))
+
+                if not media_id:
+                    file_bytes = self.supabase.storage.from_(self.storage_bucket).download(file_path)
+                    if not file_bytes:
+                        raise ValueError("Could not download file from Supabase")
+                    # El próximo envío de esta ruta ya no necesita descargarla
+                    sha256 = hashlib.sha256(file_bytes).hexdigest()
+                    self.media_index.put_path(file_path, sha256)
+
+                    # Subir primero a WhatsApp (devuelve media_id)
+                    media_id = self._upload_media_to_whatsapp_extended(
+                        file_bytes, wa_message_type, content_type, sha256=sha256
+                    )
                 if not media_id:
                     raise RuntimeError("WhatsApp /media upload failed (no media_id)")
 
@@ -715,9 +1331,13 @@ class ExtendedFileService:
                 send_filename = None  # nunca filename en audio/sticker; en image/video no se usa
 
                 # Enviar mensaje por ID de media
-                return self._send_whatsapp_media_message_extended(
+                sent, wamid = self._send_whatsapp_media_message_extended(
                     phone, media_id, wa_message_type, send_caption, send_filename
                 )
+                if not sent and sha256:
+                    # media_id caducado/borrado en Meta: que el próximo envío lo vuelva a subir
+                    self.media_index.forget_media_id(sha256, self.config.whatsapp_config.get("phone_number_id"))
+                return sent, wamid
 
             else:
                 # DOCUMENTOS u otros -> enviar por LINK público
@@ -740,8 +1360,16 @@ class ExtendedFileService:
         content_type, _ = mimetypes.guess_type(file_path)
         return content_type or 'application/octet-stream'
 
-    def _upload_media_to_whatsapp_extended(self, file_content: bytes, media_type: str, content_type: str) -> str:
-        """Upload media to WhatsApp with extended type support"""
+    def _upload_media_to_whatsapp_extended(self, file_content: bytes, media_type: str, content_type: str,
+                                           sha256: str = None) -> str:
+        """Upload media to WhatsApp with extended type support (reutiliza media_id si el contenido ya se subió a ese número)"""
+        phone_number_id = self.config.whatsapp_config["phone_number_id"]
+        sha256 = sha256 or hashlib.sha256(file_content).hexdigest()
+        cached_id = self.media_index.get_media_id(sha256, phone_number_id)
+        if cached_id:
+            logger.info(f"Media dedupe hit ({sha256[:12]}): reusing WhatsApp media_id {cached_id}")
+            return cached_id
+
         headers = {
             'Authorization': f'Bearer {self.config.whatsapp_config["access_token"]}',
         }
@@ -752,7 +1380,7 @@ class ExtendedFileService:
             'messaging_product': (None, 'whatsapp')
         }
         
-        response = requests.post(
+        response = graph_http.post(
             f'https://graph.facebook.com/v22.0/{self.config.whatsapp_config["phone_number_id"]}/media',
             headers={'Authorization': headers['Authorization']},
             files=files,
@@ -761,6 +1389,7 @@ class ExtendedFileService:
         
         response.raise_for_status()
         result = response.json()
+        self.media_index.put_media_id(sha256, phone_number_id, result['id'], len(file_content))
         return result['id']
 
     def build_whatsapp_media_payload(to_e164: str, media_kind: str, media_id: str = None, link: str = None, mime_type: str = None, caption: str = None, voice: bool = False):
@@ -835,7 +1464,7 @@ class ExtendedFileService:
     def _validate_pnid_auth(pnid: str, access_token: str):
         try:
             url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{pnid}"
-            r = requests.get(url, headers={"Authorization": f"Bearer {access_token}"}, timeout=8)
+            r = graph_http.get(url, headers={"Authorization": f"Bearer {access_token}"}, timeout=8)
             if r.status_code != 200:
                 raise RuntimeError(f"Token no válido para PNID {pnid}: HTTP {r.status_code} {r.text}")
         except Exception:
@@ -983,7 +1612,7 @@ class ExtendedFileService:
                 media_type, destination, source, pnid, waba, url, masked, bool(caption), (filename or "N/A")
             )
 
-            resp = requests.post(url, headers=token_headers, json=payload, timeout=30)
+            resp = graph_http.post(url, headers=token_headers, json=payload, timeout=30)
             if not resp.ok:
                 logger.error(
                     "Error %s enviando media: %s (type=%s, source=%s, pnid=%s)",
@@ -1069,7 +1698,7 @@ class ExtendedFileService:
                 destination, source, pnid, waba, url, masked, (filename or "N/A"), bool(caption)
             )
 
-            resp = requests.post(url, headers=token_headers, json=payload, timeout=30)
+            resp = graph_http.post(url, headers=token_headers, json=payload, timeout=30)
             if not resp.ok:
                 logger.error("Error %s enviando documento: %s (source=%s, pnid=%s)",
                             resp.status_code, resp.text, source, pnid)
@@ -1140,8 +1769,12 @@ class FlowExitClient:
         'http_port': 5101,
         'exit_path': '/api/exit',
         'try_candidates': True,
-        'timeout': 8
+        'timeout': 8,
+        'health_cooldown': 60
       }
+
+    Memoria de salud por URL candidata: la última que respondió se prueba primero y las que
+    fallan (red, 404, 5xx) quedan al final durante health_cooldown segundos.
     """
 
     def __init__(self, *args, **kwargs):
@@ -1177,6 +1810,10 @@ class FlowExitClient:
 
         self.logger = logger or logging.getLogger(__name__)
 
+        self.health_cooldown = float(flow_config.get('health_cooldown', 60))
+        self._health = {}   # url -> {'ok', 'fail', 'last_status', 'last_ok_at', 'down_until'}
+        self._health_lock = threading.Lock()
+
     def _candidates(self):
         """
         Devuelve lista de URLs candidatas según configuración.
@@ -1196,6 +1833,38 @@ class FlowExitClient:
                 seen.add(u)
         return ordered
 
+    def _ordered_candidates(self):
+        """Candidatas por salud: disponibles (la última OK primero) y después las caídas."""
+        candidates = self._candidates() if self.try_candidates else [f"{self.base_url}{self.exit_path}"]
+        now = time.time()
+        with self._health_lock:
+            def rank(item):
+                idx, url = item
+                h = self._health.get(url) or {}
+                down = h.get('down_until', 0) > now
+                return (down, -(h.get('last_ok_at') or 0), idx)
+            return [url for _, url in sorted(enumerate(candidates), key=rank)]
+
+    def _record_health(self, url: str, status, ok: bool):
+        with self._health_lock:
+            h = self._health.setdefault(url, {'ok': 0, 'fail': 0, 'last_status': None, 'last_ok_at': None, 'down_until': 0})
+            h['last_status'] = status
+            if ok:
+                h['ok'] += 1
+                h['last_ok_at'] = time.time()
+                h['down_until'] = 0
+            else:
+                h['fail'] += 1
+                h['down_until'] = time.time() + self.health_cooldown
+
+    def health(self) -> dict:
+        now = time.time()
+        with self._health_lock:
+            return {
+                url: {**h, 'down_for': round(max(0.0, h['down_until'] - now), 1)}
+                for url, h in self._health.items()
+            }
+
     def send_exit(self, lead_id: str, flow_name: str = "welcome_email_flow",
                   motivo: str = "Usuario quiere salir del flow") -> bool:
         """
@@ -1212,7 +1881,7 @@ class FlowExitClient:
             "motivo": motivo,
         }
 
-        candidates = self._candidates() if self.try_candidates else [f"{self.base_url}{self.exit_path}"]
+        candidates = self._ordered_candidates()
 
         for idx, url in enumerate(candidates, start=1):
             try:
@@ -1223,7 +1892,7 @@ class FlowExitClient:
                     'headers': headers,
                     'payload': payload
                 })
-                resp = requests.post(url, headers=headers, json=payload, timeout=self.timeout)
+                resp = graph_http.post(url, headers=headers, json=payload, timeout=self.timeout)
                 text_prev = (resp.text or '')[:2000]
                 self.logger.debug({
                     'event': 'flow.exit.response',
@@ -1233,14 +1902,19 @@ class FlowExitClient:
 
                 # Caso OK
                 if 200 <= resp.status_code < 300:
+                    self._record_health(url, resp.status_code, True)
                     self.logger.info(f"[FLOW EXIT] OK {resp.status_code} en {url}")
                     return True
 
                 # Caso idempotente / sin nodos activos => lo damos por bueno
                 if resp.status_code == 400 and 'No active flow nodes found' in text_prev:
+                    self._record_health(url, resp.status_code, True)
                     self.logger.warning(f"[FLOW EXIT] 400 pero sin nodos activos; lo consideramos completado: {url}")
                     return True
 
+                # 404 / 5xx: la ruta no está en ese puerto o el scheduler no responde ahí
+                self._record_health(url, resp.status_code, not (resp.status_code == 404 or resp.status_code >= 500))
+
                 # Errores típicos
                 if resp.status_code == 401:
                     self.logger.error(f"[FLOW EXIT] HTTP 401 en {url} (credenciales faltan o no válidas).")
@@ -1250,18 +1924,123 @@ class FlowExitClient:
                     self.logger.error(f"[FLOW EXIT] HTTP {resp.status_code} en {url}")
 
             except Exception as e:
+                self._record_health(url, None, False)
                 self.logger.exception(f"[FLOW EXIT] excepción realizando POST a {url}: {e}")
 
         self.logger.error("[FLOW EXIT] Fallaron todos los candidatos; revisa Nginx/puerto/route del scheduler")
         return False
 
+
+class FlowExitOutbox:
+    """
+    Envío de los flow-exit en segundo plano para que el webhook no espere al scheduler.
+    - submit(lead_id, on_success=...) vuelve al momento; un hilo llama a FlowExitClient.send_exit.
+    - Si falla, reintento con backoff exponencial hasta max_attempts; on_success(job) al completar
+      (p.ej. el marcador 'flow_exit_triggered').
+    - Un mismo lead pendiente no se encola dos veces.
+    """
+    def __init__(self, client, max_attempts: int = 6, base_backoff: float = 5.0, max_backoff: float = 300.0,
+                 max_pending: int = 10000):
+        self.client = client
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self._heap = []
+        self._pending = {}   # lead_id -> job
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._stop = threading.Event()
+        self._stats = {'submitted': 0, 'deduplicated': 0, 'rejected': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+        self._thread = Thread(target=self._worker, name='flow-exit-outbox', daemon=True)
+        self._thread.start()
+
+    def submit(self, lead_id: str, flow_name: str = "welcome_email_flow",
+               motivo: str = "Usuario quiere salir del flow", on_success=None, meta: dict = None) -> bool:
+        lead_id = str(lead_id)
+        with self._cond:
+            if lead_id in self._pending:
+                self._stats['deduplicated'] += 1
+                return True
+            if len(self._pending) >= self.max_pending:
+                self._stats['rejected'] += 1
+                logger.error(f"[FLOW EXIT] Outbox llena ({self.max_pending}); se descarta el exit de lead_id={lead_id}")
+                return False
+            job = {
+                'lead_id': lead_id, 'flow_name': flow_name, 'motivo': motivo, 'attempts': 0,
+                'created_at': time.time(), 'meta': meta or {}, '_on_success': on_success,
+            }
+            self._pending[lead_id] = job
+            self._stats['submitted'] += 1
+            self._push(job, 0.0)
+        return True
+
+    def _push(self, job: dict, not_before: float):
+        self._seq += 1
+        heapq.heappush(self._heap, (not_before, self._seq, job))
+        self._cond.notify()
+
+    def _worker(self):
+        while not self._stop.is_set():
+            with self._cond:
+                if not self._heap or self._heap[0][0] > time.monotonic():
+                    wait = (self._heap[0][0] - time.monotonic()) if self._heap else 1.0
+                    self._cond.wait(timeout=min(max(wait, 0.01), 1.0))
+                    continue
+                _, _, job = heapq.heappop(self._heap)
+            self._execute(job)
+
+    def _execute(self, job: dict):
+        job['attempts'] += 1
+        try:
+            ok = self.client.send_exit(job['lead_id'], flow_name=job['flow_name'], motivo=job['motivo'])
+        except Exception:
+            logger.exception(f"[FLOW EXIT] Error enviando exit de lead_id={job['lead_id']}")
+            ok = False
+
+        if not ok and job['attempts'] < self.max_attempts:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** (job['attempts'] - 1)))
+            delay += random.uniform(0, delay / 4)
+            logger.warning(f"[FLOW EXIT] lead_id={job['lead_id']} intento {job['attempts']}/{self.max_attempts} fallido; "
+                           f"reintento en {delay:.0f}s")
+            with self._cond:
+                self._stats['retried'] += 1
+                self._push(job, time.monotonic() + delay)
+            return
+
+        with self._cond:
+            self._pending.pop(job['lead_id'], None)
+            self._stats['sent' if ok else 'failed'] += 1
+        if not ok:
+            logger.error(f"[FLOW EXIT] lead_id={job['lead_id']} descartado tras {job['attempts']} intentos")
+            return
+        callback = job.get('_on_success')
+        if callback:
+            try:
+                callback(job)
+            except Exception:
+                logger.exception(f"[FLOW EXIT] on_success falló para lead_id={job['lead_id']}")
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = {'pending': len(self._pending), 'max_attempts': self.max_attempts, **self._stats}
+        stats['endpoints'] = self.client.health()
+        return stats
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+
 class Config:
     """Centralized configuration management with company cache support"""
     def __init__(self, config_path=None, company_id=None, supabase_client=None):
         self._logger = logging.getLogger(__name__)
         self.config = configparser.ConfigParser()
         if config_path is None:
-            config_path = 'scripts.conf'
+            # serve.py --config lo pasa a los workers por CLOUDAPI_CONFIG
+            config_path = os.getenv('CLOUDAPI_CONFIG', 'scripts.conf')
         self.config.read(config_path)
         self._init_logging()
         # Clamp global levels a INFO
@@ -1281,8 +2060,7 @@ class Config:
         # Precargar configs si es la primera instancia
         global company_cache
         if not company_cache._last_reload:
-            db_manager = DatabaseManager(self.db_config)
-            company_cache.preload_all_companies(db_manager)
+            company_cache.preload_all_companies(get_db_manager(self.db_config))
         
         # Si hay company_id, cargar de caché
         if self.company_id:
@@ -1415,7 +2193,7 @@ class Config:
             }
 
             # Hacer la llamada a la API
-            response = requests.get(api_url, headers=headers)
+            response = graph_http.get(api_url, headers=headers)
             response.raise_for_status()
             properties = response.json()
 
@@ -1573,6 +2351,12 @@ class Config:
             'user': db_cfg.get('DB_USER'),
             'password': db_cfg.get('DB_PASS'),
             'search_path': db_cfg.get('DB_SEARCH_PATH', None),
+            # Pool de conexiones
+            'pool_min_size': int(db_cfg.get('DB_POOL_MIN_SIZE', '1')),
+            'pool_max_size': int(db_cfg.get('DB_POOL_MAX_SIZE', '10')),
+            'pool_idle_timeout': int(db_cfg.get('DB_POOL_IDLE_TIMEOUT', '300')),
+            'pool_checkout_timeout': int(db_cfg.get('DB_POOL_CHECKOUT_TIMEOUT', '10')),
+            'pool_health_check_interval': int(db_cfg.get('DB_POOL_HEALTH_CHECK_INTERVAL', '30')),
         }
         missing = [k for k, v in self.db_config.items() if k != 'search_path' and v in (None, '')]
         if missing:
@@ -1656,7 +2440,7 @@ class Config:
         # Comprobar si existen los certificados
         cert_exists = bool(ssl_cert)  # Asumir que existe si tiene valor
         key_exists = bool(ssl_key)    # Asumir que existe si tiene valor
-        `   if not (cert_exists and key_exists):
+        if not (cert_exists and key_exists):
             self._logger.warning(f"[Config] SSL cert or key not found. Falling back to HTTP only. Cert: {ssl_cert}, Key: {ssl_key}")
             ssl_cert = None
             ssl_key = None
@@ -1743,6 +2527,36 @@ class Config:
             'exit_path': exit_path if exit_path.startswith('/') else f'/{exit_path}',
             'try_candidates': try_candidates,
             'timeout': int(flow_cfg.get('timeout', 8)),  # segundos
+            'health_cooldown': int(flow_cfg.get('health_cooldown', 60)),  # segundos que una URL caída va al final
+            # exits en segundo plano (outbox) en vez de bloquear el webhook
+            'async_exit': flow_cfg.get('async_exit', 'true').strip().lower() in ('1', 'true', 'yes', 'y'),
+            'max_attempts': int(flow_cfg.get('max_attempts', 6)),
+            'context_window_minutes': int(flow_cfg.get('context_window_minutes', 15)),
+        }
+
+        # ---------- INGEST (cola asíncrona para /<company_id>/webhook) ----------
+        ingest_cfg = self.config['INGEST'] if self.config.has_section('INGEST') else {}
+        ingest_enabled = os.getenv('INGEST_ENABLED') or ingest_cfg.get('enabled', 'false')
+        self.ingest_config = {
+            'enabled': ingest_enabled.strip().lower() in ('1', 'true', 'yes', 'y'),
+            'queue_path': ingest_cfg.get('queue_path', 'webhook_ingest.db'),
+            'workers': int(ingest_cfg.get('workers', 4)),
+            'max_pending': int(ingest_cfg.get('max_pending', 10000)),   # backpressure -> 503
+            'max_attempts': int(ingest_cfg.get('max_attempts', 5)),
+            'lease_timeout': int(ingest_cfg.get('lease_timeout', 300)),  # segundos
+            'mode': (ingest_cfg.get('mode', 'threads') or 'threads').strip().lower(),  # threads | async
+            # None -> DB_POOL_MAX_SIZE (cada evento en vuelo ocupa un hilo y una conexión)
+            'max_in_flight': int(ingest_cfg['max_in_flight']) if ingest_cfg.get('max_in_flight') else None,
+        }
+
+        # ---------- AUTO_REPLY (estado "ya respondido" compartido entre workers) ----------
+        auto_reply_cfg = self.config['AUTO_REPLY'] if self.config.has_section('AUTO_REPLY') else {}
+        self.auto_reply_config = {
+            'backend': (auto_reply_cfg.get('backend', 'sqlite') or 'sqlite').strip().lower(),  # sqlite | memory
+            'store_path': auto_reply_cfg.get('store_path', 'auto_reply_state.db'),
+            'ttl': int(auto_reply_cfg.get('ttl', 3600)),  # segundos
+            'max_size': int(auto_reply_cfg.get('max_size', 100000)),
+            'db_check': (auto_reply_cfg.get('db_check', 'cold') or 'cold').strip().lower(),  # always | cold | never
         }
 
         # ---------- Logs de resumen seguro ----------
@@ -1759,13 +2573,178 @@ class Config:
         except Exception:
             logging.exception("[Config] No se pudo loguear flow_config")
 
+class ConnectionPool:
+    """
+    Pool de conexiones pg8000 thread-safe.
+    - min_size/max_size: conexiones físicas que se mantienen / máximo abierto.
+    - Health check (SELECT 1) al hacer checkout si la conexión lleva ociosa más de health_check_interval.
+    - Las conexiones ociosas más de idle_timeout se cierran (respetando min_size).
+    """
+    def __init__(self, connect_fn, min_size=1, max_size=10, idle_timeout=300,
+                 checkout_timeout=10, health_check_interval=30):
+        self._connect = connect_fn
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size), self.min_size)
+        self.idle_timeout = float(idle_timeout)
+        self.checkout_timeout = float(checkout_timeout)
+        self.health_check_interval = float(health_check_interval)
+
+        self._cond = threading.Condition()
+        self._idle = []      # [(conn, last_used_monotonic)] LIFO
+        self._size = 0       # conexiones físicas abiertas (incluye las que se están creando)
+        self._in_use = 0
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+        }
+
+    def acquire(self):
+        """Obtiene una conexión del pool (bloquea hasta checkout_timeout si está lleno)"""
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        waited = False
+
+        while True:
+            conn, last_used, to_close = None, None, []
+            with self._cond:
+                to_close = self._evict_idle_locked()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise TimeoutError(
+                            f"DB pool exhausted: {self._size}/{self.max_size} in use after {self.checkout_timeout}s"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1  # reservamos el hueco antes de conectar fuera del lock
+
+            self._close_all(to_close)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+            elif time.monotonic() - last_used >= self.health_check_interval and not self._is_healthy(conn):
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                    self._stats['wait_time_ms'] += (time.monotonic() - start) * 1000
+            return conn
+
+    def release(self, conn, discard=False):
+        """Devuelve la conexión al pool (o la cierra si está rota)"""
+        with self._cond:
+            self._in_use -= 1
+        if discard:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            to_close = self._evict_idle_locked()
+            self._cond.notify()
+        self._close_all(to_close)
+
+    def stats(self) -> dict:
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                **self._stats,
+                'wait_time_ms': round(self._stats['wait_time_ms'], 2),
+                'avg_wait_ms': round(self._stats['wait_time_ms'] / self._stats['waits'], 2) if self._stats['waits'] else 0.0,
+                'reuse_ratio': round(1 - self._stats['created'] / checkouts, 4) if checkouts else 0.0,
+            }
+
+    def close(self):
+        """Cierra todas las conexiones ociosas"""
+        with self._cond:
+            to_close = [c for c, _ in self._idle]
+            self._idle = []
+            self._size -= len(to_close)
+            self._cond.notify_all()
+        self._close_all(to_close)
+
+    def _evict_idle_locked(self) -> list:
+        """Saca del pool las conexiones ociosas caducadas (llamar con el lock cogido)"""
+        if not self._idle or self.idle_timeout <= 0:
+            return []
+        now = time.monotonic()
+        evicted = []
+        # _idle es LIFO: las más antiguas están al principio
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            evicted.append(self._idle.pop(0)[0])
+            self._size -= 1
+        return evicted
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.warning(f"[DB POOL] Health check failed, discarding connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close_all([conn])
+
+    def _close_all(self, conns):
+        for c in conns:
+            try:
+                c.close()
+            except Exception:
+                pass
+            with self._cond:
+                self._stats['closed'] += 1
+
+
 class DatabaseManager:
     """Database operations manager"""
     def __init__(self, db_config):
         self.db_config = db_config
+        self.pool = ConnectionPool(
+            self._connect,
+            min_size=db_config.get('pool_min_size', 1),
+            max_size=db_config.get('pool_max_size', 10),
+            idle_timeout=db_config.get('pool_idle_timeout', 300),
+            checkout_timeout=db_config.get('pool_checkout_timeout', 10),
+            health_check_interval=db_config.get('pool_health_check_interval', 30),
+        )
+        self._local = threading.local()  # unit of work activo por hilo
 
-    def get_connection(self):
-        """Get database connection with retry logic"""
+    def _connect(self):
+        """Open a physical connection with retry logic (session setup runs once per connection)"""
         max_retries = 3
         for attempt in range(max_retries):
             try:
@@ -1797,19 +2776,173 @@ class DatabaseManager:
                     raise
                 time.sleep(1)
 
-    def execute_query(self, query, params=None, fetch_one=False, fetch_all=False):
+    @contextmanager
+    def get_connection(self):
         """
-        Ejecuta una consulta con logging robusto y manejo opcional de escritura deshabilitada.
-        - Soporta pg8000 (%s + lista/tupla en params).
-        - Evita UnboundLocalError con q_preview.
+        Checkout de una conexión del pool. Uso: `with db_manager.get_connection() as conn:`
+        Al salir la conexión vuelve al pool (rollback si quedó una transacción abierta).
+        Dentro de un unit_of_work() devuelve la conexión de la unidad de trabajo.
         """
-        start = time.time()
+        uow = getattr(self._local, 'uow', None)
+        if uow is not None:
+            yield uow['conn']
+            return
+
+        conn = self.pool.acquire()
+        broken = False
         try:
-            q_preview = ' '.join((query or '').split())[:500]
+            yield conn
         except Exception:
-            q_preview = str(query)[:500] if query is not None else '<empty-query>'
-
-        params = params or []
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            if not broken and getattr(conn, 'in_transaction', True):
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            self.pool.release(conn, discard=broken)
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Agrupa todas las execute_query del hilo actual en una sola conexión y una sola transacción.
+
+            with db_manager.unit_of_work():
+                lead = lead_service.get_lead_data_by_phone(phone)
+                message_service.save_incoming_message(msg, wa_id)
+
+        - Commit único al salir; rollback completo si sale una excepción.
+        - Tras cada escritura se marca un SAVEPOINT: si una consulta posterior falla (y el
+          llamador captura la excepción), se vuelve al último savepoint en lugar de perder
+          las escrituras anteriores o dejar la transacción abortada.
+        - Anidable: un unit_of_work() interno reutiliza la transacción exterior.
+        - on_commit(fn): efectos en memoria (dedupe, índices) solo si la transacción se confirma;
+          on_rollback(fn): deshacer en memoria lo reservado antes de escribir si no se confirma.
+        - No meter HTTP dentro: la conexión queda "idle in transaction" mientras dura.
+        """
+        if getattr(self._local, 'uow', None) is not None:
+            yield self._local.uow['conn']
+            return
+
+        start = time.time()
+        conn = self.pool.acquire()
+        uow = {'conn': conn, 'savepoint': False, 'statements': 0, 'on_commit': [], 'on_rollback': []}
+        self._local.uow = uow
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            self._run_callbacks(uow['on_rollback'], 'on_rollback')
+            raise
+        finally:
+            self._local.uow = None
+            self.pool.release(conn, discard=broken)
+            logging.debug({
+                'event': 'db.uow.done',
+                'elapsed_ms': int((time.time() - start) * 1000),
+                'statements': uow['statements']
+            })
+        self._run_callbacks(uow['on_commit'], 'on_commit')
+
+    @staticmethod
+    def _run_callbacks(callbacks: list, kind: str):
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                logging.exception(f"[DB] {kind} callback failed")
+
+    @contextmanager
+    def atomic(self):
+        """
+        unit_of_work() todo-o-nada también cuando va anidado: si sale una excepción del bloque se
+        deshacen sus escrituras (ROLLBACK TO SAVEPOINT propio) sin tocar las de la transacción exterior.
+        Los on_commit del bloque se descartan y sus on_rollback se ejecutan en el acto.
+        """
+        uow = getattr(self._local, 'uow', None)
+        if uow is None:
+            with self.unit_of_work() as conn:
+                yield conn
+            return
+
+        conn = uow['conn']
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT uow_atomic")
+        n_commit, n_rollback = len(uow['on_commit']), len(uow['on_rollback'])
+        try:
+            yield conn
+        except Exception:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("ROLLBACK TO SAVEPOINT uow_atomic")
+                    # Los uow_sp del bloque ya no existen: el punto de recuperación pasa a ser este
+                    cur.execute("SAVEPOINT uow_sp")
+                uow['savepoint'] = True
+            except Exception:
+                logging.exception("[DB] atomic block rollback failed")
+            undo = uow['on_rollback'][n_rollback:]
+            del uow['on_commit'][n_commit:], uow['on_rollback'][n_rollback:]
+            self._run_callbacks(undo, 'on_rollback')
+            raise
+
+    def on_commit(self, fn):
+        """Ejecuta fn tras el commit del unit_of_work activo; sin unit of work, en el acto."""
+        uow = getattr(self._local, 'uow', None)
+        if uow is None:
+            fn()
+            return
+        uow['on_commit'].append(fn)
+
+    def on_rollback(self, fn):
+        """Ejecuta fn si el unit_of_work activo (o el atomic() que lo registra) se deshace; sin unit of work, nada."""
+        uow = getattr(self._local, 'uow', None)
+        if uow is not None:
+            uow['on_rollback'].append(fn)
+
+    def _mark_savepoint(self, conn, uow, query):
+        """SAVEPOINT tras cada sentencia que puede escribir (INSERT ... RETURNING incluido)"""
+        if (query or '').lstrip()[:6].lower() == 'select':
+            return
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT uow_sp")
+        uow['savepoint'] = True
+
+    def _recover_unit_of_work(self, conn, uow):
+        """Deja la transacción del unit of work usable tras un error de sentencia"""
+        try:
+            if uow['savepoint']:
+                with conn.cursor() as cur:
+                    cur.execute("ROLLBACK TO SAVEPOINT uow_sp")
+            else:
+                conn.rollback()
+        except Exception:
+            logging.exception("[DB] unit of work recovery failed")
+
+    def pool_stats(self) -> dict:
+        return self.pool.stats()
+
+    def execute_query(self, query, params=None, fetch_one=False, fetch_all=False):
+        """
+        Ejecuta una consulta con logging robusto y manejo opcional de escritura deshabilitada.
+        - Soporta pg8000 (%s + lista/tupla en params).
+        - Evita UnboundLocalError con q_preview.
+        """
+        start = time.time()
+        try:
+            q_preview = ' '.join((query or '').split())[:500]
+        except Exception:
+            q_preview = str(query)[:500] if query is not None else '<empty-query>'
+
+        params = params or []
 
         try:
             is_read = bool(fetch_one or fetch_all)
@@ -1821,6 +2954,7 @@ class DatabaseManager:
                 })
                 return 0
 
+            uow = getattr(self._local, 'uow', None)
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
                     logging.debug({
@@ -1828,14 +2962,26 @@ class DatabaseManager:
                         'query_preview': q_preview,
                         'params_type': type(params).__name__,
                         'fetch_one': fetch_one,
-                        'fetch_all': fetch_all
+                        'fetch_all': fetch_all,
+                        'unit_of_work': uow is not None
                     })
 
-                    cur.execute(query, params)
+                    try:
+                        cur.execute(query, params)
+                    except Exception:
+                        if uow is not None:
+                            self._recover_unit_of_work(conn, uow)
+                        raise
+
+                    if uow is not None:
+                        uow['statements'] += 1
 
                     if fetch_one:
                         row = cur.fetchone()
-                        conn.commit()
+                        if uow is None:
+                            conn.commit()
+                        else:
+                            self._mark_savepoint(conn, uow, query)
                         logging.debug({
                             'event': 'db.execute.done',
                             'elapsed_ms': int((time.time() - start) * 1000),
@@ -1846,7 +2992,10 @@ class DatabaseManager:
 
                     if fetch_all:
                         rows = cur.fetchall()
-                        conn.commit()
+                        if uow is None:
+                            conn.commit()
+                        else:
+                            self._mark_savepoint(conn, uow, query)
                         logging.debug({
                             'event': 'db.execute.done',
                             'elapsed_ms': int((time.time() - start) * 1000),
@@ -1856,7 +3005,10 @@ class DatabaseManager:
                         return rows
 
                     affected_rows = cur.rowcount
-                    conn.commit()
+                    if uow is None:
+                        conn.commit()
+                    else:
+                        self._mark_savepoint(conn, uow, query)
                     logging.info({
                         'event': 'db.execute.done',
                         'elapsed_ms': int((time.time() - start) * 1000),
@@ -1870,6 +3022,20 @@ class DatabaseManager:
             raise
 
 
+db_manager = None
+
+
+def get_db_manager(db_config=None):
+    """
+    DatabaseManager del proceso (un único pool de conexiones). Se crea con db_config la primera
+    vez; Config, el preload y los endpoints lo reutilizan en vez de abrir un pool propio.
+    """
+    global db_manager
+    if db_manager is None:
+        db_manager = DatabaseManager(db_config)
+    return db_manager
+
+
 class PhoneUtils:
     """Phone number utilities"""
     @staticmethod
@@ -1899,12 +3065,654 @@ try:
 except Exception:
     current_app = None
 
+class TokenBucket:
+    """Token bucket simple: `rate` envíos/segundo con ráfagas de hasta `burst`."""
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class _OutboundLane:
+    """Cola de un phone_number_id: heap por prioridad + reintentos diferidos + bucket propio."""
+    def __init__(self, phone_number_id: str, rate: float, burst: float):
+        self.phone_number_id = phone_number_id
+        self.bucket = TokenBucket(rate, burst)
+        self.heap = []
+        self.delayed = []
+        self.cond = threading.Condition()
+        self.paused_until = 0.0
+        self.thread = None
+        self.executor = None   # POSTs en paralelo (hasta `concurrency`)
+        self.in_flight = 0
+        self.sent = 0
+        self.throttled = 0
+
+
+class OutboundDispatcher:
+    """
+    Envíos salientes a Graph con una cola por phone_number_id.
+    - Token bucket por número (throughput del tier; Cloud API por defecto ~80 msg/s)
+    - Backoff automático ante throttling de Meta:
+        130429 / 80007 -> se pausa todo el número
+        131056 (pair rate limit) -> solo se retrasa ese envío
+    - Prioridades: respuestas automáticas/conversación antes que templates masivos
+    - Hasta `concurrency` POSTs en vuelo por número (el bucket marca el ritmo, no el RTT);
+      `reply_slots` de ellos nunca los ocupan envíos PRIORITY_BULK
+    - send(): síncrono (espera la respuesta, los endpoints actuales siguen igual)
+      submit(): asíncrono, devuelve job_id consultable con job_status()
+    - Con `shared_state` (WorkerState) el estado de los jobs asíncronos sin on_done se publica
+      para que GET /outbound/jobs/<id> responda desde cualquier worker de serve.py
+    """
+    PRIORITY_REPLY = 0
+    PRIORITY_DEFAULT = 5
+    PRIORITY_BULK = 9
+
+    LANE_THROTTLE_CODES = {130429, 80007}
+    PAIR_THROTTLE_CODES = {131056}
+
+    def __init__(self, rate_per_sec: float = 80.0, burst: float = 80.0, max_retries: int = 5,
+                 base_backoff: float = 2.0, max_backoff: float = 60.0, max_jobs: int = 100000,
+                 http_client=None, concurrency: int = 16, reply_slots: int = 2):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.concurrency = max(1, int(concurrency))
+        self.reply_slots = min(max(0, int(reply_slots)), self.concurrency - 1)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_jobs = max_jobs
+        self.http = http_client or graph_http
+        self._lanes = {}
+        self._lanes_lock = threading.Lock()
+        self._jobs: OrderedDict = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._seq = 0
+        self._stop = threading.Event()
+        self.shared_state = None
+        self.shared_ttl = 3600
+
+    # ---------- API ----------
+    def submit(self, phone_number_id: str, url: str, headers: dict, payload: dict,
+               priority: int = PRIORITY_DEFAULT, timeout: float = 15, on_done=None, meta: dict = None) -> str:
+        """Encola un POST a Graph y devuelve el job_id. on_done(job) se llama al terminar (en el worker)."""
+        return self._enqueue(phone_number_id, url, headers, payload, priority, timeout, on_done, meta)['id']
+
+    def send(self, phone_number_id: str, url: str, headers: dict, payload: dict,
+             priority: int = PRIORITY_DEFAULT, timeout: float = 15, wait_timeout: float = None):
+        """
+        Encola y espera: devuelve el requests.Response final (tras reintentos por throttling).
+        Si vence wait_timeout con el job aún en cola se cancela y sale Timeout; si el POST ya
+        está en vuelo se espera a su resultado real (el mensaje puede haber salido).
+        """
+        job = self._enqueue(phone_number_id, url, headers, payload, priority, timeout, sync=True)
+        if wait_timeout is None:
+            wait_timeout = timeout + self.max_backoff * 2
+        if not job['_event'].wait(wait_timeout):
+            lane = self._lane(job['phone_number_id'])
+            while True:
+                with lane.cond:
+                    if job['status'] in ('queued', 'retrying'):
+                        job['_cancelled'] = True
+                        raise requests.exceptions.Timeout(f"Outbound job {job['id']} not sent within {wait_timeout}s")
+                if job['_event'].wait(timeout + 1):
+                    break
+        response, exc = job['_response'], job['_exception']
+        job['_response'] = None
+        if exc is not None:
+            raise exc
+        return response
+
+    def _enqueue(self, phone_number_id, url, headers, payload, priority, timeout,
+                 on_done=None, meta=None, sync=False) -> dict:
+        lane = self._lane(phone_number_id)
+        job = {
+            'id': uuid4().hex,
+            'phone_number_id': lane.phone_number_id,
+            'priority': priority,
+            'status': 'queued',
+            'attempts': 0,
+            'created_at': time.time(),
+            'finished_at': None,
+            'http_status': None,
+            'message_id': None,
+            'error': None,
+            'meta': meta or {},
+            # internos (no se exponen)
+            '_request': (url, headers, payload, timeout),
+            '_on_done': on_done,
+            '_event': threading.Event(),
+            '_response': None,
+            '_exception': None,
+            '_cancelled': False,
+            '_sync': sync,
+        }
+        with self._jobs_lock:
+            self._jobs[job['id']] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        self._share(job)
+        self._push(lane, job)
+        return job
+
+    def job_status(self, job_id: str) -> dict | None:
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return {k: v for k, v in job.items() if not k.startswith('_')}
+        # Encolado por otro worker
+        return self.shared_state.get('outbound_job', job_id) if self.shared_state is not None else None
+
+    def _share(self, job: dict):
+        # Los síncronos no se consultan y los de campaña se siguen por la campaña
+        if self.shared_state is None or job['_sync'] or job['_on_done'] is not None:
+            return
+        try:
+            self.shared_state.put('outbound_job', job['id'],
+                                  {k: v for k, v in job.items() if not k.startswith('_')}, self.shared_ttl)
+        except Exception as e:
+            logger.warning(f"[OUTBOUND] No se pudo compartir el estado del job {job['id']}: {e}")
+
+    def stats(self) -> dict:
+        with self._lanes_lock:
+            lanes = list(self._lanes.values())
+        now = time.monotonic()
+        lane_stats = {}
+        for lane in lanes:
+            with lane.cond:
+                lane_stats[lane.phone_number_id] = {
+                    'queued': len(lane.heap),
+                    'delayed': len(lane.delayed),
+                    'in_flight': lane.in_flight,
+                    'sent': lane.sent,
+                    'throttled': lane.throttled,
+                    'paused_for': round(max(0.0, lane.paused_until - now), 2),
+                }
+        with self._jobs_lock:
+            tracked = len(self._jobs)
+        return {
+            'rate_per_sec': self.rate_per_sec,
+            'burst': self.burst,
+            'concurrency': self.concurrency,
+            'reply_slots': self.reply_slots,
+            'tracked_jobs': tracked,
+            'lanes': lane_stats,
+        }
+
+    def stop(self):
+        self._stop.set()
+        with self._lanes_lock:
+            lanes = list(self._lanes.values())
+        for lane in lanes:
+            with lane.cond:
+                lane.cond.notify_all()
+            if lane.executor is not None:
+                lane.executor.shutdown(wait=False)
+
+    # ---------- Internos ----------
+    def _lane(self, phone_number_id: str) -> _OutboundLane:
+        key = str(phone_number_id or 'default')
+        with self._lanes_lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = _OutboundLane(key, self.rate_per_sec, self.burst)
+                lane.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f'outbound-{key}-send')
+                lane.thread = Thread(target=self._worker, args=(lane,), name=f'outbound-{key}', daemon=True)
+                self._lanes[key] = lane
+                lane.thread.start()
+            return lane
+
+    def _push(self, lane: _OutboundLane, job: dict, not_before: float = 0.0):
+        with lane.cond:
+            self._seq += 1
+            item = (job['priority'], self._seq, job)
+            if not_before > time.monotonic():
+                lane.delayed.append((not_before, item))
+            else:
+                heapq.heappush(lane.heap, item)
+            lane.cond.notify()
+
+    def _slots_for(self, priority: int) -> int:
+        """Envíos en vuelo permitidos para esa prioridad (los masivos dejan huecos a las respuestas)."""
+        if priority >= self.PRIORITY_BULK:
+            return self.concurrency - self.reply_slots
+        return self.concurrency
+
+    def _worker(self, lane: _OutboundLane):
+        while not self._stop.is_set():
+            job = None
+            cancelled = None
+            with lane.cond:
+                now = time.monotonic()
+                if lane.delayed:
+                    ready = [d for d in lane.delayed if d[0] <= now]
+                    if ready:
+                        lane.delayed = [d for d in lane.delayed if d[0] > now]
+                        for _, item in ready:
+                            heapq.heappush(lane.heap, item)
+
+                wait = None
+                if lane.heap and lane.heap[0][2]['_cancelled']:
+                    _, _, cancelled = heapq.heappop(lane.heap)
+                elif lane.heap and lane.in_flight < self._slots_for(lane.heap[0][0]):
+                    wait = max(lane.paused_until - now, lane.bucket.wait_time())
+                    if wait <= 0:
+                        _, _, job = heapq.heappop(lane.heap)
+                        lane.bucket.consume()
+                        job['status'] = 'sending'
+                        lane.in_flight += 1
+                elif lane.delayed:
+                    wait = min(d[0] for d in lane.delayed) - now
+
+                if job is None and cancelled is None:
+                    # Sin hueco libre: _run_job despierta al terminar un envío
+                    lane.cond.wait(timeout=min(wait, 1.0) if wait is not None else 1.0)
+                    continue
+            if cancelled is not None:
+                self._finish(cancelled, 'cancelled')
+                continue
+            try:
+                lane.executor.submit(self._run_job, lane, job)
+            except RuntimeError:
+                # executor cerrado (stop)
+                self._run_job(lane, job)
+
+    def _run_job(self, lane: _OutboundLane, job: dict):
+        try:
+            self._execute(lane, job)
+        except Exception as e:
+            logger.exception(f"[OUTBOUND] pnid={lane.phone_number_id} job={job['id']} crashed")
+            job['_exception'] = e
+            job['error'] = str(e)
+            self._finish(job, 'failed')
+        finally:
+            with lane.cond:
+                lane.in_flight -= 1
+                lane.cond.notify()
+
+    @staticmethod
+    def _error_code(response) -> int | None:
+        if response is None:
+            return None
+        try:
+            return int(((response.json() or {}).get('error') or {}).get('code'))
+        except Exception:
+            return 130429 if response.status_code == 429 else None
+
+    def _execute(self, lane: _OutboundLane, job: dict):
+        url, headers, payload, timeout = job['_request']
+        job['attempts'] += 1
+        try:
+            response = self.http.post(url, headers=headers, json=payload, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            job['_exception'] = e
+            job['error'] = str(e)
+            self._finish(job, 'failed')
+            return
+
+        code = self._error_code(response) if not response.ok else None
+        throttled = code in self.LANE_THROTTLE_CODES or code in self.PAIR_THROTTLE_CODES
+        if throttled and job['attempts'] <= self.max_retries:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** (job['attempts'] - 1)))
+            delay += random.uniform(0, delay / 4)
+            job['error'] = f"throttled ({code}), retry in {delay:.1f}s"
+            logger.warning(f"[OUTBOUND] pnid={lane.phone_number_id} job={job['id']} throttled code={code}; backoff {delay:.1f}s")
+            with lane.cond:
+                lane.throttled += 1
+                job['status'] = 'retrying'
+                if code in self.LANE_THROTTLE_CODES:
+                    lane.paused_until = max(lane.paused_until, time.monotonic() + delay)
+            self._share(job)
+            if code in self.LANE_THROTTLE_CODES:
+                self._push(lane, job)
+            else:
+                self._push(lane, job, not_before=time.monotonic() + delay)
+            return
+
+        with lane.cond:
+            lane.sent += 1
+        job['_response'] = response
+        job['http_status'] = response.status_code
+        if response.ok:
+            try:
+                job['message_id'] = ((response.json() or {}).get('messages') or [{}])[0].get('id')
+            except Exception:
+                pass
+            job['error'] = None
+            self._finish(job, 'sent')
+        else:
+            job['error'] = response.text[:1000]
+            self._finish(job, 'failed')
+
+    def _finish(self, job: dict, status: str):
+        job['status'] = status
+        job['finished_at'] = time.time()
+        self._share(job)
+        job['_event'].set()
+        callback = job.get('_on_done')
+        if callback:
+            try:
+                callback(job)
+            except Exception:
+                logger.exception(f"[OUTBOUND] on_done callback failed for job {job['id']}")
+        if not job['_sync']:
+            # Los jobs asíncronos solo conservan el estado resumido
+            job['_response'] = None
+
+
+# Instancia global; se crea al cargar la config ([OUTBOUND] ENABLED)
+outbound_dispatcher = None
+
+
+def _outbound_post(url: str, headers: dict, payload: dict, timeout: float = 15,
+                   priority: int = OutboundDispatcher.PRIORITY_DEFAULT, http=None):
+    """POST a /messages pasando por el dispatcher (si está activo) o directo si no."""
+    if outbound_dispatcher is None:
+        return (http or graph_http).post(url, headers=headers, json=payload, timeout=timeout)
+    pnid = _extract_pnid_from_base_url(url)
+    return outbound_dispatcher.send(pnid, url, headers, payload, priority=priority, timeout=timeout)
+
+
+class TemplateCatalogCache:
+    """
+    Catálogo de plantillas por WABA en memoria.
+    - Descarga la lista completa siguiendo la paginación de Graph.
+    - Guarda los componentes ya parseados (header_format, body_text, nº de placeholders).
+    - Stale-while-revalidate: pasado `ttl` se sirve el catálogo viejo y se refresca en
+      segundo plano; pasado `max_stale` se vuelve a pedir de forma síncrona.
+    - Los webhooks de plantillas (status/quality/category/components) actualizan en sitio
+      y marcan el WABA para refresco.
+    """
+    FIELDS = 'name,status,category,language,components,id,rejected_reason'
+    WEBHOOK_FIELDS = {
+        'message_template_status_update',
+        'message_template_quality_update',
+        'message_template_components_update',
+        'template_category_update',
+    }
+    _PLACEHOLDER_RE = re.compile(r"\{\{\s*(\d+)\s*\}\}")
+
+    def __init__(self, ttl: int = 300, max_stale: int = 86400, page_size: int = 200, timeout: float = 15,
+                 shared_dir: str = None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.page_size = page_size
+        self.timeout = timeout
+        # Directorio compartido entre los workers de serve.py: un solo fetch a Graph por WABA y TTL
+        self.shared_dir = shared_dir
+        self._catalogs = {}          # waba_id -> dict(templates, by_key, fetched_at, stale)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.fetch_errors = 0
+        self.webhook_updates = 0
+        self.shared_loads = 0
+
+    # ---------- Graph ----------
+    def _fetch(self, waba_id: str, access_token: str) -> list:
+        url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{waba_id}/message_templates"
+        headers = {"Authorization": f"Bearer {access_token}"}
+        params = {'fields': self.FIELDS, 'limit': self.page_size}
+        templates = []
+        pages = 0
+        t0 = time.monotonic()
+        while url and pages < 50:
+            resp = graph_http.get(url, headers=headers, params=params, timeout=self.timeout)
+            resp.raise_for_status()
+            body = resp.json() or {}
+            templates.extend(body.get('data') or [])
+            # 'next' ya incluye fields/limit/after
+            url = (body.get('paging') or {}).get('next')
+            params = None
+            pages += 1
+        logger.info(f"[TEMPLATE CATALOG] waba={waba_id}: {len(templates)} plantillas en {pages} página(s), "
+                    f"{(time.monotonic() - t0) * 1000:.0f}ms")
+        return templates
+
+    def _parse(self, t: dict) -> dict:
+        header_format = None
+        body_text = None
+        for c in (t.get('components') or []):
+            ctype = (c.get('type') or '').upper()
+            if ctype == 'HEADER':
+                header_format = (c.get('format') or '').upper()
+            elif ctype == 'BODY':
+                body_text = c.get('text') or ''
+        return {
+            'header_format': header_format,
+            'body_text': body_text,
+            'body_placeholder_count': len(self._PLACEHOLDER_RE.findall(body_text)) if body_text else 0,
+        }
+
+    def _store(self, waba_id: str, templates: list, fetched_at: float = None):
+        by_key = {}
+        for t in templates:
+            t['_parsed'] = self._parse(t)
+            by_key.setdefault((t.get('name') or '', t.get('language') or ''), t)
+        with self._lock:
+            self._catalogs[str(waba_id)] = {
+                'templates': templates,
+                'by_key': by_key,
+                'fetched_at': fetched_at or time.time(),
+                'stale': False,
+            }
+
+    def _fetch_and_store(self, waba_id: str, access_token: str) -> list:
+        self.fetches += 1
+        try:
+            templates = self._fetch(waba_id, access_token)
+        except Exception:
+            self.fetch_errors += 1
+            raise
+        self._store(waba_id, templates)
+        return templates
+
+    def refresh(self, waba_id: str, access_token: str, force: bool = False) -> list:
+        """
+        Descarga el catálogo. Con shared_dir, bajo un flock por WABA: si otro worker lo bajó hace
+        menos de `ttl` se usa su copia (salvo force, p.ej. tras un webhook de plantillas).
+        """
+        if not self.shared_dir:
+            return self._fetch_and_store(waba_id, access_token)
+
+        import fcntl
+        os.makedirs(self.shared_dir, exist_ok=True)
+        path = os.path.join(self.shared_dir, f"{waba_id}.json")
+        with open(path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not force:
+                    try:
+                        with open(path, encoding='utf-8') as f:
+                            shared = json.load(f)
+                        if time.time() - shared['fetched_at'] < self.ttl:
+                            self.shared_loads += 1
+                            self._store(waba_id, shared['templates'], shared['fetched_at'])
+                            return shared['templates']
+                    except (OSError, ValueError, KeyError, TypeError):
+                        pass
+                templates = self._fetch_and_store(waba_id, access_token)
+                try:
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp, 'w', encoding='utf-8') as f:
+                        json.dump({'fetched_at': time.time(), 'templates': templates}, f, ensure_ascii=False, default=str)
+                    os.replace(tmp, path)
+                except OSError as e:
+                    logger.warning(f"[TEMPLATE CATALOG] No se pudo compartir el catálogo de waba={waba_id}: {e}")
+                return templates
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh_async(self, waba_id: str, access_token: str, force: bool = False):
+        key = str(waba_id)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def _run():
+            try:
+                self.refresh(waba_id, access_token, force=force)
+            except Exception as e:
+                logger.warning(f"[TEMPLATE CATALOG] Refresco en segundo plano falló para waba={waba_id}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        Thread(target=_run, name=f'template-catalog-{key}', daemon=True).start()
+
+    # ---------- Lectura ----------
+    def get_catalog(self, waba_id: str, access_token: str) -> tuple:
+        """(templates, info). Lanza excepción solo si no hay nada utilizable en caché."""
+        now = time.time()
+        with self._lock:
+            entry = self._catalogs.get(str(waba_id))
+        if entry is not None:
+            age = now - entry['fetched_at']
+            if not entry['stale'] and age < self.ttl:
+                self.hits += 1
+                return entry['templates'], {'source': 'cache', 'age': round(age, 1)}
+            if age < self.max_stale:
+                self.stale_hits += 1
+                self._refresh_async(waba_id, access_token, force=entry['stale'])
+                return entry['templates'], {'source': 'stale', 'age': round(age, 1)}
+
+        self.misses += 1
+        try:
+            return self.refresh(waba_id, access_token), {'source': 'graph', 'age': 0}
+        except Exception:
+            if entry is not None:
+                logger.warning(f"[TEMPLATE CATALOG] Graph falló para waba={waba_id}; sirviendo catálogo caducado")
+                return entry['templates'], {'source': 'expired', 'age': round(now - entry['fetched_at'], 1)}
+            raise
+
+    def find(self, waba_id: str, access_token: str, name: str, lang: str = None) -> dict | None:
+        """Plantilla por nombre exacto o sin sufijo _vN; si no se indica idioma vale cualquiera."""
+        templates, _ = self.get_catalog(waba_id, access_token)
+        name_normalized = re.sub(r'_v\d+$', '', name or '')
+        with self._lock:
+            entry = self._catalogs.get(str(waba_id))
+            by_key = entry['by_key'] if entry else {}
+        if lang:
+            return by_key.get((name, lang)) or by_key.get((name_normalized, lang))
+        for t in templates:
+            if t.get('name') in (name, name_normalized):
+                return t
+        return None
+
+    def get_definition(self, waba_id: str, access_token: str, name: str, lang: str) -> tuple:
+        """(header_format, body_text_def, body_placeholder_count), como esperaba _build_template_payload."""
+        t = self.find(waba_id, access_token, name, lang)
+        if not t:
+            return None, None, 0
+        parsed = t['_parsed']
+        return parsed['header_format'], parsed['body_text'], parsed['body_placeholder_count']
+
+    # ---------- Invalidación ----------
+    def invalidate(self, waba_id: str = None, shared: bool = True) -> int:
+        """
+        Olvida el catálogo en memoria y, con shared, también la copia de shared_dir: si no, el
+        siguiente refresh (de este u otro worker) la volvería a cargar mientras sea más joven que ttl.
+        """
+        if shared and self.shared_dir:
+            names = [f"{waba_id}.json"] if waba_id else [
+                n for n in (os.listdir(self.shared_dir) if os.path.isdir(self.shared_dir) else []) if n.endswith('.json')
+            ]
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.shared_dir, name))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"[TEMPLATE CATALOG] No se pudo borrar la copia compartida {name}: {e}")
+        with self._lock:
+            if waba_id:
+                return int(self._catalogs.pop(str(waba_id), None) is not None)
+            removed = len(self._catalogs)
+            self._catalogs.clear()
+            return removed
+
+    def on_template_webhook(self, waba_id: str, field: str, value: dict):
+        """
+        Webhook de plantillas de Meta. Si la plantilla está en caché se actualiza el estado en
+        sitio (el listado lo refleja al momento) y el WABA queda marcado para revalidar.
+        """
+        self.webhook_updates += 1
+        with self._lock:
+            entry = self._catalogs.get(str(waba_id))
+            if entry is None:
+                return
+            entry['stale'] = True
+            template_id = str(value.get('message_template_id') or '')
+            if not template_id:
+                return
+            for t in entry['templates']:
+                if str(t.get('id')) != template_id:
+                    continue
+                if field == 'message_template_status_update' and value.get('event'):
+                    t['status'] = value['event']
+                    reason = value.get('reason')
+                    t['rejected_reason'] = None if reason in (None, 'NONE') else reason
+                elif field == 'template_category_update' and value.get('new_category'):
+                    t['category'] = value['new_category']
+                break
+        logger.info(f"[TEMPLATE CATALOG] {field} waba={waba_id} template={value.get('message_template_name')} "
+                    f"event={value.get('event')}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.time()
+            catalogs = {
+                waba: {
+                    'templates': len(e['templates']),
+                    'age': round(now - e['fetched_at'], 1),
+                    'stale': e['stale'],
+                }
+                for waba, e in self._catalogs.items()
+            }
+            refreshing = sorted(self._refreshing)
+        total = self.hits + self.stale_hits + self.misses
+        return {
+            'ttl': self.ttl,
+            'max_stale': self.max_stale,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'fetches': self.fetches,
+            'fetch_errors': self.fetch_errors,
+            'webhook_updates': self.webhook_updates,
+            'shared_loads': self.shared_loads,
+            'shared_dir': self.shared_dir,
+            'hit_ratio': round((self.hits + self.stale_hits) / total, 4) if total else 0.0,
+            'refreshing': refreshing,
+            'catalogs': catalogs,
+        }
+
+
+# --- Catálogo de plantillas por WABA (TTL/max_stale se ajustan al cargar config)
+template_catalog = TemplateCatalogCache()
+
+
 class WhatsAppService:
     """WhatsApp API service con templates y logging de errores"""
     def __init__(self, config=None, http_client=None, logger=None):
         # === Compatibilidad hacia atrás ===
         # Si no pasan http_client/logger, se auto-configuran.
-        self.http   = http_client or requests.Session()
+        self.http   = http_client or graph_http
         self.logger = (
             logger
             or (getattr(current_app, "logger", None) if current_app else None)
@@ -1929,6 +3737,105 @@ class WhatsAppService:
             self.headers         = wc['headers']
             self.api_base_url    = getattr(config, 'api_base_url', "https://test.solvify.es/api")
 
+    def _get_template_definition(self, waba_id: str, access_token: str, name: str, lang: str) -> tuple:
+        """
+        (header_format, body_text_def, body_placeholder_count) de la plantilla en el WABA.
+        Sale del catálogo en memoria (template_catalog): en una campaña todos los destinatarios
+        comparten la misma definición.
+        """
+        header_format, body_text_def, body_placeholder_count = template_catalog.get_definition(
+            waba_id, access_token, name, lang
+        )
+        if not body_text_def:
+            logger.warning(f"[BUILD_TEMPLATE] ⚠️ Template '{name}' ({lang}) NO encontrado en el catálogo del WABA")
+        return header_format, body_text_def, body_placeholder_count
+
+    def _prepare_template_request(
+        self,
+        to_phone: str,
+        template_name: str,
+        template_data: dict,
+        company_id: str | None = None,
+        language: str | None = None,
+        phone_number_id: str | None = None,
+    ) -> tuple[str, dict, dict]:
+        """Resuelve credenciales del tenant y construye el payload. Devuelve (request_url, headers, payload)."""
+        # --- Normalización de teléfono ---
+        clean_phone = PhoneUtils.strip_34(to_phone)
+        if not PhoneUtils.validate_spanish_phone(clean_phone):
+            raise ValueError(f"Número de teléfono inválido: {to_phone}")
+        to_e164 = PhoneUtils.add_34(clean_phone)  # '34XXXXXXXXX' (sin '+')
+
+        # 1) Resolver tenant a usar (prioriza parámetro explícito)
+        resolved_company_id = company_id or (template_data.get("company_id") if isinstance(template_data, dict) else None)
+
+        # 2) Resolver credenciales (tenant-aware)
+        #    Prioridad: phone_number_id explícito > company_id > heurística por teléfono > defaults
+        if phone_number_id:
+            creds = get_whatsapp_credentials_for_phone(clean_phone, company_id=resolved_company_id) or {}
+            creds["phone_number_id"] = phone_number_id
+        else:
+            creds = get_whatsapp_credentials_for_phone(clean_phone, company_id=resolved_company_id) or {}
+
+        headers = creds.get("headers", self.headers)
+        base_url = creds.get("base_url", self.base_url)  # ← En tus logs ya es .../{pnid}/messages
+        pnid     = creds.get("phone_number_id")
+
+        # Idioma (si no pasas, respeta payload)
+        lang_code = (language or "es_ES").lower()
+
+        logger.info("=" * 80)
+        logger.info(f"🔐 Sending template '{template_name}' con tenant:")
+        logger.info(f"📱 Phone: {clean_phone} -> E164: {to_e164}")
+        logger.info(f"🏢 Company ID: {resolved_company_id or 'Default'}")
+        logger.info(f"🏢 Company Name: {creds.get('company_name', 'Default')}")
+        logger.info(f"📞 Phone Number ID: {pnid}")
+        logger.info(f"🔑 Token: {creds.get('access_token', '')[:20]}...")
+        logger.info(f"🌐 Base URL: {base_url}")
+        logger.info(f"🧾 Template data preview: {str(template_data)[:300]}")
+        logger.info("=" * 80)
+
+        # 3) Construir payload (tu helper actual) y forzar 'to' en E.164
+        payload = self._build_template_payload(template_name, template_data, to_e164, company_id=company_id)
+        try:
+            payload["to"] = to_e164
+            # fuerza idioma si se pasó por parámetro
+            if language:
+                payload["template"]["language"]["code"] = lang_code
+        except Exception:
+            pass
+
+        # Enviar a base_url directamente: ya apunta a .../{pnid}/messages
+        return base_url, headers, payload
+
+    def submit_template_message(
+        self,
+        to_phone: str,
+        template_name: str,
+        template_data: dict,
+        company_id: str | None = None,
+        language: str | None = None,
+        priority: int = OutboundDispatcher.PRIORITY_BULK,
+        on_done=None,
+        meta: dict | None = None,
+        timeout: int = 15,
+    ) -> tuple[str, dict]:
+        """
+        Versión asíncrona de send_template_message: encola en el dispatcher y devuelve (job_id, payload).
+        No aplica los reintentos de idioma/HEADER (el resultado se consulta por job_id).
+        """
+        if outbound_dispatcher is None:
+            raise RuntimeError("Outbound dispatcher disabled ([OUTBOUND] ENABLED=false)")
+        request_url, headers, payload = self._prepare_template_request(
+            to_phone, template_name, template_data, company_id=company_id, language=language
+        )
+        job_id = outbound_dispatcher.submit(
+            _extract_pnid_from_base_url(request_url), request_url, headers, payload,
+            priority=priority, timeout=timeout, on_done=on_done,
+            meta=dict(meta or {}, template_name=template_name, to=payload.get("to"))
+        )
+        return job_id, payload
+
     def send_template_message(
         self,
         to_phone: str,
@@ -1938,63 +3845,20 @@ class WhatsAppService:
         company_id: str | None = None,        # <-- NUEVO
         language: str | None = None,          # <-- opcional
         phone_number_id: str | None = None,   # <-- opcional
+        priority: int = OutboundDispatcher.PRIORITY_BULK,
         **kwargs                               # <-- compatibilidad futura
     ):
         try:
-            # --- Normalización de teléfono ---
-            clean_phone = PhoneUtils.strip_34(to_phone)
-            if not PhoneUtils.validate_spanish_phone(clean_phone):
-                raise ValueError(f"Número de teléfono inválido: {to_phone}")
-            to_e164 = PhoneUtils.add_34(clean_phone)  # '34XXXXXXXXX' (sin '+')
-
-            # 1) Resolver tenant a usar (prioriza parámetro explícito)
-            resolved_company_id = company_id or (template_data.get("company_id") if isinstance(template_data, dict) else None)
-
-            # 2) Resolver credenciales (tenant-aware)
-            #    Prioridad: phone_number_id explícito > company_id > heurística por teléfono > defaults
-            if phone_number_id:
-                creds = get_whatsapp_credentials_for_phone(clean_phone, company_id=resolved_company_id) or {}
-                creds["phone_number_id"] = phone_number_id
-            else:
-                creds = get_whatsapp_credentials_for_phone(clean_phone, company_id=resolved_company_id) or {}
-
-            headers = creds.get("headers", self.headers)
-            base_url = creds.get("base_url", self.base_url)  # ← En tus logs ya es .../{pnid}/messages
-            pnid     = creds.get("phone_number_id")
-
-            # Idioma (si no pasas, respeta payload)
-            lang_code = (language or "es_ES").lower()
-
-            logger.info("=" * 80)
-            logger.info(f"🔐 Sending template '{template_name}' con tenant:")
-            logger.info(f"📱 Phone: {clean_phone} -> E164: {to_e164}")
-            logger.info(f"🏢 Company ID: {resolved_company_id or 'Default'}")
-            logger.info(f"🏢 Company Name: {creds.get('company_name', 'Default')}")
-            logger.info(f"📞 Phone Number ID: {pnid}")
-            logger.info(f"🔑 Token: {creds.get('access_token', '')[:20]}...")
-            logger.info(f"🌐 Base URL: {base_url}")
-            logger.info(f"🧾 Template data preview: {str(template_data)[:300]}")
-            logger.info("=" * 80)
-
-            # 3) Construir payload (tu helper actual) y forzar 'to' en E.164
-            payload = self._build_template_payload(template_name, template_data, to_e164, company_id=company_id)
-            try:
-                payload["to"] = to_e164
-                # fuerza idioma si se pasó por parámetro
-                if language:
-                    payload["template"]["language"]["code"] = lang_code
-            except Exception:
-                pass
-
-            # 4) Enviar (usa base_url directamente: ya apunta a .../{pnid}/messages)
-            #    Si prefieres, podrías construir: request_url = f"https://graph.facebook.com/v22.0/{pnid}/messages"
-            request_url = base_url
+            request_url, headers, payload = self._prepare_template_request(
+                to_phone, template_name, template_data,
+                company_id=company_id, language=language, phone_number_id=phone_number_id
+            )
             print(payload)
             print("Headers:", headers)
             print("Payload:", payload)
             print("Base URL:", request_url)
 
-            r = self.http.post(request_url, headers=headers, json=payload, timeout=timeout)
+            r = _outbound_post(request_url, headers, payload, timeout=timeout, priority=priority, http=self.http)
 
             if r.status_code // 100 == 2:
                 body = r.json()
@@ -2029,7 +3893,7 @@ class WhatsAppService:
                     if lang == "es_ES":
                         payload["template"]["language"]["code"] = "es"
                         self.logger.info("🔁 Reintentando con language=es (fallback de es_ES)")
-                        r2 = self.http.post(request_url, headers=headers, json=payload, timeout=timeout)
+                        r2 = _outbound_post(request_url, headers, payload, timeout=timeout, priority=priority, http=self.http)
                         if r2.status_code // 100 == 2:
                             body2 = r2.json()
                             msg_id2 = None
@@ -2059,7 +3923,7 @@ class WhatsAppService:
                         payload2 = dict(payload)
                         payload2["template"] = dict(payload["template"])
                         payload2["template"]["components"] = comps_sin_header
-                        r3 = self.http.post(request_url, headers=headers, json=payload2, timeout=timeout)
+                        r3 = _outbound_post(request_url, headers, payload2, timeout=timeout, priority=priority, http=self.http)
                         if r3.status_code // 100 == 2:
                             body3 = r3.json()
                             msg_id3 = None
@@ -2205,7 +4069,8 @@ class WhatsAppService:
             )
 
 
-    def send_text_message(self, to_phone: str, message: str, company_id: str | None = None, timeout: int = 10):
+    def send_text_message(self, to_phone: str, message: str, company_id: str | None = None, timeout: int = 10,
+                          priority: int = OutboundDispatcher.PRIORITY_DEFAULT):
         try:
             clean_phone = PhoneUtils.strip_34(to_phone)
             if not PhoneUtils.validate_spanish_phone(clean_phone):
@@ -2265,7 +4130,7 @@ class WhatsAppService:
             }
 
             logger.debug(f"Enviando texto a {clean_phone} → payload: {payload}")
-            resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
+            resp = _outbound_post(base_url, headers, payload, timeout=timeout, priority=priority)
             if not resp.ok:
                 logger.error(f"❌ Error {resp.status_code} enviando texto: {resp.text}")
             resp.raise_for_status()
@@ -2344,7 +4209,7 @@ class WhatsAppService:
 
             # 3) Envío
             logger.debug(f"[document] POST {base_url} json={payload}")
-            resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
+            resp = _outbound_post(base_url, headers, payload, timeout=timeout)
             if not resp.ok:
                 logger.error(f"❌ Error {resp.status_code} enviando document: {resp.text}")
             resp.raise_for_status()
@@ -2383,588 +4248,58 @@ class WhatsAppService:
             return None
 
     def _build_template_payload(self, template_name: str, template_data: dict, to_phone: str, company_id: str) -> dict:
-        import re
-        try:
-            import requests
-        except Exception:
-            requests = None
-
-        def normalize_es(phone: str) -> str:
-            p = PhoneUtils.strip_34(str(phone))
-            return p if p.startswith("34") else f"34{p}"
-
-        def normalize_template_name(name: str) -> str:
-            """Elimina sufijos de versión como _v2, _v3, _v4, etc. del nombre del template"""
-            return re.sub(r'_v\d+$', '', name)
-        
+        """
+        Construye el payload de una plantilla con el registro compilado (template_registry):
+        definición WABA (cacheada) → HEADER IMAGE si aplica → BODY/BUTTON de la plantilla compilada.
+        """
         td = template_data or {}
         name = (template_name or "").strip()
-        name_normalized = normalize_template_name(name)  # Nombre sin sufijo de versión para comparaciones
         lang = td.get("language") or "es_ES"
-        to_e164 = normalize_es(to_phone)
-        cover_url = self._resolve_cover_url(company_id=company_id or td.get("company_id"))
+        p = PhoneUtils.strip_34(str(to_phone))
+        to_e164 = p if p.startswith("34") else f"34{p}"
 
-        logger.info(template_data)
-
-        logger.info(f"[BUILD_TEMPLATE] ===== INICIO BUILD TEMPLATE =====")
-        logger.info(f"[BUILD_TEMPLATE] template_name input: '{template_name}' | name_normalized (stripped): '{name_normalized}'")
-        logger.info(f"[BUILD_TEMPLATE] company_id: {company_id}")
-        logger.info(f"[BUILD_TEMPLATE] company name: {td.get('company_name')}")             
-        logger.info(f"[BUILD_TEMPLATE] to_phone: {to_phone} → to_e164: {to_e164}")
-
-        is_etd_company = bool(company_id) and str(company_id) in ETD_COMPANY_IDS
-        logger.info(f"[BUILD_TEMPLATE] is_etd_company: {is_etd_company} | name.startswith('etd_'): {name.startswith('etd_')}")
-
-        # >>>>>>> NUEVO: usar SIEMPRE el WABA/TOKEN DEL TENANT ACTIVO (pasados en template_data) <<<<<<<
-        # El caller ya sabe con qué WABA envía (lo logeas justo antes de llamar). Pásalos en template_data.
-
-        creds = get_whatsapp_credentials_for_company(company_id)
-        print("TENANT CREDS:----------------------------------------------------------------------------------------------------->", creds)
-
-        access_token = creds.get("access_token")
-        pnid  = creds.get("phone_number_id")
-        waba_id  = creds.get("business_id")        
-        if not waba_id or not access_token:
-            logger.warning("[BUILD_TEMPLATE] ⚠️ waba_id/access_token no definidos en template_data; usando DEFAULT (puede fallar)")
-        else:
-                    logger.info(f"[BUILD_TEMPLATE] Usando waba_id={waba_id} para leer definición")
+        compiled = template_registry.resolve(name, company_id)
+        logger.info(
+            f"[BUILD_TEMPLATE] template='{name}' company_id={company_id} to={to_e164} "
+            f"compiled={compiled.name if compiled else None}"
+        )
 
-        # ---------- Leer definición real de la plantilla en el WABA correcto ----------
+        # ---------- Leer definición real de la plantilla en el WABA del tenant ----------
         header_format = None         # "IMAGE" | "TEXT" | "VIDEO" | "DOCUMENT" | None
-        body_text_def = None
-        body_placeholder_count = 0
-        try:
-            if requests and waba_id and access_token:
-                # Normalizar nombre para buscar (sin _vN)
-                def normalize_template_name_for_search(tname: str) -> str:
-                    return re.sub(r'_v\d+$', '', tname)
-                
-                name_normalized = normalize_template_name_for_search(name)
-                logger.info(f"[BUILD_TEMPLATE] Buscando template: '{name}' o '{name_normalized}'")
-                
-                resp = requests.get(
-                    f"https://graph.facebook.com/v22.0/{waba_id}/message_templates",
-                    headers={"Authorization": f"Bearer {access_token}"},
-                    params={"fields": "name,language,components,status", "limit": 200},
-                    timeout=10
-                )
-                if resp.status_code == 200:
-                    data = resp.json() or {}
-                    for t in (data.get("data") or []):
-                        t_name = t.get("name") or ""
-                        t_lang = t.get("language") or ""
-                        # Buscar por nombre exacto O normalizado, mismo idioma
-                        if (t_name == name or t_name == name_normalized) and t_lang == lang:
-                            logger.info(f"[BUILD_TEMPLATE] ✅ Template encontrado en Meta: '{t_name}' ({t_lang})")
-                            for c in (t.get("components") or []):
-                                ctype = (c.get("type") or "").upper()
-                                if ctype == "HEADER":
-                                    header_format = (c.get("format") or "").upper()
-                                elif ctype == "BODY":
-                                    body_text_def = c.get("text") or ""
-                                    body_placeholder_count = len(re.findall(r"\{\{\s*(\d+)\s*\}\}", body_text_def))
-                            break
-                    
-                    if not body_text_def:
-                        logger.warning(f"[BUILD_TEMPLATE] ⚠️ Template '{name}' NO encontrado en Meta API")
-                    
-                    logger.info(f"[BUILD_TEMPLATE] Definición WABA → header_format={header_format} | body_placeholders={body_placeholder_count}")
-        except Exception as e:
-            logger.warning(f"[BUILD_TEMPLATE] ⚠️ Error leyendo definición WABA: {e}")
-        # ---------- Añadir header IMAGE si la plantilla lo requiere ----------
-        components = []
-        try:
-            if header_format == "IMAGE":
-                cover_url = f"https://app.solvify.es/cover-whats.jpg"
-                components.append({
-                    "type": "header",
-                    "parameters": [
-                        {
-                            "type": "image",
-                            "image": {"link": cover_url}
-                        }
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] 📷 Añadido header IMAGE con link={cover_url}")
-        except Exception as e:
-            logger.warning(f"[BUILD_TEMPLATE] ⚠️ No se pudo añadir header IMAGE: {e}")
-        # ---------- ETD (sin header) ----------
-        if is_etd_company and name.startswith("etd_"):
-            logger.info(f"[BUILD_TEMPLATE] ✅ Entrando en bloque ETD")
-            
-            # Para ETD quitamos el HEADER porque las plantillas no lo tienen definido
-            components = []
-            logger.info(f"[BUILD_TEMPLATE] Limpiado components (quitando HEADER)")
-
-            # Resolver valores
-            cliente = (
-                td.get("customer_name")
-                or td.get("client_name")
-                or td.get("first_name")
-                or ""
-            )
-            comercial = (
-                td.get("sales_name")
-                or td.get("comercial_asignado")
-                or td.get("responsible_first_name")
-                or td.get("responsible_name")
-                or ""
-            )
-            oficina = (
-                td.get("office_name")
-                or td.get("office")
-                or td.get("oficina")
-                or td.get("company_name")
-                or ""
-            )
-            raw_link = (
-                td.get("link")
-                or td.get("portal_link")
-                or td.get("payment_link")
-                or td.get("expediente_link")
-                or td.get("url")
-                or ""
-            )
-            fecha = (
-                td.get("date_ddmm")
-                or td.get("fecha_ddmm")
-                or td.get("fecha")
-                or td.get("date")
-                or ""
-            )
-            texto_libre = (
-                td.get("free_text")
-                or td.get("texto_libre")
-                or td.get("notes")
-                or ""
-            )
-
-            logger.info(
-                f"[BUILD_TEMPLATE] Valores resueltos: "
-                f"cliente='{cliente}' | comercial='{comercial}' | oficina='{oficina}' | fecha='{fecha}'"
-            )
-
-            # ⚠️ WhatsApp no quiere strings vacíos
-            def _safe(v: str, default: str = "-") -> str:
-                v = (v or "").strip()
-                return v if v else default
-
-            link_safe = _safe(raw_link, "https://portal.eliminamostudeuda.com")
-
-            ordered_values = [
-                _safe(cliente),                    # 0
-                _safe(comercial, "Nuestro equipo"),# 1
-                _safe(oficina),                    # 2
-                link_safe,                         # 3
-                _safe(fecha),                      # 4
-                _safe(texto_libre),                # 5
-            ]
-            logger.info(f"[BUILD_TEMPLATE] ordered_values (después _safe): {ordered_values}")
-
-            # ===== MAPEO DINÁMICO DE TEMPLATES CON PREFIJOS =====
-            ETD_TEMPLATE_PARAM_COUNT = {
-                "etd_contacto_inicial": 2,
-                "etd_resp_comovamio_docspendientes": 2,
-                "etd_pago_vencido_1sem": 2,
-                "etd_pago_vencido_2sem": 2,
-                "etd_pago_exp_paralizado": 2,
-                # --- 3P ---
-                "etd_doc_completa_pago_procurador": 3,
-                "etd_estado_preparacion_demanda": 3,
-                "etd_estado_demanda_presentada": 3,
-                "etd_estado_declarado_concurso": 3,
-                "etd_estado_epi_solicitado": 3,
-                "etd_estado_epi_concedido": 3,
-                "etd_estado_epi_comunicado": 3,
-                "etd_estado_bajas_ficheros": 3,
-                "etd_rec_citas_tel": 3,
-                "etd_pago_por_vencer": 3,
-                "etd_pago_fecha_acordada": 3,
-                # --- 4P ---
-                "etd_recaptura_post_entrevista": 4,
-                "etd_doc_seguimiento_envio": 4,
-                "etd_rec_cita_presencial": 4,
-                "etd_pago_varias_cuotas": 4,
-            }
-
-            logger.info(f"[BUILD_TEMPLATE] Buscando prefijo para template: '{name}'")
-            logger.info(f"[BUILD_TEMPLATE] name_normalized usado: '{name_normalized}' (si aplica)")
-            body_param_count = 0
-            matched_prefix = None
-            
-            for prefix, count in ETD_TEMPLATE_PARAM_COUNT.items():
-                logger.debug(f"[BUILD_TEMPLATE] Comparando: '{name}'.startswith('{prefix}') ?")
-                if name.startswith(prefix):
-                    body_param_count = count
-                    matched_prefix = prefix
-                    logger.info(
-                        f"[BUILD_TEMPLATE] ✅ COINCIDENCIA ENCONTRADA: "
-                        f"prefix='{prefix}' → body_param_count={count}"
-                    )
-                    break
-            
-            if matched_prefix is None:
-                logger.warning(
-                    f"[BUILD_TEMPLATE] ⚠️ NO COINCIDIÓ CON NINGÚN PREFIJO - body_param_count={body_param_count}"
-                )
-
-            logger.info(f"[BUILD_TEMPLATE] body_param_count final: {body_param_count}")
-
-            if body_param_count > 0:
-                # 🔧 CASO ESPECIAL: etd_rec_cita_presencial
-                if name.startswith("etd_rec_cita_presencial"):
-                    _, dbm = _get_cfg_db()                    
-                    office_str = get_office_for_lead(dbm, td.get("lead_id"))
-                    logger.info(f"👉 Oficina asignada: {office_str}")
-                    oficina = office_str or oficina
-                    fecha_ddmm = get_call_date_ddmm_for_lead(td.get("lead_id"))
-
-                    body_values = [
-                        _safe(cliente),  # {{1}}
-                        _safe(oficina),  # {{2}}
-                        _safe(fecha_ddmm),    # {{3}}
-                        " ",       # {{4}}
-                    ]
-                    logger.info(
-                        "[BUILD_TEMPLATE] (etd_rec_cita_presencial) body_values="
-                        f"{body_values}"
-                    )
-                else:
-                    # Comportamiento genérico anterior
-                    body_values = ordered_values[:body_param_count]
-                    logger.info(
-                        f"[BUILD_TEMPLATE] (genérico) body_values={body_values}"
-                    )
-
-                logger.info(
-                    f"[BUILD_TEMPLATE] Agregando BODY component con "
-                    f"{body_param_count} parámetros: {body_values}"
-                )
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": v} for v in body_values
-                    ]
-                })
+        if compiled is None or not compiled.drop_header:
+            creds = get_whatsapp_credentials_for_company(company_id)
+            access_token = creds.get("access_token")
+            waba_id = creds.get("business_id")
+            if not waba_id or not access_token:
+                logger.warning("[BUILD_TEMPLATE] ⚠️ waba_id/access_token no definidos; no se lee la definición")
             else:
-                logger.warning(
-                    "[BUILD_TEMPLATE] ⚠️ body_param_count es 0 - "
-                    "NO se agregará BODY component"
-                )
+                try:
+                    header_format, _, _ = self._get_template_definition(waba_id, access_token, name, lang)
+                except Exception as e:
+                    logger.warning(f"[BUILD_TEMPLATE] ⚠️ Error leyendo definición WABA: {e}")
 
-            # Todas las ETD salvo 'etd_resp_comovamio_docspendientes' tienen botón URL
-            if name != "etd_resp_comovamio_docspendientes":
-                logger.info("[BUILD_TEMPLATE] Agregando BUTTON (URL) component")
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": td.get("deal_id") or ""}
-                    ]
-                })
-            else:
-                logger.info(
-                    "[BUILD_TEMPLATE] Omitiendo BUTTON "
-                    "(nombre es 'etd_resp_comovamio_docspendientes')"
-                )
+        # ---------- Añadir header IMAGE si la plantilla lo requiere ----------
+        components = []
+        if header_format == "IMAGE":
+            cover_url = DEFAULT_COVER_URL
+            if compiled is not None and compiled.header_image == "tenant_cover":
+                cover_url = self._resolve_cover_url(company_id=company_id or td.get("company_id")) or DEFAULT_COVER_URL
+            components.append({
+                "type": "header",
+                "parameters": [{"type": "image", "image": {"link": cover_url}}]
+            })
 
+        # ---------- BODY / BUTTON desde el registro ----------
+        if compiled is not None:
+            try:
+                components.extend(compiled.bind(td, name))
+            except Exception as e:
+                logger.error(f"[BUILD_TEMPLATE] ❌ Error rellenando plantilla '{name}': {e}", exc_info=True)
+                raise
+            if compiled.language:
+                lang = compiled.language
         else:
-            """
-            CÓDIGO CORREGIDO PARA LA SECCIÓN NO ETD DE _build_template_payload
-
-            Reemplazar desde la línea 2612 (después del bloque ETD) hasta la línea 2716
-            """
-
-            # ======== PLANTILLAS CONOCIDAS (resto de tenants) ========
-            logger.info(f"[BUILD_TEMPLATE] ===== PLANTILLAS CONOCIDAS (resto de tenants) =====")
-
-            # agendar_llamada → SOLO body (botón URL estático en WABA, sin parámetros)
-            if name_normalized == "agendar_llamada":
-                logger.info("[BUILD_TEMPLATE] Detectado template: agendar_llamada")
-                first_name = td.get("first_name") or ""
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name}
-                    ]
-                })
-
-            elif name_normalized == "agendar_llamada_inicial":
-                # Body: {{1}} = first_name
-                # Botón URL dinámico con {{1}} = deal_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: agendar_llamada_inicial")
-                first_name = td.get("first_name") or ""
-                deal_id = td.get("deal_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": deal_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ agendar_llamada_inicial: first_name='{first_name}', deal_id='{deal_id}'")
-
-            elif name_normalized == "recordatorio_llamada_agendada":
-                # Body: {{1}} = first_name, {{2}} = responsible_name, {{3}} = company_name
-                logger.info("[BUILD_TEMPLATE] Detectado template: recordatorio_llamada_agendada")
-                first_name = td.get("first_name") or ""
-                responsible_name = td.get("responsible_name") or td.get("responsible_first_name") or ""
-                company_name = td.get("company_name") or "Solvify"
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": responsible_name},
-                        {"type": "text", "text": company_name}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ recordatorio_llamada_agendada: 3 params")
-
-            elif name_normalized == "retomar_contacto":
-                # Body: {{1}} = first_name, {{2}} = responsible_name, {{3}} = company_name
-                logger.info("[BUILD_TEMPLATE] Detectado template: retomar_contacto")
-                first_name = td.get("first_name") or ""
-                responsible_name = td.get("responsible_name") or td.get("responsible_first_name") or ""
-                company_name = td.get("company_name") or "Solvify"
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": responsible_name},
-                        {"type": "text", "text": company_name}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ retomar_contacto: 3 params (first_name='{first_name}', responsible='{responsible_name}', company='{company_name}')")
-
-            elif name_normalized == "nuevo_numero":
-                # Body: {{1}} = first_name, {{2}} = responsible_name
-                # Button URL: {{1}} = deal_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: nuevo_numero")
-                first_name = td.get("first_name") or ""
-                responsible_name = td.get("responsible_name") or td.get("responsible_first_name") or ""
-                deal_id = td.get("deal_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": responsible_name}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": deal_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ nuevo_numero: first_name='{first_name}', responsible='{responsible_name}', deal_id='{deal_id}'")
-
-            elif name_normalized == "baja_comercial":
-                # Body: {{1}} = first_name, {{2}} = responsible_name, {{3}} = company_name
-                # Button URL: {{1}} = deal_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: baja_comercial")
-                first_name = td.get("first_name") or ""
-                responsible_name = td.get("responsible_name") or td.get("responsible_first_name") or ""
-                company_name = td.get("company_name") or "Solvify"
-                deal_id = td.get("deal_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": responsible_name},
-                        {"type": "text", "text": company_name}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": deal_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ baja_comercial: 3 body params + button")
-
-            elif name_normalized == "followup_missed_calls":
-                # Header: TEXT (sin parámetros, es estático)
-                # Body: {{1}} = first_name
-                # Button URL: {{1}} = deal_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: followup_missed_calls")
-                first_name = td.get("first_name") or ""
-                deal_id = td.get("deal_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": deal_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ followup_missed_calls: first_name='{first_name}', deal_id='{deal_id}'")
-
-            elif name_normalized == "recordatorio_pago_hoy":
-                # Body: {{1}} = first_name, {{2}} = amount
-                # Button URL: {{1}} = order_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: recordatorio_pago_hoy")
-                first_name = td.get("first_name") or ""
-                amount = td.get("amount") or td.get("payment_amount") or ""
-                order_id = td.get("order_id") or td.get("payment_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": str(amount)}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": order_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ recordatorio_pago_hoy: first_name='{first_name}', amount='{amount}', order_id='{order_id}'")
-
-            elif name_normalized == "recordatorio_pago_vencido":
-                # Body: {{1}} = first_name, {{2}} = days_overdue, {{3}} = amount
-                # Button URL: {{1}} = order_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: recordatorio_pago_vencido")
-                first_name = td.get("first_name") or ""
-                days_overdue = td.get("days_overdue") or td.get("days") or ""
-                amount = td.get("amount") or td.get("payment_amount") or ""
-                order_id = td.get("order_id") or td.get("payment_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": str(days_overdue)},
-                        {"type": "text", "text": str(amount)}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": order_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ recordatorio_pago_vencido: 3 body params + button")
-
-            elif name_normalized == "recordatorio_pago_anticipado":
-                # Body: {{1}} = first_name, {{2}} = amount
-                # Button URL: {{1}} = order_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: recordatorio_pago_anticipado")
-                first_name = td.get("first_name") or ""
-                amount = td.get("amount") or td.get("payment_amount") or ""
-                order_id = td.get("order_id") or td.get("payment_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": str(amount)}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": order_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ recordatorio_pago_anticipado: 2 body params + button")
-
-            elif name_normalized == "recordatorio_pago_vencido_sin_cta":
-                # Body: {{1}} = first_name, {{2}} = days_overdue
-                # Button URL: {{1}} = order_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: recordatorio_pago_vencido_sin_cta")
-                first_name = td.get("first_name") or ""
-                days_overdue = td.get("days_overdue") or td.get("days") or ""
-                order_id = td.get("order_id") or td.get("payment_id") or ""
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name},
-                        {"type": "text", "text": str(days_overdue)}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 0,
-                    "parameters": [
-                        {"type": "text", "text": order_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ recordatorio_pago_vencido_sin_cta: 2 body params + button")
-
-            elif name_normalized == "llamada_perdida":
-                # ⚠️ ATENCIÓN: Este template está en es_ES en WBM (no es_ES)
-                # Body: {{1}} = first_name
-                # Button URL (index 1 porque hay QUICK_REPLY antes): {{1}} = deal_id
-                logger.info("[BUILD_TEMPLATE] Detectado template: llamada_perdida")
-                logger.warning("[BUILD_TEMPLATE] ⚠️ llamada_perdida requiere es_ES")
-                first_name = td.get("first_name") or ""
-                deal_id = td.get("deal_id") or ""
-                
-                # Override del language para este template específico
-                lang = "en_US"
-                
-                components.append({
-                    "type": "body",
-                    "parameters": [
-                        {"type": "text", "text": first_name}
-                    ]
-                })
-                components.append({
-                    "type": "button",
-                    "sub_type": "url",
-                    "index": 1,  # Es el segundo botón (el primero es QUICK_REPLY)
-                    "parameters": [
-                        {"type": "text", "text": deal_id}
-                    ]
-                })
-                logger.info(f"[BUILD_TEMPLATE] ✅ llamada_perdida (es_ES): first_name='{first_name}', deal_id='{deal_id}'")
-
-            elif name_normalized == "contacto_recordatorio_pago":
-                # Esta plantilla NO tiene parámetros
-                logger.info("[BUILD_TEMPLATE] Detectado template: contacto_recordatorio_pago (sin parámetros)")
-                components = []
-
-            elif name_normalized == "recordatorio_proximo_pago":
-                # Esta plantilla NO tiene parámetros
-                logger.info("[BUILD_TEMPLATE] Detectado template: recordatorio_proximo_pago (sin parámetros)")
-                components = []
-            
-        logger.info(f"[BUILD_TEMPLATE] Components finales: {components}")
-        logger.info(f"[BUILD_TEMPLATE] ===== FIN BUILD TEMPLATE =====")
+            logger.warning(f"[BUILD_TEMPLATE] ⚠️ Plantilla '{name}' no registrada; solo se envía el HEADER (si aplica)")
 
         payload = {
             "messaging_product": "whatsapp",
@@ -2979,10 +4314,14 @@ class WhatsAppService:
 
 class AutoReplyService:
     """Auto-reply service for office hours management"""
-    def __init__(self, db_manager):
+    def __init__(self, db_manager, store=None, ttl: int = 3600, db_check: str = 'cold'):
         self.db_manager = db_manager
-        self._last_auto_replies = {}
-        self._cache_duration = 3600  # 1 hora
+        # teléfono -> caducidad; compartido entre workers si el store es SQLite
+        self.store = store or MemoryTTLStore()
+        self._cache_duration = ttl  # 1 hora
+        # 'always' | 'cold' (solo mientras el store no cubre aún un TTL completo) | 'never'
+        self.db_check = (db_check or 'cold').strip().lower()
+        self._stats = {'db_checks': 0, 'sent': 0, 'skipped': 0, 'released': 0}
 
     def is_office_hours(self, madrid_datetime=None):
         if madrid_datetime is None:
@@ -3030,57 +4369,103 @@ class AutoReplyService:
                 "Te responderemos lo antes posible durante nuestro horario de oficina."
             )
 
+    def note_outbound(self, phone_number):
+        """Un saliente 'sent' (p.ej. un agente) silencia el auto-reply durante el TTL, como la consulta a BD."""
+        try:
+            self.store.set(PhoneUtils.strip_34(phone_number), self._cache_duration)
+        except Exception:
+            logger.exception('Error marking outbound in auto-reply store')
+
+    def _needs_db_check(self) -> bool:
+        if self.db_check == 'always':
+            return True
+        if self.db_check == 'never':
+            return False
+        # Store recién creado: los envíos anteriores a él solo constan en BD
+        return self.store.age() < self._cache_duration
+
+    def _recent_reply_in_db(self, clean_phone) -> bool:
+        self._stats['db_checks'] += 1
+        madrid_time_threshold = now_madrid_naive() - timedelta(seconds=self._cache_duration)
+        query = """
+            SELECT COUNT(*) FROM external_messages
+            WHERE sender_phone = %s
+            AND from_me = 'true'
+            AND status IN ('sent', 'auto_reply')
+            AND created_at > %s
+        """
+        result = self.db_manager.execute_query(query, [clean_phone, madrid_time_threshold], fetch_one=True)
+        return bool(result and result[0] > 0)
+
     def should_send_auto_reply(self, phone_number):
+        """Solo consulta; send_auto_reply reserva con claim_auto_reply."""
         clean_phone = PhoneUtils.strip_34(phone_number)
-        current_time = time.time()
-
-        # Purge cache
-        expired_keys = [k for k, ts in self._last_auto_replies.items() if current_time - ts > self._cache_duration]
-        for k in expired_keys:
-            del self._last_auto_replies[k]
 
         # Already replied recently?
-        if clean_phone in self._last_auto_replies and current_time - self._last_auto_replies[clean_phone] < self._cache_duration:
+        if self.store.get(clean_phone):
             return False
 
-        # Check DB (last hour)
-        try:
-            madrid_time_threshold = now_madrid_naive() - timedelta(hours=1)
-            query = """
-                SELECT COUNT(*) FROM external_messages
-                WHERE sender_phone = %s
-                AND from_me = 'true'
-                AND status IN ('sent', 'auto_reply')
-                AND created_at > %s
-            """
-            result = self.db_manager.execute_query(query, [clean_phone, madrid_time_threshold], fetch_one=True)
-            if result and result[0] > 0:
+        if self._needs_db_check():
+            try:
+                if self._recent_reply_in_db(clean_phone):
+                    return False
+            except Exception:
+                logger.exception('Error checking recent auto-replies in DB')
                 return False
-        except Exception:
-            logger.exception('Error checking recent auto-replies in DB')
-            return False
 
         return True
+
+    def claim_auto_reply(self, phone_number) -> bool:
+        """Reserva el auto-reply del teléfono (atómico entre workers). False si ya hay uno reciente."""
+        clean_phone = PhoneUtils.strip_34(phone_number)
+        if not self.store.claim(clean_phone, self._cache_duration):
+            return False
+        if self._needs_db_check():
+            try:
+                if self._recent_reply_in_db(clean_phone):
+                    # Ya respondido antes de que existiera el store: se queda marcado hasta caducar
+                    return False
+            except Exception:
+                logger.exception('Error checking recent auto-replies in DB')
+                self.release_auto_reply(clean_phone)
+                return False
+        return True
+
+    def release_auto_reply(self, phone_number):
+        self._stats['released'] += 1
+        try:
+            self.store.delete(PhoneUtils.strip_34(phone_number))
+        except Exception:
+            logger.exception('Error releasing auto-reply claim')
+
+    def stats(self) -> dict:
+        return {'ttl': self._cache_duration, 'db_check': self.db_check,
+                'db_check_active': self._needs_db_check(), **self._stats, 'store': self.store.stats()}
+
     # AutoReplyService
     def send_auto_reply(self, phone_number, whatsapp_service, message_service, company_id: str | None = None):
         try:
             madrid_time = now_madrid()
             if self.is_office_hours(madrid_time):
                 return False, "Office hours - no auto-reply needed"
-            if not self.should_send_auto_reply(phone_number):
+            if not self.claim_auto_reply(phone_number):
+                self._stats['skipped'] += 1
                 return False, "Auto-reply already sent recently"
 
             auto_message = self.get_auto_reply_message(madrid_time)
 
             destination = PhoneUtils.add_34(phone_number)
             # ✅ ahora acepta company_id y lo pasa al envío
-            success, message_id = whatsapp_service.send_text_message(destination, auto_message, company_id=company_id)
+            success, message_id = whatsapp_service.send_text_message(
+                destination, auto_message, company_id=company_id,
+                priority=OutboundDispatcher.PRIORITY_REPLY
+            )
 
             if success:
                 clean_phone = PhoneUtils.strip_34(phone_number)
                 current_time_naive = now_madrid_naive()
 
-                assigned_to_id, responsible_email = message_service.lead_service.get_lead_assigned_info(clean_phone)
+                assigned_to_id, responsible_email = message_service.lead_service.get_lead_assigned_info(clean_phone, company_id=company_id)
                 lead = message_service.lead_service.get_lead_data_by_phone(clean_phone, company_id=company_id)
                 deal_id = (lead.get('deal_id') if lead and lead.get('deal_id') else None)
 
@@ -3102,13 +4487,13 @@ class AutoReplyService:
                     chat_url, chat_id, False, assigned_to_id, company_id
                 ]
                 self.db_manager.execute_query(query, params)
-
-                self._last_auto_replies[clean_phone] = time.time()
+                self._stats['sent'] += 1
 
                 log_sent_message(f'+{destination}', auto_message, message_id)
                 logger.info(f"🤖 Auto-reply sent to {clean_phone} (outside office hours) -> sent (wamid={message_id})")
                 return True, f"Auto-reply sent: {message_id}"
             else:
+                self.release_auto_reply(phone_number)
                 return False, "Failed to send auto-reply message"
 
         except Exception:
@@ -3124,17 +4509,81 @@ class LeadService:
 class LeadService:
     """Lead and deal management service"""
 
-    def __init__(self, db_manager):
+    def __init__(self, db_manager, cache_ttl: int = 30, cache_max_entries: int = 10000):
         self.db_manager = db_manager
+        # Caché de proceso (clean_phone, company_id) -> (expires_at, lead) con TTL corto.
+        # Solo guarda resultados positivos: un lead recién creado se ve en la siguiente consulta.
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Memo por petición (incluye resultados None), activo dentro de request_scope()
+        self._local = threading.local()
+
+    @contextmanager
+    def request_scope(self):
+        """
+        Memoiza get_lead_data_by_phone durante un evento/petición en el hilo actual.
+        Anidable: un scope interno reutiliza el memo del exterior.
+        """
+        if getattr(self._local, 'memo', None) is not None:
+            yield
+            return
+        self._local.memo = {}
+        try:
+            yield
+        finally:
+            self._local.memo = None
+
+    def invalidate_phone(self, phone: str):
+        """Elimina de memo y caché todas las entradas del teléfono (cualquier company)."""
+        clean_phone = PhoneUtils.strip_34(phone)
+        with self._cache_lock:
+            for key in [k for k in self._cache if k[0] == clean_phone]:
+                del self._cache[key]
+        memo = getattr(self._local, 'memo', None)
+        if memo:
+            for key in [k for k in memo if k[0] == clean_phone]:
+                del memo[key]
 
     def get_lead_data_by_phone(self, phone: str, company_id: str | None = None):
         """
         Devuelve datos del lead + deal + responsable + compañía a partir del teléfono.
         Si se pasa company_id, filtra por esa compañía (multi-tenant seguro).
         Para las empresas ETD (ETD_COMPANY_IDS), ignora la company concreta y busca en todas las ETD.
+        Resultado memoizado por petición (request_scope) y cacheado cache_ttl segundos.
         """
         clean_phone = PhoneUtils.strip_34(phone)
-
+        key = (clean_phone, str(company_id) if company_id else None)
+
+        memo = getattr(self._local, 'memo', None)
+        if memo is not None and key in memo:
+            lead = memo[key]
+            return dict(lead) if lead else None
+
+        if self.cache_ttl > 0:
+            with self._cache_lock:
+                cached = self._cache.get(key)
+                if cached and cached[0] > time.monotonic():
+                    self._cache.move_to_end(key)
+                    if memo is not None:
+                        memo[key] = cached[1]
+                    return dict(cached[1])
+
+        lead = self._query_lead_data(clean_phone, company_id)
+
+        if memo is not None:
+            memo[key] = lead
+        if lead and self.cache_ttl > 0:
+            with self._cache_lock:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, lead)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_max_entries:
+                    self._cache.popitem(last=False)
+        return dict(lead) if lead else None
+
+    def _query_lead_data(self, clean_phone: str, company_id: str | None):
+        """Join leads/deals/profiles/companies (deal más reciente)."""
         base_sql = """
             SELECT
                 l.id, l.first_name, l.last_name, l.email,
@@ -3170,6 +4619,53 @@ class LeadService:
         if not row:
             return None
 
+        return self._lead_from_row(row, clean_phone)
+
+    def get_leads_data_by_phones(self, phones, company_id: str | None = None) -> dict:
+        """
+        Igual que get_lead_data_by_phone para muchos teléfonos en una sola query (= ANY).
+        Devuelve {clean_phone: lead}; los que no tienen lead no aparecen. Rellena la caché.
+        """
+        clean_phones = sorted({PhoneUtils.strip_34(str(p)) for p in phones if p})
+        if not clean_phones:
+            return {}
+        sql = """
+            SELECT DISTINCT ON (l.phone)
+                l.id, l.first_name, l.last_name, l.email,
+                d.id, d.user_assigned_id,
+                p.email, p.first_name, p.last_name,
+                c.name, c.id, l.phone
+            FROM public.leads l
+            JOIN public.deals d      ON d.lead_id = l.id AND d.is_deleted = false
+            LEFT JOIN public.profiles p ON p.id = d.user_assigned_id
+            LEFT JOIN public.companies c ON d.company_id = c.id
+            WHERE l.phone = ANY(%s) AND l.is_deleted = false
+        """
+        params: list = [clean_phones]
+        if company_id and str(company_id) in ETD_COMPANY_IDS:
+            sql += " AND d.company_id = ANY(%s)"
+            params.append(list(ETD_COMPANY_IDS))
+        elif company_id:
+            sql += " AND d.company_id = %s"
+            params.append(str(company_id))
+        sql += " ORDER BY l.phone, d.created_at DESC NULLS LAST"
+
+        rows = self.db_manager.execute_query(sql, params, fetch_all=True) or []
+        leads = {str(row[11]): self._lead_from_row(row, str(row[11])) for row in rows}
+
+        if leads and self.cache_ttl > 0:
+            expires_at = time.monotonic() + self.cache_ttl
+            company_key = str(company_id) if company_id else None
+            with self._cache_lock:
+                for phone, lead in leads.items():
+                    self._cache[(phone, company_key)] = (expires_at, lead)
+                    self._cache.move_to_end((phone, company_key))
+                while len(self._cache) > self.cache_max_entries:
+                    self._cache.popitem(last=False)
+        return {phone: dict(lead) for phone, lead in leads.items()}
+
+    @staticmethod
+    def _lead_from_row(row, clean_phone: str) -> dict:
         return {
             'lead_id': str(row[0]),
             'first_name': row[1] or '',
@@ -3185,20 +4681,14 @@ class LeadService:
             'phone': clean_phone,
         }
 
-    def get_lead_assigned_info(self, phone: str):
-        """Devuelve (user_assigned_id, email del responsable) o (None, None)."""
-        clean_phone = PhoneUtils.strip_34(phone)
-        query = """
-            SELECT d.user_assigned_id, p.email
-            FROM public.leads AS l
-            JOIN public.deals AS d ON d.lead_id = l.id
-            LEFT JOIN public.profiles AS p ON p.id = d.user_assigned_id
-            WHERE l.phone = %s
-            LIMIT 1
+    def get_lead_assigned_info(self, phone: str, company_id: str | None = None):
         """
-        row = self.db_manager.execute_query(query, [clean_phone], fetch_one=True)
-        if row and row[0]:
-            return str(row[0]), row[1]
+        Devuelve (user_assigned_id, email del responsable) o (None, None).
+        Reutiliza get_lead_data_by_phone (mismo join, memo y caché) en lugar de una query propia.
+        """
+        lead = self.get_lead_data_by_phone(phone, company_id=company_id)
+        if lead and lead.get('user_assigned_id'):
+            return lead['user_assigned_id'], lead.get('responsible_email') or None
         return None, None
 
     def update_deal_assignee(self, phone: str, assigned_to_id: str) -> bool:
@@ -3223,6 +4713,7 @@ class LeadService:
             """
             
             affected_rows = self.db_manager.execute_query(update_query, [assigned_to_id, clean_phone])
+            self.invalidate_phone(clean_phone)
             
             if affected_rows > 0:
                 logger.info(f"Deal assignee updated for phone {clean_phone} -> {assigned_to_id}")
@@ -3254,17 +4745,418 @@ class LeadService:
             logger.exception(f"Error validating assigned_to_id {assigned_to_id}: {e}")
             return False
     
+class RecentKeyIndex:
+    """
+    LRU acotado de claves vistas recientemente (p.ej. (company_id, wamid)).
+    Meta reentrega el mismo wamid varias veces en sus reintentos: con esto los duplicados
+    se descartan en memoria antes de tocar la BD.
+    """
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max_size
+        self._keys: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, key) -> bool:
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class ConversationWindowIndex:
+    """
+    Estado de la ventana de conversación por (company_id, teléfono) en public.conversation_windows:
+    último entrante, último template y último saliente. Lo mantienen los save_* de MessageService
+    (upsert con GREATEST) y lo leen /canSendTemplate, /canSendMessage y /timeToTemplate por PK,
+    sin recorrer el histórico de external_messages.
+    - Cada guardado actualiza también la fila ALL_TENANTS ('*') del teléfono (para /timeToTemplate).
+    - Una fila solo es fiable con seeded=TRUE: la primera consulta de una clave sin sembrar calcula
+      los valores desde external_messages (una vez) y la marca. Así no hace falta backfill masivo.
+    - Tabla compartida: vale igual con varios workers (serve.py).
+    - touch() escribe tras el commit del unit of work del llamador (no retiene el lock de la fila '*'
+      durante la transacción del webhook) y en orden (company_id, phone) para no cruzar locks.
+    - Si la tabla no se puede crear/usar, enabled=False y los endpoints vuelven a las queries de siempre.
+    """
+    ALL_TENANTS = '*'
+    _COLUMNS = {'inbound': 'last_inbound_at', 'template': 'last_template_at', 'outbound': 'last_outbound_at'}
+
+    def __init__(self, db_manager, enabled: bool = True):
+        self.db_manager = db_manager
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {'touches': 0, 'touch_errors': 0, 'lookups': 0, 'seeded': 0, 'fallbacks': 0}
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    @staticmethod
+    def phone_key(phone) -> str | None:
+        digits = ''.join(ch for ch in str(phone or '') if ch.isdigit())
+        return PhoneUtils.strip_34(digits) if digits else None
+
+    def ensure_table(self) -> bool:
+        if not self.enabled:
+            return False
+        try:
+            self.db_manager.execute_query("""
+                CREATE TABLE IF NOT EXISTS public.conversation_windows (
+                    company_id       TEXT NOT NULL,
+                    phone            TEXT NOT NULL,
+                    last_inbound_at  TIMESTAMP,
+                    last_template_at TIMESTAMP,
+                    last_outbound_at TIMESTAMP,
+                    seeded           BOOLEAN NOT NULL DEFAULT FALSE,
+                    updated_at       TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (company_id, phone)
+                )
+            """)
+            logger.info("[WINDOWS] Índice de ventanas de conversación activo (public.conversation_windows)")
+        except Exception as e:
+            logger.error(f"[WINDOWS] No se pudo preparar conversation_windows ({e}); se usan las queries sobre external_messages")
+            self.enabled = False
+        return self.enabled
+
+    # ---------- Escritura (desde MessageService) ----------
+    def touch(self, company_id, phone, kind: str, ts=None):
+        """Registra un mensaje de tipo kind ('inbound' | 'template' | 'outbound') con timestamp Madrid naive."""
+        self.touch_many(company_id, [(phone, ts)], kind)
+
+    def touch_many(self, company_id, items, kind: str):
+        """
+        items: [(phone, ts), ...]. Un único upsert multi-fila (lo usa el guardado por lotes de templates).
+        Dentro de un unit_of_work se aplica después del commit, en su propia transacción.
+        """
+        if not self.enabled:
+            return
+        column = self._COLUMNS[kind]
+        latest = {}
+        for phone, ts in items:
+            key = self.phone_key(phone)
+            if not key:
+                continue
+            ts = ts or now_madrid_naive()
+            for tenant in {str(company_id) if company_id else '', self.ALL_TENANTS}:
+                if (tenant, key) not in latest or ts > latest[(tenant, key)]:
+                    latest[(tenant, key)] = ts
+        if not latest:
+            return
+        # Filas siempre en el mismo orden: dos lotes concurrentes no se bloquean en cruz
+        rows = sorted(latest.items())
+        sql = f"""
+            INSERT INTO public.conversation_windows (company_id, phone, {column})
+            VALUES {", ".join(["(%s, %s, %s)"] * len(rows))}
+            ON CONFLICT (company_id, phone) DO UPDATE SET
+                {column} = GREATEST(conversation_windows.{column}, EXCLUDED.{column}),
+                updated_at = NOW()
+        """
+        params = [p for (tenant, key), ts in rows for p in (tenant, key, ts)]
+
+        def _apply():
+            try:
+                self.db_manager.execute_query(sql, params)
+                self._count('touches', len(rows))
+            except Exception as e:
+                self._count('touch_errors')
+                logger.warning(f"[WINDOWS] No se pudo actualizar la ventana ({kind}, company={company_id}): {e}")
+        self.db_manager.on_commit(_apply)
+
+    # ---------- Lectura (endpoints de elegibilidad) ----------
+    def get(self, company_id, phone) -> dict | None:
+        """
+        {'last_inbound_at', 'last_template_at', 'last_outbound_at'} para (company_id, teléfono);
+        company_id=None → todos los tenants. None si el índice está desactivado o falla (usar fallback).
+        """
+        key = self.phone_key(phone)
+        if not self.enabled or not key:
+            return None
+        tenant = str(company_id) if company_id else self.ALL_TENANTS
+        self._count('lookups')
+        try:
+            row = self.db_manager.execute_query(
+                """
+                SELECT last_inbound_at, last_template_at, last_outbound_at, seeded
+                FROM public.conversation_windows
+                WHERE company_id = %s AND phone = %s
+                """,
+                [tenant, key], fetch_one=True
+            )
+            if row and row[3]:
+                return {'last_inbound_at': row[0], 'last_template_at': row[1], 'last_outbound_at': row[2]}
+            return self._seed(tenant, key, row)
+        except Exception as e:
+            self._count('fallbacks')
+            logger.warning(f"[WINDOWS] Lectura fallida para company={tenant} phone={key}: {e}")
+            return None
+
+    def _seed(self, tenant: str, key: str, current=None) -> dict:
+        """Primera consulta de la clave: calcula desde external_messages y deja la fila sembrada."""
+        sql = """
+            SELECT MAX(last_message_timestamp) FILTER (WHERE from_me = 'false'),
+                   MAX(last_message_timestamp) FILTER (WHERE from_me = 'true' AND status ILIKE '%template%'),
+                   MAX(last_message_timestamp) FILTER (WHERE from_me = 'true')
+            FROM public.external_messages
+            WHERE sender_phone = ANY(%s)
+        """
+        params = [_normalize_phone_candidates(key)]
+        if tenant != self.ALL_TENANTS:
+            sql += " AND company_id IS NOT DISTINCT FROM %s"
+            params.append(tenant or None)
+        scanned = self.db_manager.execute_query(sql, params, fetch_one=True) or (None, None, None)
+        # Lo ya registrado por touch() antes de sembrar puede ser más reciente que el histórico
+        row = [max((v for v in pair if v is not None), default=None)
+               for pair in zip(scanned, current or (None, None, None))]
+        self.db_manager.execute_query(
+            """
+            INSERT INTO public.conversation_windows
+                (company_id, phone, last_inbound_at, last_template_at, last_outbound_at, seeded)
+            VALUES (%s, %s, %s, %s, %s, TRUE)
+            ON CONFLICT (company_id, phone) DO UPDATE SET
+                last_inbound_at  = GREATEST(conversation_windows.last_inbound_at, EXCLUDED.last_inbound_at),
+                last_template_at = GREATEST(conversation_windows.last_template_at, EXCLUDED.last_template_at),
+                last_outbound_at = GREATEST(conversation_windows.last_outbound_at, EXCLUDED.last_outbound_at),
+                seeded = TRUE,
+                updated_at = NOW()
+            """,
+            [tenant, key, row[0], row[1], row[2]]
+        )
+        self._count('seeded')
+        return {'last_inbound_at': row[0], 'last_template_at': row[1], 'last_outbound_at': row[2]}
+
+    def get_many(self, company_id, phones) -> dict:
+        """
+        Versión por lotes de get(): {phone_key: {...}} para todos los teléfonos en 2 queries como máximo
+        (filas sembradas del índice + un único scan agrupado por teléfono para el resto, que se siembra).
+        Con el índice desactivado solo hace el scan agrupado.
+        """
+        keys = sorted({k for k in (self.phone_key(p) for p in phones) if k})
+        if not keys:
+            return {}
+        tenant = str(company_id) if company_id else self.ALL_TENANTS
+        result = {}
+        if self.enabled:
+            self._count('lookups', len(keys))
+            try:
+                rows = self.db_manager.execute_query(
+                    """
+                    SELECT phone, last_inbound_at, last_template_at, last_outbound_at, seeded
+                    FROM public.conversation_windows
+                    WHERE company_id = %s AND phone = ANY(%s)
+                    """,
+                    [tenant, keys], fetch_all=True
+                ) or []
+            except Exception as e:
+                self._count('fallbacks')
+                logger.warning(f"[WINDOWS] Lectura por lotes fallida (company={tenant}): {e}")
+                rows = []
+            current = {}
+            for phone, inbound, template, outbound, seeded in rows:
+                window = {'last_inbound_at': inbound, 'last_template_at': template, 'last_outbound_at': outbound}
+                if seeded:
+                    result[phone] = window
+                else:
+                    current[phone] = window
+        missing = [k for k in keys if k not in result]
+        if missing:
+            scanned = self._scan_many(tenant, missing)
+            for key in missing:
+                window = scanned.get(key, {})
+                before = current.get(key, {}) if self.enabled else {}
+                result[key] = {
+                    col: max((v for v in (window.get(col), before.get(col)) if v is not None), default=None)
+                    for col in ('last_inbound_at', 'last_template_at', 'last_outbound_at')
+                }
+            if self.enabled:
+                self._seed_many(tenant, {k: result[k] for k in missing})
+        return result
+
+    def _scan_many(self, tenant: str, keys: list) -> dict:
+        """Un scan de external_messages agrupado por teléfono (con y sin prefijo 34)."""
+        candidates = [c for k in keys for c in _normalize_phone_candidates(k)]
+        sql = """
+            SELECT sender_phone,
+                   MAX(last_message_timestamp) FILTER (WHERE from_me = 'false'),
+                   MAX(last_message_timestamp) FILTER (WHERE from_me = 'true' AND status ILIKE '%template%'),
+                   MAX(last_message_timestamp) FILTER (WHERE from_me = 'true')
+            FROM public.external_messages
+            WHERE sender_phone = ANY(%s)
+        """
+        params = [candidates]
+        if tenant != self.ALL_TENANTS:
+            sql += " AND company_id IS NOT DISTINCT FROM %s"
+            params.append(tenant or None)
+        sql += " GROUP BY sender_phone"
+        out = {}
+        for phone, inbound, template, outbound in self.db_manager.execute_query(sql, params, fetch_all=True) or []:
+            window = out.setdefault(self.phone_key(phone), {})
+            for col, value in (('last_inbound_at', inbound), ('last_template_at', template), ('last_outbound_at', outbound)):
+                if value is not None and (window.get(col) is None or value > window[col]):
+                    window[col] = value
+        return out
+
+    def _seed_many(self, tenant: str, windows: dict, chunk_size: int = 1000):
+        items = sorted(windows.items())
+        try:
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                self.db_manager.execute_query(
+                    f"""
+                    INSERT INTO public.conversation_windows
+                        (company_id, phone, last_inbound_at, last_template_at, last_outbound_at, seeded)
+                    VALUES {", ".join(["(%s, %s, %s, %s, %s, TRUE)"] * len(chunk))}
+                    ON CONFLICT (company_id, phone) DO UPDATE SET
+                        last_inbound_at  = GREATEST(conversation_windows.last_inbound_at, EXCLUDED.last_inbound_at),
+                        last_template_at = GREATEST(conversation_windows.last_template_at, EXCLUDED.last_template_at),
+                        last_outbound_at = GREATEST(conversation_windows.last_outbound_at, EXCLUDED.last_outbound_at),
+                        seeded = TRUE,
+                        updated_at = NOW()
+                    """,
+                    [p for key, w in chunk for p in (tenant, key, w['last_inbound_at'], w['last_template_at'], w['last_outbound_at'])]
+                )
+            self._count('seeded', len(items))
+        except Exception as e:
+            logger.warning(f"[WINDOWS] No se pudieron sembrar {len(items)} ventanas (company={tenant}): {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'enabled': self.enabled, **self._stats}
+
+
+class FlowExitContextCache:
+    """
+    Contexto de flow-exit en memoria, alimentado al guardar templates:
+    - wamid de templates enviados (¿el context.id de la respuesta es un template?)
+    - último template por (company_id, teléfono) con su hora (respuestas sin context.id)
+    - exits ya disparados/encolados por (context_id, teléfono)
+    Un fallo de caché no es definitivo: MessageService consulta la BD (el template pudo salir por otro worker).
+    """
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max_size
+        self._templates: OrderedDict = OrderedDict()   # wamid -> True
+        self._by_phone: OrderedDict = OrderedDict()    # (company_id, phone) -> (wamid, sent_at)
+        self._exits: OrderedDict = OrderedDict()       # (context_id, phone) -> None
+        self._lock = threading.Lock()
+        self._stats = {'template_hits': 0, 'template_misses': 0, 'context_hits': 0, 'context_misses': 0}
+
+    def _put(self, store: OrderedDict, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_size:
+            store.popitem(last=False)
+
+    def record_template(self, company_id, phone, wamid, sent_at=None):
+        if not wamid:
+            return
+        with self._lock:
+            self._put(self._templates, wamid, True)
+            if phone:
+                key = (str(company_id) if company_id else None, PhoneUtils.strip_34(str(phone)))
+                self._put(self._by_phone, key, (wamid, sent_at or now_madrid_naive()))
+
+    def is_template(self, wamid) -> bool:
+        with self._lock:
+            hit = wamid in self._templates
+            self._stats['template_hits' if hit else 'template_misses'] += 1
+            return hit
+
+    def recent_template(self, company_id, phone, since):
+        """wamid del último template a ese teléfono enviado después de `since`, o None."""
+        key = (str(company_id) if company_id else None, PhoneUtils.strip_34(str(phone)))
+        with self._lock:
+            entry = self._by_phone.get(key)
+            hit = bool(entry and entry[1] > since)
+            self._stats['context_hits' if hit else 'context_misses'] += 1
+            return entry[0] if hit else None
+
+    def has_exit(self, context_id, phone) -> bool:
+        with self._lock:
+            return (context_id, PhoneUtils.strip_34(str(phone))) in self._exits
+
+    def claim_exit(self, context_id, phone) -> bool:
+        """Reserva el exit de (context_id, teléfono); False si ya estaba disparado o encolado."""
+        key = (context_id, PhoneUtils.strip_34(str(phone)))
+        with self._lock:
+            if key in self._exits:
+                return False
+            self._put(self._exits, key, None)
+            return True
+
+    def release_exit(self, context_id, phone):
+        with self._lock:
+            self._exits.pop((context_id, PhoneUtils.strip_34(str(phone))), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'templates': len(self._templates),
+                'phones': len(self._by_phone),
+                'exits': len(self._exits),
+                'max_size': self.max_size,
+                **self._stats,
+            }
+
+
 class MessageService:
     """Message persistence service"""
-    def __init__(self, db_manager, lead_service):
+    def __init__(self, db_manager, lead_service, dedupe_size: int = 50000, window_index=None):
         self.db_manager = db_manager
         self.lead_service = lead_service
+        # (company_id, wamid) de entrantes ya guardados
+        self.incoming_dedupe = RecentKeyIndex(dedupe_size)
+        # Ventana de conversación por (company_id, teléfono); se actualiza en cada guardado
+        self.window_index = window_index
+        # Templates recientes y exits disparados (flow-exit sin ir a BD en cada entrante)
+        self.flow_exit_context = FlowExitContextCache(dedupe_size)
+        # Callback(teléfono) tras guardar un saliente 'sent' (silencia el auto-reply)
+        self.on_outbound = None
+
+    def ensure_schema(self) -> bool:
+        """
+        Índice único en external_messages.last_message_uid: lo exigen los ON CONFLICT (last_message_uid)
+        de entrantes, templates y marcadores de flow-exit. Uno compuesto (company_id, last_message_uid)
+        no vale como conflict target.
+        """
+        try:
+            self.db_manager.execute_query("""
+                CREATE UNIQUE INDEX IF NOT EXISTS ux_external_messages_last_message_uid
+                    ON public.external_messages (last_message_uid)
+            """)
+            return True
+        except Exception as e:
+            logger.error(f"[MESSAGES] Falta el índice único en external_messages.last_message_uid ({e}); "
+                         f"los upserts de mensajes fallarán hasta crearlo")
+            return False
 
     # ---------- Utilidades flow-exit ----------
     def was_template_message(self, context_id: str) -> bool:
         """True si context_id corresponde a un mensaje 'template_sent'."""
         if not context_id:
             return False
+        if self.flow_exit_context.is_template(context_id):
+            return True
         q = """
             SELECT 1
             FROM public.external_messages
@@ -3273,57 +5165,88 @@ class MessageService:
             LIMIT 1
         """
         row = self.db_manager.execute_query(q, [context_id], fetch_one=True)
+        if row:
+            self.flow_exit_context.record_template(None, None, context_id)
         return bool(row)
 
+    @staticmethod
+    def flow_exit_marker_uid(context_id: str, phone: str) -> str:
+        """
+        last_message_uid del marcador (y dedupe_key del evento en el outbox). No puede ser el
+        context_id: ese wamid ya es la fila del template y last_message_uid es único.
+        """
+        return f"flow_exit:{context_id}:{PhoneUtils.strip_34(phone)}"
+
     def has_flow_exit_marker(self, context_id: str, phone: str) -> bool:
         """Evita duplicar el exit para un mismo context_id + teléfono."""
         if not context_id or not phone:
             return False
+        if self.flow_exit_context.has_exit(context_id, phone):
+            return True
         q = """
             SELECT 1
             FROM public.external_messages
             WHERE last_message_uid = %s
-              AND sender_phone = %s
               AND status = 'flow_exit_triggered'
             LIMIT 1
         """
-        row = self.db_manager.execute_query(q, [context_id, PhoneUtils.strip_34(phone)], fetch_one=True)
+        row = self.db_manager.execute_query(q, [self.flow_exit_marker_uid(context_id, phone)], fetch_one=True)
         return bool(row)
 
-    def mark_flow_exit_triggered(self, context_id: str, phone: str, chat_id: str) -> None:
-        """Inserta un marcador para no repetir el flow-exit en el mismo contexto."""
+    def mark_flow_exit_triggered(self, context_id: str, phone: str, chat_id: str | None = None,
+                                 company_id: str | None = None,
+                                 flow_name: str = "welcome_email_flow",
+                                 motivo: str = "Usuario quiere salir del flow") -> bool:
+        """
+        Inserta un marcador para no repetir el flow-exit en el mismo contexto.
+        Devuelve False si otro proceso ya lo había marcado (ON CONFLICT DO NOTHING).
+        """
         clean_phone = PhoneUtils.strip_34(phone)
-        now_ts = now_madrid_naive()
+        exit_message = f"Exit Flow: {flow_name} por: {motivo}"
         insert_sql = """
             INSERT INTO public.external_messages (
                 id, message, sender_phone, responsible_email,
                 last_message_uid, last_message_timestamp,
                 from_me, status, created_at, updated_at, is_deleted,
-                chat_id, chat_url, assigned_to_id
+                chat_id, chat_url, assigned_to_id, company_id
             ) VALUES (
                 %s, %s, %s, %s,
                 %s, %s,
                 %s, %s, NOW(), NOW(), FALSE,
-                %s, %s, %s
+                %s, %s, %s, %s
             )
+            ON CONFLICT (last_message_uid) DO NOTHING
+            RETURNING id
         """
         params = [
             str(uuid4()),
             json.dumps({'text': exit_message}, ensure_ascii=False),
-            sender_phone, '', context_id, madrid_ahora,
+            clean_phone, '', self.flow_exit_marker_uid(context_id, clean_phone), now_madrid_naive(),
             'true', 'flow_exit_triggered',
-            sender_phone, sender_phone, None,
-            company_id_db
+            chat_id or clean_phone, clean_phone, None,
+            company_id
         ]
-        self.db_manager.execute_query(insert_sql, params)
+        inserted = self.db_manager.execute_query(insert_sql, params, fetch_one=True) is not None
+        # En memoria solo si el marcador llega a confirmarse
+        self.db_manager.on_commit(lambda: self.flow_exit_context.claim_exit(context_id, clean_phone))
+        return inserted
 
-    def get_recent_template_context_for_phone(self, phone: str, window_minutes: int = 15) -> str | None:
+    def get_recent_template_context_for_phone(self, phone: str, window_minutes: int = 15,
+                                              company_id: str | None = None) -> str | None:
         """
         Fallback: obtiene el last_message_uid del template más reciente
         enviado a 'phone' dentro de una ventana temporal.
+        Orden: caché en memoria → índice de ventanas (si no hubo template en la ventana, no hay query) → BD.
         """
         clean_phone = PhoneUtils.strip_34(phone)
         threshold = now_madrid_naive() - timedelta(minutes=window_minutes)
+        wamid = self.flow_exit_context.recent_template(company_id, clean_phone, threshold)
+        if wamid:
+            return wamid
+        if self.window_index:
+            window = self.window_index.get(company_id, clean_phone)
+            if window is not None and (window['last_template_at'] is None or window['last_template_at'] <= threshold):
+                return None
         q = """
             SELECT last_message_uid
             FROM public.external_messages
@@ -3332,88 +5255,51 @@ class MessageService:
               AND status = 'template_sent'
               AND created_at > %s
               AND last_message_uid IS NOT NULL
-            ORDER BY created_at DESC
-            LIMIT 1
         """
-        row = self.db_manager.execute_query(q, [clean_phone, threshold], fetch_one=True)
+        params = [clean_phone, threshold]
+        if company_id:
+            q += " AND company_id = %s"
+            params.append(company_id)
+        q += " ORDER BY created_at DESC LIMIT 1"
+        row = self.db_manager.execute_query(q, params, fetch_one=True)
         return row[0] if row else None
 
+    def is_redelivery(self, msg: dict, company_id: str | None = None) -> bool:
+        """True si este wamid ya se guardó y confirmó en este proceso (reentrega de Meta)."""
+        uid = msg.get('id')
+        return bool(uid) and self.incoming_dedupe.contains((str(company_id) if company_id else None, uid))
+
     # ---------- Guardado de mensajes (TENANT-AWARE) ----------
     def save_incoming_message(self, msg: dict, wa_id: str, company_id: str | None = None) -> bool:
-        """Guarda mensaje entrante. Upsert manual por last_message_uid, aislado por company_id."""
+        """
+        Guarda mensaje entrante, aislado por company_id.
+        - Reentregas del mismo wamid se descartan en memoria (incoming_dedupe) antes de tocar la BD.
+        - Upsert único por last_message_uid (INSERT ... ON CONFLICT); nunca pisa la fila de otro tenant.
+        """
         try:
             sender = PhoneUtils.strip_34(msg.get('from', ''))
             uid = msg.get('id')  # wamid.* si llega
+            dedupe_key = (str(company_id) if company_id else None, uid)
+            if uid and self.incoming_dedupe.contains(dedupe_key):
+                logger.debug(f"[DEDUPE] Duplicate delivery dropped: {uid} (company={company_id})")
+                return True
+
             text = (msg.get('text') or {}).get('body')
             body_text_or_json = text if text else json.dumps(msg, ensure_ascii=False)
 
             wa_timestamp = msg.get('timestamp')
             last_message_ts = timestamp_to_madrid_naive(wa_timestamp) if wa_timestamp else now_madrid_naive()
 
-            assigned_to_id, responsible_email = self.lead_service.get_lead_assigned_info(sender)
-            # ✅ AHORA (línea 3201-3208)
-
-
+            assigned_to_id, responsible_email = self.lead_service.get_lead_assigned_info(sender, company_id=company_id)
             lead = self.lead_service.get_lead_data_by_phone(sender, company_id=company_id)
+            logger.debug(f"save_incoming_message lead={lead} company_id={company_id}")
 
-            print(lead)
-            print("company_id en save_incoming_message ------>:", company_id)
-            # IMPORTANTE: Obtener deal_id ANTES de usarlo
             deal_id = lead.get('deal_id') if lead else None
 
-            chat_id = (deal_id if deal_id else sender)  # ✅ Ahora funciona correctamente
-            chat_url = sender
-
             # --- Resolver company_id efectivo ---
             effective_company_id = company_id or (lead.get('company_id') if lead else None)
 
-            # --- DEDUPE por last_message_uid (aislado por tenant si lo conocemos) ---
-            if uid:
-                if effective_company_id:
-                    # Busca SOLO dentro del tenant
-                    check_sql = """
-                        SELECT id, company_id
-                          FROM public.external_messages
-                         WHERE last_message_uid = %s
-                           AND company_id       = %s
-                         LIMIT 1
-                    """
-                    row = self.db_manager.execute_query(check_sql, [uid, effective_company_id], fetch_one=True)
-                else:
-                    # Sin tenant, busca global (compatibilidad)
-                    check_sql = "SELECT id FROM public.external_messages WHERE last_message_uid = %s LIMIT 1"
-                    row = self.db_manager.execute_query(check_sql, [uid], fetch_one=True)
-
-                if row and row[0]:
-                    set_chat = ", chat_id = %s" if deal_id else ""
-                    update_sql = f"""
-                    UPDATE public.external_messages
-                    SET message = %s,
-                        sender_phone = %s,
-                        responsible_email = %s,
-                        last_message_timestamp = %s,
-                        from_me = %s,
-                        status = %s,
-                        chat_url = %s,
-                        assigned_to_id = %s,
-                        updated_at = NOW()
-                    {set_chat}
-                    WHERE id = %s
-                    """
-                    params_upd = [
-                    body_text_or_json, sender, (responsible_email or ""),
-                    last_message_ts, 'false', 'received',
-                    sender, assigned_to_id
-                    ]
-                    if deal_id:
-                       params_upd.append(deal_id)
-                       params_upd.append(row[0])
-                       self.db_manager.execute_query(update_sql, params_upd)
-                       return True
-
-            deal_id = lead.get('deal_id') if lead else None
-
-            insert_sql = """
+            upsert_sql = """
             INSERT INTO public.external_messages (
             id, message, sender_phone, responsible_email,
             last_message_uid, last_message_timestamp,
@@ -3425,8 +5311,21 @@ class MessageService:
             %s, %s, NOW(), NOW(), FALSE,
             %s, %s, %s, %s
             )
+            ON CONFLICT (last_message_uid) DO UPDATE SET
+                message = EXCLUDED.message,
+                sender_phone = EXCLUDED.sender_phone,
+                responsible_email = EXCLUDED.responsible_email,
+                last_message_timestamp = EXCLUDED.last_message_timestamp,
+                from_me = EXCLUDED.from_me,
+                status = EXCLUDED.status,
+                chat_url = EXCLUDED.chat_url,
+                chat_id = COALESCE(EXCLUDED.chat_id, external_messages.chat_id),
+                assigned_to_id = EXCLUDED.assigned_to_id,
+                updated_at = NOW()
+            WHERE EXCLUDED.company_id IS NULL
+               OR external_messages.company_id IS NOT DISTINCT FROM EXCLUDED.company_id
             """
-            params_ins = [
+            params = [
             str(uuid4()), body_text_or_json, sender, (responsible_email or ""),
             uid, last_message_ts,
             'false', 'received',
@@ -3434,7 +5333,12 @@ class MessageService:
             deal_id,     # chat_id = deal_id (UUID o NULL)
             assigned_to_id, effective_company_id
             ]
-            self.db_manager.execute_query(insert_sql, params_ins)
+            self.db_manager.execute_query(upsert_sql, params)
+            if uid:
+                # Solo tras el commit: si el evento hace rollback, el reintento del ingest no se descarta
+                self.db_manager.on_commit(lambda: self.incoming_dedupe.add(dedupe_key))
+            if self.window_index:
+                self.window_index.touch(effective_company_id, sender, 'inbound', last_message_ts)
             return True
 
         except Exception:
@@ -3470,6 +5374,7 @@ class MessageService:
             sender = PhoneUtils.strip_34(str(phone))
             last_message_ts = now_madrid_naive()
 
+            lead = None
             effective_company_id = company_id
             if not effective_company_id:
                 # Resolver por lead si no viene explicitamente
@@ -3501,6 +5406,10 @@ class MessageService:
             assigned_to_id, effective_company_id
             ]
             self.db_manager.execute_query(insert_sql, params)
+            if self.window_index:
+                self.window_index.touch(effective_company_id, sender, 'outbound', last_message_ts)
+            if self.on_outbound:
+                self.on_outbound(sender)
             return True
         except Exception:
             logging.exception("Failed to save outgoing message")
@@ -3643,150 +5552,109 @@ class MessageService:
             except Exception as e:
                 print(f"\n⚠️ Error printing template: {e}\n")
 
-    def save_template_message(
+    _TEMPLATE_INSERT_COLUMNS = """
+        INSERT INTO public.external_messages (
+            id, message, sender_phone, responsible_email,
+            last_message_uid, last_message_timestamp,
+            from_me, status, created_at, updated_at, is_deleted,
+            chat_id, chat_url, assigned_to_id, company_id
+        ) VALUES
+    """
+    _TEMPLATE_VALUES_ROW = "(%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW(), FALSE, %s, %s, %s, %s)"
+
+    def _template_message_params(
         self,
         payload: dict,
         wamid: str | None,
-        company_id: str | None = None
-    ) -> bool:
+        company_id: str | None = None,
+        preview: bool = True
+    ) -> list:
         """
-        Registra un mensaje saliente de tipo TEMPLATE (from_me=true) con status 'template_sent'.
-        Renderiza la cadena EXACTA del BODY (placeholders reemplazados) e imprime un preview.
-        Guarda en external_messages.message un JSON con {"type":"template","text":..., "raw":...}.
+        Parámetros de la fila external_messages para un TEMPLATE enviado (orden de _TEMPLATE_VALUES_ROW).
+        Renderiza la cadena EXACTA del BODY (placeholders reemplazados) y, si preview, la imprime.
         """
-        try:
-            # 1) Resolver teléfono
-            phone = (
-                payload.get("phone")
-                or payload.get("to")
-                or (payload.get("template_payload") or {}).get("to")
-                or ""
-            )
-            sender = PhoneUtils.strip_34(str(phone)) if phone else None
-
-            # 2) Template name
-            template_name = (
-                payload.get("template_name")
-                or (payload.get("template_data") or {}).get("template_name")
-                or (payload.get("template") or {}).get("name")
-                or ""
-            )
-
-            # 3) Timestamp
-            last_message_ts = now_madrid_naive()
+        # 1) Resolver teléfono
+        phone = (
+            payload.get("phone")
+            or payload.get("to")
+            or (payload.get("template_payload") or {}).get("to")
+            or ""
+        )
+        sender = PhoneUtils.strip_34(str(phone)) if phone else None
+
+        # 2) Template name
+        template_name = (
+            payload.get("template_name")
+            or (payload.get("template_data") or {}).get("template_name")
+            or (payload.get("template") or {}).get("name")
+            or ""
+        )
 
-            # 4) Parámetros del BODY que estás enviando ahora mismo
-            tpl = (payload.get("template") or (payload.get("template_payload") or {}).get("template") or {}) or {}
-            comps = tpl.get("components") or []
-            body_params = []
-            for c in comps:
-                if (c.get("type") or "").lower() == "body":
-                    for p in (c.get("parameters") or []):
-                        if isinstance(p, dict):
-                            if p.get("type") == "text":
-                                body_params.append(p.get("text") or "")
-                            else:
-                                body_params.append(
-                                    p.get("text") or
-                                    (p.get("currency") or {}).get("fallback_value") or
-                                    (p.get("date_time") or {}).get("fallback_value") or
-                                    p.get("payload") or
-                                    ""
-                                )
+        # 3) Timestamp
+        last_message_ts = now_madrid_naive()
+
+        # 4) Parámetros del BODY que estás enviando ahora mismo
+        tpl = (payload.get("template") or (payload.get("template_payload") or {}).get("template") or {}) or {}
+        comps = tpl.get("components") or []
+        body_params = []
+        for c in comps:
+            if (c.get("type") or "").lower() == "body":
+                for p in (c.get("parameters") or []):
+                    if isinstance(p, dict):
+                        if p.get("type") == "text":
+                            body_params.append(p.get("text") or "")
                         else:
-                            body_params.append(str(p))
-
-            # 5) Obtener el BODY.text real del template desde Meta (con cache)
-            rendered_text = None
-            try:
-                import requests, re
-                global _TEMPLATE_BODY_CACHE
-                try:
-                    _TEMPLATE_BODY_CACHE
-                except NameError:
-                    _TEMPLATE_BODY_CACHE = {}
-
-                import re
-                def normalize_template_name_for_search(name: str) -> str:
-                    """Elimina sufijos de versión para buscar en Meta API"""
-                    return re.sub(r'_v\d+$', '', name)
-
-                template_name_normalized = normalize_template_name_for_search(template_name)
-
-                # 🔧 OBTENER CREDENCIALES DEL TENANT CORRECTO
-                if company_id:
-                    creds = get_whatsapp_credentials_for_company(company_id)
-                    waba_id = creds.get('business_id') or creds.get('waba_id') or WABA_ID
-                    access_token = creds.get('access_token') or ACCESS_TOKEN
-                    logger.info(f"[SAVE_TEMPLATE] Usando WABA del tenant: {waba_id[:15]}...")
-                else:
-                    waba_id = WABA_ID
-                    access_token = ACCESS_TOKEN
-                    logger.info(f"[SAVE_TEMPLATE] Usando WABA global: {waba_id[:15]}...")
-
-                # Buscar AMBOS nombres (con y sin versión) en Meta API
-                cache_key = f"{company_id or 'global'}:{template_name}"  # Cache por tenant + template
-                body_text = _TEMPLATE_BODY_CACHE.get(cache_key)
-
-                if not body_text:
-                    url = f"https://graph.facebook.com/v22.0/{waba_id}/message_templates"
-                    headers = {"Authorization": f"Bearer {access_token}"}
-                    params = {
-                        "fields": "name,language,status,components",
-                        "limit": 200
-                    }
-                    logger.info(f"[SAVE_TEMPLATE] Consultando templates de Meta API para '{template_name}' (normalizado: '{template_name_normalized}')")
-                    resp = requests.get(url, headers=headers, params=params, timeout=12)
-                    if resp.status_code == 200:
-                        data = resp.json() or {}
-                        templates_found = []
-                        for t in (data.get("data") or []):
-                            t_name = t.get("name") or ""
-                            templates_found.append(t_name)
-                            # Buscar por nombre exacto O por nombre normalizado
-                            if t_name == template_name or t_name == template_name_normalized:
-                                logger.info(f"[SAVE_TEMPLATE] ✅ Template encontrado en Meta: '{t_name}'")
-                                # Buscar componente BODY con 'text'
-                                for comp in (t.get("components") or []):
-                                    if str(comp.get("type") or "").upper() == "BODY":
-                                        body_text = comp.get("text") or ""
-                                        logger.info(f"[SAVE_TEMPLATE] Body text extraído: {body_text[:100]}...")
-                                        break
-                                if body_text:  # Salir si ya encontramos el body
-                                    break
-                        
-                        if not body_text:
-                            logger.warning(
-                                f"[SAVE_TEMPLATE] ⚠️ Template '{template_name}' (norm: '{template_name_normalized}') "
-                                f"NO encontrado. Templates disponibles: {templates_found[:10]}"
+                            body_params.append(
+                                p.get("text") or
+                                (p.get("currency") or {}).get("fallback_value") or
+                                (p.get("date_time") or {}).get("fallback_value") or
+                                p.get("payload") or
+                                ""
                             )
-                        
-                        # Cachear si lo conseguimos
-                        if body_text:
-                            _TEMPLATE_BODY_CACHE[cache_key] = body_text
                     else:
-                        logger.error(f"[SAVE_TEMPLATE] ❌ Error consultando Meta API: {resp.status_code} - {resp.text[:200]}")
+                        body_params.append(str(p))
 
-                # 6) Sustituir {{n}} por body_params[n-1]
-                if body_text:
-                    def _repl(m):
-                        try:
-                            idx = int(m.group(1)) - 1
-                            return str(body_params[idx]) if 0 <= idx < len(body_params) else ""
-                        except Exception:
-                            return ""
-                    rendered_text = re.sub(r"\{\{\s*(\d+)\s*\}\}", _repl, body_text).strip()
-                    logger.info(f"[SAVE_TEMPLATE] ✅ Texto renderizado: {rendered_text[:100]}...")
+        # 5) Obtener el BODY.text real del template desde Meta (con cache)
+        rendered_text = None
+        try:
+            # 🔧 OBTENER CREDENCIALES DEL TENANT CORRECTO
+            if company_id:
+                creds = get_whatsapp_credentials_for_company(company_id)
+                waba_id = creds.get('business_id') or creds.get('waba_id') or WABA_ID
+                access_token = creds.get('access_token') or ACCESS_TOKEN
+                logger.info(f"[SAVE_TEMPLATE] Usando WABA del tenant: {waba_id[:15]}...")
+            else:
+                waba_id = WABA_ID
+                access_token = ACCESS_TOKEN
+                logger.info(f"[SAVE_TEMPLATE] Usando WABA global: {waba_id[:15]}...")
+
+            # Buscar por nombre exacto o sin sufijo _vN en el catálogo (cacheado por WABA)
+            template_def = template_catalog.find(waba_id, access_token, template_name)
+            body_text = template_def['_parsed']['body_text'] if template_def else None
+            if not body_text:
+                logger.warning(f"[SAVE_TEMPLATE] ⚠️ Template '{template_name}' NO encontrado en el catálogo del WABA")
+
+            # 6) Sustituir {{n}} por body_params[n-1]
+            if body_text:
+                def _repl(m):
+                    try:
+                        idx = int(m.group(1)) - 1
+                        return str(body_params[idx]) if 0 <= idx < len(body_params) else ""
+                    except Exception:
+                        return ""
+                rendered_text = re.sub(r"\{\{\s*(\d+)\s*\}\}", _repl, body_text).strip()
+                logger.info(f"[SAVE_TEMPLATE] ✅ Texto renderizado: {rendered_text[:100]}...")
 
-            except Exception as e:
-                # No paramos el flujo si falla la consulta; haremos fallback.
-                logger.exception(f"[SAVE_TEMPLATE] ❌ Error obteniendo template body: {e}")
-
-            # 7) Fallback si no se pudo renderizar (mostramos algo útil)
-            if not (isinstance(rendered_text, str) and rendered_text.strip()):
-                logger.warning(f"[SAVE_TEMPLATE] ⚠️ Fallback a parámetros: {body_params}")
-                rendered_text = "\n".join([x for x in body_params if x]).strip()
-            # 8) PREVIEW EXACTO (BODY renderizado)
+        except Exception as e:
+            # No paramos el flujo si falla la consulta; haremos fallback.
+            logger.exception(f"[SAVE_TEMPLATE] ❌ Error obteniendo template body: {e}")
+
+        # 7) Fallback si no se pudo renderizar (mostramos algo útil)
+        if not (isinstance(rendered_text, str) and rendered_text.strip()):
+            logger.warning(f"[SAVE_TEMPLATE] ⚠️ Fallback a parámetros: {body_params}")
+            rendered_text = "\n".join([x for x in body_params if x]).strip()
+        # 8) PREVIEW EXACTO (BODY renderizado)
+        if preview:
             print("\n" + "="*80)
             print("📨 MENSAJE DE PLANTILLA (PREVIEW CLIENTE)")
             print("="*80)
@@ -3801,80 +5669,116 @@ class MessageService:
             print("-"*80)
             print("="*80 + "\n")
 
-            # 9) Guardar en BBDD como JSON (texto + raw)
-            message_json = {
-                "type": "template",
-                "template_name": template_name,
-                "to": sender,
-                "wamid": wamid,
-                "text": rendered_text,   # <- BODY renderizado (exacto)
-                "raw": payload
-            }
-            message_text = json.dumps(message_json, ensure_ascii=False)
+        # 9) Guardar en BBDD como JSON (texto + raw)
+        message_json = {
+            "type": "template",
+            "template_name": template_name,
+            "to": sender,
+            "wamid": wamid,
+            "text": rendered_text,   # <- BODY renderizado (exacto)
+            "raw": payload
+        }
+        message_text = json.dumps(message_json, ensure_ascii=False)
 
-            # 10) Resolver asignaciones/lead
-            assigned_to_id = None
-            responsible_email = ""
-            lead = None
-            if sender:
-                try:
-                    assigned_to_id, responsible_email = self.lead_service.get_lead_assigned_info(sender)
-                except Exception:
-                    logging.exception("Failed to get lead assigned info for sender=%s", sender)
-                try:
-                    lead = self.lead_service.get_lead_data_by_phone(sender, company_id=company_id)
-                except Exception:
-                    logging.exception("Failed to get lead data for sender=%s", sender)
+        # 10) Resolver asignaciones/lead
+        assigned_to_id = None
+        responsible_email = ""
+        lead = None
+        if sender:
+            try:
+                assigned_to_id, responsible_email = self.lead_service.get_lead_assigned_info(sender, company_id=company_id)
+            except Exception:
+                logging.exception("Failed to get lead assigned info for sender=%s", sender)
+            try:
+                lead = self.lead_service.get_lead_data_by_phone(sender, company_id=company_id)
+            except Exception:
+                logging.exception("Failed to get lead data for sender=%s", sender)
 
-            chat_id = None
-            chat_url = None
-            if lead:
-                chat_id = lead.get("deal_id") or sender
-                chat_url = sender
-                if not company_id:
-                    company_id = lead.get("company_id")
+        chat_id = None
+        chat_url = None
+        if lead:
+            chat_id = lead.get("deal_id") or sender
+            chat_url = sender
+            if not company_id:
+                company_id = lead.get("company_id")
 
-            if not chat_id:
-                chat_id = sender or str(uuid4())
-            if not chat_url:
-                chat_url = sender or ""
+        if not chat_id:
+            chat_id = sender or str(uuid4())
+        if not chat_url:
+            chat_url = sender or ""
 
-            # 11) INSERT idempotente
-            insert_sql = """
-                INSERT INTO public.external_messages (
-                    id, message, sender_phone, responsible_email,
-                    last_message_uid, last_message_timestamp,
-                    from_me, status, created_at, updated_at, is_deleted,
-                    chat_id, chat_url, assigned_to_id, company_id
-                ) VALUES (
-                    %s, %s, %s, %s,
-                    %s, %s,
-                    %s, %s, NOW(), NOW(), FALSE,
-                    %s, %s, %s, %s
-                )
+        return [
+            str(uuid4()),
+            message_text,
+            (sender or ""),
+            (responsible_email or ""),
+            wamid,
+            last_message_ts,
+            'true',
+            'template_sent',
+            chat_id,
+            chat_url,
+            assigned_to_id,
+            company_id
+        ]
+
+    def save_template_message(
+        self,
+        payload: dict,
+        wamid: str | None,
+        company_id: str | None = None
+    ) -> bool:
+        """
+        Registra un mensaje saliente de tipo TEMPLATE (from_me=true) con status 'template_sent'.
+        Renderiza la cadena EXACTA del BODY (placeholders reemplazados) e imprime un preview.
+        Guarda en external_messages.message un JSON con {"type":"template","text":..., "raw":...}.
+        """
+        try:
+            params = self._template_message_params(payload, wamid, company_id)
+
+            # INSERT idempotente
+            insert_sql = self._TEMPLATE_INSERT_COLUMNS + self._TEMPLATE_VALUES_ROW + """
                 ON CONFLICT (last_message_uid) DO NOTHING
             """
-            params = [
-                str(uuid4()),
-                message_text,
-                (sender or ""),
-                (responsible_email or ""),
-                wamid,
-                last_message_ts,
-                'true',
-                'template_sent',
-                chat_id,
-                chat_url,
-                assigned_to_id,
-                company_id
-            ]
             self.db_manager.execute_query(insert_sql, params)
+            # params: [2]=sender_phone, [4]=wamid, [5]=last_message_timestamp, [11]=company_id
+            self.flow_exit_context.record_template(params[11], params[2], params[4], params[5])
+            if self.window_index:
+                self.window_index.touch(params[11], params[2], 'template', params[5])
             return True
 
         except Exception:
             logging.exception("Failed to save template message")
             return False
 
+    def save_template_messages_batch(self, items: list, company_id: str | None = None, chunk_size: int = 500) -> int:
+        """
+        Versión por lotes de save_template_message para envíos masivos.
+        items: [(payload, wamid), ...]. Un INSERT multi-fila por chunk; devuelve filas preparadas.
+        """
+        rows = []
+        for payload, wamid in items:
+            try:
+                rows.append(self._template_message_params(payload, wamid, company_id, preview=False))
+            except Exception:
+                logging.exception("Failed to prepare template message row (wamid=%s)", wamid)
+
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            insert_sql = self._TEMPLATE_INSERT_COLUMNS + ",\n".join([self._TEMPLATE_VALUES_ROW] * len(chunk)) + """
+                ON CONFLICT (last_message_uid) DO NOTHING
+            """
+            self.db_manager.execute_query(insert_sql, [p for row in chunk for p in row])
+            for row in chunk:
+                self.flow_exit_context.record_template(row[11], row[2], row[4], row[5])
+            if self.window_index:
+                by_company = {}
+                for row in chunk:
+                    by_company.setdefault(row[11], []).append((row[2], row[5]))
+                for row_company_id, items in by_company.items():
+                    self.window_index.touch_many(row_company_id, items, 'template')
+        return len(rows)
+
     def save_media_message(
         self,
         msg: dict,
@@ -3975,7 +5879,7 @@ class MessageService:
                 chat_id = deal_id if deal_id else clean_phone
                 # assigned_to_id y email
                 try:
-                    assigned_to_id, responsible_email = self.lead_service.get_lead_assigned_info(clean_phone)
+                    assigned_to_id, responsible_email = self.lead_service.get_lead_assigned_info(clean_phone, company_id=company_id)
                 except Exception:
                     assigned_to_id, responsible_email = None, ""
             else:
@@ -4045,6 +5949,8 @@ class MessageService:
             ]
 
             dbm.execute_query(sql, params, fetch_one=False, fetch_all=False)
+            if self.window_index:
+                self.window_index.touch(company_id, clean_phone, 'inbound' if direction == "in" else 'outbound')
             logger.info(
                 f"[MEDIA SAVE] Guardado media ({direction}) para {display_phone} | "
                 f"status={status} | msg_uid={msg_uid} | deal/chat_id={chat_id} | company_id={company_id}"
@@ -4126,13 +6032,120 @@ def get_call_date_ddmm_for_lead(lead_id: str) -> str | None:
         logging.warning(f"[get_call_date_ddmm_for_lead] Tarea sin due_date para lead_id={lead_id}")
         return None
 
-    fecha_str = due_date.strftime('%d/%m')
-    logging.info(f"[get_call_date_ddmm_for_lead] Fecha resuelta para lead_id={lead_id}: {fecha_str}")
-    return fecha_str
+    fecha_str = due_date.strftime('%d/%m')
+    logging.info(f"[get_call_date_ddmm_for_lead] Fecha resuelta para lead_id={lead_id}: {fecha_str}")
+    return fecha_str
+
+
+class PhoneRoutingIndex:
+    """
+    Índice phone -> company_id acotado: LRU por tamaño + TTL por entrada, con métricas.
+    Un lead que cambia de tenant deja de enrutarse mal como mucho tras `ttl` segundos
+    (o al momento si se invalida explícitamente).
+    """
+    def __init__(self, max_size: int = 200000, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, phone: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(phone)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= time.time():
+                del self._entries[phone]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(phone)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, phone: str, company_id: str):
+        with self._lock:
+            self._put(phone, company_id, time.time() + self.ttl)
+
+    def _put(self, phone, company_id, expires_at):
+        self._entries[phone] = (str(company_id), expires_at)
+        self._entries.move_to_end(phone)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, phone: str = None, company_id: str = None) -> int:
+        """Invalida un teléfono, todos los de un tenant, o todo si no se pasa nada."""
+        with self._lock:
+            if phone:
+                return int(self._entries.pop(phone, None) is not None)
+            if company_id:
+                doomed = [p for p, (cid, _) in self._entries.items() if cid == str(company_id)]
+                for p in doomed:
+                    del self._entries[p]
+                return len(doomed)
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+
+    def warm_up(self, db_manager, limit: int = None) -> int:
+        """Carga en bloque los teléfonos con deal más reciente (una query)."""
+        limit = limit or self.max_size
+        sql = """
+            SELECT phone, company_id
+              FROM (
+                    SELECT DISTINCT ON (l.phone) l.phone, d.company_id, d.created_at
+                      FROM public.leads l
+                      JOIN public.deals d ON d.lead_id = l.id
+                     WHERE l.phone IS NOT NULL
+                       AND l.is_deleted = false
+                       AND d.is_deleted = false
+                       AND d.company_id IS NOT NULL
+                     ORDER BY l.phone, d.created_at DESC NULLS LAST
+                   ) t
+             ORDER BY created_at DESC NULLS LAST
+             LIMIT %s
+        """
+        t0 = time.monotonic()
+        rows = db_manager.execute_query(sql, [limit], fetch_all=True) or []
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            # Más antiguos primero para que los recientes queden al final del LRU
+            for phone, company_id in reversed(rows):
+                self._put(PhoneUtils.strip_34(str(phone)), company_id, expires_at)
+        logging.info(f"[PHONE ROUTING] Warm-up: {len(rows)} teléfonos en {time.monotonic() - t0:.2f}s")
+        return len(rows)
+
+    def warm_up_async(self, db_manager, limit: int = None):
+        def _run():
+            try:
+                self.warm_up(db_manager, limit)
+            except Exception:
+                logging.exception("[PHONE ROUTING] Warm-up failed")
+        Thread(target=_run, name='phone-routing-warmup', daemon=True).start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
 
 
-# --- Cache opcional para mapear phone -> company_id (simple diccionario en memoria)
-_phone_company_cache: dict[str, str] = {}
+# --- Índice phone -> company_id (LRU + TTL; tamaño/TTL se ajustan al cargar config)
+_phone_company_cache = PhoneRoutingIndex()
 
 def _resolve_company_id_from_phone(phone: str) -> str | None:
     """Intenta resolver company_id a partir del teléfono normalizado."""
@@ -4140,20 +6153,26 @@ def _resolve_company_id_from_phone(phone: str) -> str | None:
         if not phone:
             return None
         phone_norm = PhoneUtils.strip_34(str(phone))
-        if phone_norm in _phone_company_cache:
-            return _phone_company_cache[phone_norm]
+        cached = _phone_company_cache.get(phone_norm)
+        if cached:
+            return cached
 
+        # Mismo criterio que PhoneRoutingIndex.warm_up: deal no borrado más reciente
         sql = """
             SELECT d.company_id
               FROM public.leads l
               JOIN public.deals d ON d.lead_id = l.id
              WHERE l.phone = %s
+               AND l.is_deleted = false
+               AND d.is_deleted = false
+               AND d.company_id IS NOT NULL
+             ORDER BY d.created_at DESC NULLS LAST
              LIMIT 1
         """
         row = db_manager.execute_query(sql, [phone_norm], fetch_one=True)
         company_id = row[0] if row else None
         if company_id:
-            _phone_company_cache[phone_norm] = company_id
+            _phone_company_cache.put(phone_norm, company_id)
         return company_id
     except Exception:
         logging.exception("Failed to resolve company_id from phone")
@@ -4397,7 +6416,7 @@ def send_flow_exit(lead_id: str):
 
     # Request preparado (para ver URL final exacta, headers y body que envía requests)
     try:
-        s = Session()
+        s = graph_http.session
         req = PreparedRequest()
         req.prepare(
             method="POST",
@@ -4632,7 +6651,7 @@ def post_flow_exit(lead_id: str, reason: str = "Usuario quiere salir del flow"):
     for idx, url in enumerate(urls, start=1):
         try:
             logger.info(f"[FLOW EXIT] intento {idx}/{len(urls)} → POST {url} | payload={payload}")
-            r = requests.post(url, headers=headers, json=payload, timeout=8)
+            r = graph_http.post(url, headers=headers, json=payload, timeout=8)
             logger.info(f"[FLOW EXIT] respuesta {r.status_code} | body={r.text[:500]}")
             if 200 <= r.status_code < 300:
                 logger.info("[FLOW EXIT] OK")
@@ -4671,6 +6690,47 @@ def rate_limit(max_calls=10, window=60):
         return wrapper
     return decorator
 
+def admin_only(f):
+    """
+    Endpoints de administración (invalidar cachés, reencolar, estado de envíos): desde localhost,
+    o con cabecera X-API-Key = [ADMIN] API_KEY (por defecto la api_key de FLOW).
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr in ('127.0.0.1', '::1'):
+            return f(*args, **kwargs)
+        expected = config.config.get('ADMIN', 'API_KEY', fallback=None) or config.api_key
+        provided = request.headers.get('X-API-Key') or ''
+        if not expected or not hmac.compare_digest(provided.encode(), str(expected).encode()):
+            logger.warning(f"[ADMIN] Unauthorized {request.method} {request.path} from {request.remote_addr}")
+            return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return wrapper
+
+def all_workers(f):
+    """
+    Endpoints de stats con varios workers de serve.py: la respuesta del que atiende lleva además
+    'worker' (su pid) y 'workers' {pid: respuesta de cada worker} vía worker_state.gather.
+    Con un solo proceso la respuesta no cambia.
+    """
+    def local(args: dict) -> dict:
+        with app.test_request_context(query_string=args):
+            return f()[0].get_json()
+    worker_state.on_gather(f.__name__, local)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        result = f(*args, **kwargs)
+        if not worker_state.enabled:
+            return result
+        response, code = result
+        body = response.get_json()
+        workers = worker_state.gather(f.__name__, request.args.to_dict(), local=dict(body))
+        body['worker'] = os.getpid()
+        body['workers'] = workers
+        return jsonify(body), code
+    return wrapper
+
 def build_flow_exit_client(config, logger):
     """
     Crea y devuelve un FlowExitClient usando la configuración ya cargada en `config`.
@@ -4683,6 +6743,72 @@ def build_flow_exit_client(config, logger):
         logger=logger
     )
 
+def process_flow_exit_reply(sender_phone: str, context_id: str | None, company_id: str | None, lead: dict | None = None) -> bool:
+    """
+    Flow-exit para un texto entrante: si responde (context.id, o template de los últimos
+    FLOW.context_window_minutes) a un template, encola el exit del lead en flow_exit_outbox.
+    Devuelve True si el exit de ese contexto ya estaba disparado (el webhook no manda auto-reply).
+    """
+    if not context_id:
+        context_id = message_service.get_recent_template_context_for_phone(
+            sender_phone,
+            window_minutes=config.flow_config.get('context_window_minutes', 15),
+            company_id=company_id
+        )
+        if not context_id:
+            return False
+
+    if not message_service.was_template_message(context_id):
+        return False
+    if message_service.has_flow_exit_marker(context_id, sender_phone):
+        return True
+
+    if not lead or not lead.get('lead_id'):
+        lead = lead_service.get_lead_data_by_phone(sender_phone, company_id=company_id)
+    if not lead or not lead.get('lead_id'):
+        return False
+    if not message_service.flow_exit_context.claim_exit(context_id, sender_phone):
+        return True
+
+    lead_id = lead['lead_id']
+
+    def _mark(job=None):
+        return message_service.mark_flow_exit_triggered(context_id, sender_phone, company_id=company_id)
+
+    if scheduler_outbox is not None:
+        # Marcador + evento en la misma transacción: o quedan los dos o ninguno (atomic(), también
+        # dentro del unit of work del webhook). Ambos van por execute_query para que dejen savepoint
+        # y un fallo posterior del webhook no se lleve el evento. Si esa transacción se deshace (aquí
+        # o más tarde en el webhook) se suelta el claim en memoria: la reentrega debe volver a encolar.
+        with db_manager.atomic():
+            db_manager.on_rollback(lambda: message_service.flow_exit_context.release_exit(context_id, sender_phone))
+            if not _mark():
+                # Otro worker ya marcó (y encoló) este exit
+                return True
+            db_manager.execute_query(
+                OUTBOX_ENQUEUE_SQL,
+                outbox_enqueue_params(
+                    'flow_exit',
+                    {'id': str(lead_id), 'flow_name': 'welcome_email_flow', 'motivo': 'Usuario quiere salir del flow'},
+                    dedupe_key=message_service.flow_exit_marker_uid(context_id, sender_phone)
+                ),
+                fetch_one=True
+            )
+        db_manager.on_commit(scheduler_outbox.wake)
+        return False
+
+    if flow_exit_outbox is not None:
+        if not flow_exit_outbox.submit(lead_id, on_success=_mark, meta={'context_id': context_id}):
+            message_service.flow_exit_context.release_exit(context_id, sender_phone)
+        return False
+
+    if flow_exit_client.send_exit(lead_id):
+        _mark()
+    else:
+        message_service.flow_exit_context.release_exit(context_id, sender_phone)
+    return False
+
+
 # Initialize configuration and services
 def configure_logging():
     logging.basicConfig(
@@ -4691,75 +6817,128 @@ def configure_logging():
     )
     return logging.getLogger("webhook")
 
+class MessageStatus(IntEnum):
+    """
+    Estados de mensajes salientes codificados como enteros (fila de la matriz de transiciones).
+    El valor en BD es el nombre en minúsculas (MessageStatus.TEMPLATE_SENT -> 'template_sent').
+    """
+    SENT = 0
+    MESSAGE_DELIVERED = 1
+    MESSAGE_READ = 2
+    MESSAGE_FAILED = 3
+    TEMPLATE_SENT = 4
+    TEMPLATE_DELIVERED = 5
+    TEMPLATE_READ = 6
+    TEMPLATE_FAILED = 7
+    MEDIA_SENT = 8
+    MEDIA_DELIVERED = 9
+    MEDIA_READ = 10
+    MEDIA_FAILED = 11
+    AUTORESPONSE_DELIVERED = 12
+
+    @property
+    def db_value(self) -> str:
+        return self.name.lower()
+
+
+class WhatsAppStatusEvent(IntEnum):
+    """Eventos de estado de WhatsApp (columna de la matriz de transiciones)."""
+    SENT = 0
+    DELIVERED = 1
+    READ = 2
+    FAILED = 3
+
+
+# Escaleras por tipo de mensaje: (sent, delivered, read, failed)
+#   - Templates: template_sent → template_delivered → template_read | template_failed
+#   - Texto: sent → message_delivered → message_read | message_failed
+#   - Media: media_sent → media_delivered → media_read | media_failed
+#   - Auto-respuestas: autoresponse_delivered (sin transiciones)
+_STATUS_LADDERS = (
+    (MessageStatus.TEMPLATE_SENT, MessageStatus.TEMPLATE_DELIVERED, MessageStatus.TEMPLATE_READ, MessageStatus.TEMPLATE_FAILED),
+    (MessageStatus.SENT, MessageStatus.MESSAGE_DELIVERED, MessageStatus.MESSAGE_READ, MessageStatus.MESSAGE_FAILED),
+    (MessageStatus.MEDIA_SENT, MessageStatus.MEDIA_DELIVERED, MessageStatus.MEDIA_READ, MessageStatus.MEDIA_FAILED),
+)
+
+
+def _build_status_matrix() -> tuple:
+    """
+    Matriz [estado][evento] -> estado. Los estados de cada escalera tienen rango
+    (sent=0, delivered=1, read=2): un evento solo avanza a un rango mayor, así que un 'read'
+    que llega antes que su 'delivered' sigue aplicando, y un 'delivered' tardío no baja de 'read'.
+    'failed' aplica desde sent/delivered; read y failed son finales.
+    """
+    matrix = [[state for _ in WhatsAppStatusEvent] for state in MessageStatus]
+    for sent, delivered, read, failed in _STATUS_LADDERS:
+        for rank, state in enumerate((sent, delivered)):
+            if rank < 1:
+                matrix[state][WhatsAppStatusEvent.DELIVERED] = delivered
+            matrix[state][WhatsAppStatusEvent.READ] = read
+            matrix[state][WhatsAppStatusEvent.FAILED] = failed
+    return tuple(tuple(row) for row in matrix)
+
+
+STATUS_TRANSITIONS = _build_status_matrix()
+_STATUS_BY_NAME = {state.db_value: state for state in MessageStatus}
+_STATUS_EVENT_BY_NAME = {event.name.lower(): event for event in WhatsAppStatusEvent}
+
+
 def get_next_message_status(current_status: str, whatsapp_status: str) -> str:
     """
     Determina el siguiente estado basado en el estado actual y el evento de WhatsApp.
-    
-    Flujos implementados:
-    - Templates: template_sent → template_delivered → template_read | template_failed
-    - Texto: sent → message_delivered → message_read | message_failed  
-    - Media: media_sent → media_delivered → media_read | media_failed
-    - Auto-respuestas: autoresponse_delivered (sin cambios)
-    
+
     Args:
         current_status: Estado actual del mensaje en BD
-        whatsapp_status: Estado recibido de WhatsApp ('delivered', 'read', 'failed')
-    
+        whatsapp_status: Estado recibido de WhatsApp ('sent', 'delivered', 'read', 'failed')
+
     Returns:
-        Nuevo estado según los flujos definidos
+        Nuevo estado (el actual si el evento no aplica o el estado no es de un saliente)
     """
-    
-    # Mapeo de transiciones válidas según los flujos definidos
-    transitions = {
-        # Plantillas (templates)
-        'template_sent': {
-            'delivered': 'template_delivered',
-            'failed': 'template_failed'
-        },
-        'template_delivered': {
-            'read': 'template_read',
-            'failed': 'template_failed'  # Puede fallar aún después de entregado
-        },
-        
-        # Mensajes de texto
-        'sent': {
-            'delivered': 'message_delivered',
-            'failed': 'message_failed'
-        },
-        'message_delivered': {
-            'read': 'message_read',
-            'failed': 'message_failed'  # Puede fallar aún después de entregado
-        },
-        
-        # Archivos multimedia
-        'media_sent': {
-            'delivered': 'media_delivered',
-            'failed': 'media_failed'
-        },
-        'media_delivered': {
-            'read': 'media_read',
-            'failed': 'media_failed'  # Puede fallar aún después de entregado
-        },
-        
-        # Auto-respuestas (se mantienen sin cambios según requerimiento)
-        'autoresponse_delivered': {
-            # No hay transiciones definidas - se mantiene como está
-        }
-    }
-    
-    # Obtener transiciones válidas para el estado actual
-    valid_transitions = transitions.get(current_status, {})
-    
-    # Retornar nuevo estado o mantener actual si no hay transición válida
-    new_status = valid_transitions.get(whatsapp_status, current_status)
-    
-    # Log de la transición para debugging
-    if new_status != current_status:
-        logger.info(f"🔄 Estado actualizado: {current_status} → {new_status} (evento: {whatsapp_status})")
-    else:
-        logger.debug(f"⏸️ Estado mantenido: {current_status} (evento: {whatsapp_status} no válido o ya final)")
-    
-    return new_status
+    state = _STATUS_BY_NAME.get(current_status)
+    event = _STATUS_EVENT_BY_NAME.get(whatsapp_status)
+    if state is None or event is None:
+        return current_status
+    return STATUS_TRANSITIONS[state][event].db_value
+
+
+def apply_transitions(current_statuses: list, events: list) -> list:
+    """
+    Versión vectorizada de get_next_message_status para el camino batch.
+
+    Args:
+        current_statuses: estados actuales (str) de N mensajes
+        events: para cada mensaje, un evento (str) o una secuencia de eventos en orden de llegada
+
+    Returns:
+        Lista con los N estados resultantes
+    """
+    matrix = STATUS_TRANSITIONS
+    by_name = _STATUS_BY_NAME
+    event_by_name = _STATUS_EVENT_BY_NAME
+    result = []
+    for current, evs in zip(current_statuses, events):
+        state = by_name.get(current)
+        if state is None:
+            result.append(current)
+            continue
+        if isinstance(evs, str):
+            evs = (evs,)
+        for ev in evs:
+            code = event_by_name.get(ev)
+            if code is not None:
+                state = matrix[state][code]
+        result.append(state.db_value)
+    return result
+
+
+def possible_next_statuses(current_status: str) -> list:
+    """Estados alcanzables en un paso desde current_status (para endpoints de diagnóstico)."""
+    state = _STATUS_BY_NAME.get(current_status)
+    if state is None:
+        return []
+    return list(dict.fromkeys(
+        nxt.db_value for nxt in STATUS_TRANSITIONS[state] if nxt != state
+    ))
 
 
 def update_message_status(db_manager, message_id: str, whatsapp_status: str) -> bool:
@@ -4940,44 +7119,110 @@ def get_initial_message_status(message_type: str, is_template: bool = False, is_
 # CÓDIGO PARA REEMPLAZAR EN EL WEBHOOK - SECCIÓN ESTADOS DE MENSAJE
 # =========================================================================
 
+STATUS_BATCH_CHUNK = 500  # filas por UPDATE ... FROM (VALUES ...)
+
+
+def update_message_statuses_batch(db_manager, events: list) -> dict:
+    """
+    Aplica en bloque una ráfaga de recibos de estado.
+
+    1. Un único SELECT ... WHERE last_message_uid = ANY(%s) con los estados actuales.
+    2. Transiciones en memoria (apply_transitions), en el orden en que llegaron los eventos.
+    3. Un UPDATE ... FROM (VALUES ...) por cada STATUS_BATCH_CHUNK mensajes. El UPDATE solo aplica
+       si el estado en BD sigue siendo el que leímos (evita pisar una actualización concurrente).
+
+    Args:
+        db_manager: Instancia del DatabaseManager
+        events: lista de (message_id, whatsapp_status)
+
+    Returns:
+        Dict con contadores: received, found, updated, unchanged, not_found
+    """
+    result = {'received': len(events), 'found': 0, 'updated': 0, 'unchanged': 0, 'not_found': 0}
+    events = [(mid, st) for mid, st in events if mid and is_valid_whatsapp_status(st)]
+    if not events:
+        return result
+
+    message_ids = list(dict.fromkeys(mid for mid, _ in events))
+    rows = db_manager.execute_query(
+        """
+        SELECT last_message_uid, status, from_me
+        FROM public.external_messages
+        WHERE last_message_uid = ANY(%s)
+        """,
+        [message_ids],
+        fetch_all=True
+    ) or []
+
+    current = {}
+    for uid, status, from_me in rows:
+        # Solo actualizamos mensajes salientes (from_me = 'true')
+        if from_me == 'true':
+            current[uid] = status
+    result['found'] = len(current)
+    result['not_found'] = len([mid for mid in message_ids if mid not in current])
+
+    events_by_id = {}
+    for mid, whatsapp_status in events:
+        if mid in current:
+            events_by_id.setdefault(mid, []).append(whatsapp_status)
+    ids = list(events_by_id)
+    new_statuses = dict(zip(ids, apply_transitions([current[mid] for mid in ids], [events_by_id[mid] for mid in ids])))
+
+    changes = [(mid, current[mid], new_statuses[mid]) for mid in ids if new_statuses[mid] != current[mid]]
+    result['unchanged'] = len(current) - len(changes)
+
+    for i in range(0, len(changes), STATUS_BATCH_CHUNK):
+        chunk = changes[i:i + STATUS_BATCH_CHUNK]
+        values_sql = ", ".join(["(%s, %s, %s)"] * len(chunk))
+        params = [p for row in chunk for p in row]
+        update_sql = f"""
+            UPDATE public.external_messages AS m
+            SET status = v.new_status, updated_at = NOW()
+            FROM (VALUES {values_sql}) AS v(uid, prev_status, new_status)
+            WHERE m.last_message_uid = v.uid
+              AND m.status IS NOT DISTINCT FROM v.prev_status
+        """
+        result['updated'] += db_manager.execute_query(update_sql, params) or 0
+
+    for mid, prev, new in changes:
+        if new.endswith('_failed'):
+            logger.warning(f"⚠️ Mensaje fallido: {mid} - {prev} → {new}")
+    return result
+
+
 def handle_message_statuses_webhook(value: dict, db_manager) -> None:
     """
-    Maneja los updates de estado de mensajes en el webhook con los nuevos flujos.
-    Esta función reemplaza la sección "ESTADOS DE MENSAJE" en el webhook.
+    Maneja los updates de estado de mensajes del webhook.
+    Todos los estados del payload se resuelven en bloque (update_message_statuses_batch).
     """
     if 'statuses' not in value:
         return
-        
+
+    events = []
     for status in value.get('statuses', []):
         message_id = status.get('id')
         whatsapp_status = status.get('status')
-        timestamp = status.get('timestamp')
-        
+
         if not message_id or not whatsapp_status:
             logger.warning("⚠️ Status update incompleto - falta message_id o status")
             continue
-            
+
         # Validar que el estado es uno que procesamos
         if not is_valid_whatsapp_status(whatsapp_status):
             logger.debug(f"⏭️ Estado ignorado: {whatsapp_status} para mensaje {message_id}")
             continue
-        
-        logger.info(f"📊 Procesando update de estado: {message_id} → {whatsapp_status}")
-        
-        # Intentar actualizar usando la nueva lógica de flujos
-        success = update_message_status(db_manager, message_id, whatsapp_status)
-        
-        if success:
-            # Log adicional para casos especiales
-            if whatsapp_status == 'failed':
-                logger.error(f"💥 Mensaje fallido detectado: {message_id}")
-            elif whatsapp_status == 'read':
-                logger.info(f"👁️ Mensaje leído confirmado: {message_id}")
-            elif whatsapp_status == 'delivered':
-                logger.info(f"📫 Mensaje entregado confirmado: {message_id}")
-        else:
-            logger.warning(f"⚠️ No se pudo actualizar estado para mensaje {message_id}")
 
+        events.append((message_id, whatsapp_status))
+
+    if not events:
+        return
+
+    try:
+        result = update_message_statuses_batch(db_manager, events)
+        logger.info(f"📊 Status batch: {result}")
+    except Exception:
+        logger.exception(f"💥 Error aplicando batch de {len(events)} estados")
 
 
 import os
@@ -4997,7 +7242,7 @@ from supabase import create_client
 
 # 1. Leer config para obtener datos de Supabase
 temp_config = configparser.ConfigParser()
-temp_config.read('scripts.conf')
+temp_config.read(os.getenv('CLOUDAPI_CONFIG', 'scripts.conf'))
 supabase_cfg = temp_config['SUPABASE'] if temp_config.has_section('SUPABASE') else {}
 SUPABASE_URL = os.getenv('SUPABASE_URL') or supabase_cfg.get('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY') or supabase_cfg.get('SUPABASE_KEY')
@@ -5037,8 +7282,8 @@ if supabase_client:
         temp_config_obj = Config(company_id=None, supabase_client=supabase_client)
         logger.info("[PRELOAD] Temporary Config object created successfully")
         logger.debug(f"[PRELOAD] temp_config_obj.whatsapp_config: {getattr(temp_config_obj, 'whatsapp_config', None)}")
-        db_manager_for_cache = DatabaseManager(temp_config_obj.db_config)
-        logger.info("[PRELOAD] DatabaseManager for cache created")
+        db_manager_for_cache = get_db_manager(temp_config_obj.db_config)
+        logger.info("[PRELOAD] Shared DatabaseManager ready for cache")
         company_cache.preload_all_companies(db_manager_for_cache)
         logger.info("[PRELOAD] Finished preload_all_companies")
     except Exception as e:
@@ -5130,11 +7375,133 @@ logger.info(f"   • BASE_URL: {WHATSAPP_BASE_URL}")
 logger.info(f"   • HTTP Port: {config.server_config['http_port']}")
 logger.info(f"   • HTTPS Port: {config.server_config['https_port']}")
 
-db_manager = DatabaseManager(config.db_config)
-lead_service = LeadService(db_manager)
-message_service = MessageService(db_manager, lead_service)
+_bootstrap_http = graph_http
+graph_http = SharedHttpClient(
+    pool_maxsize=config.config.getint('HTTP', 'POOL_SIZE', fallback=50),
+    timeout=(
+        config.config.getfloat('HTTP', 'CONNECT_TIMEOUT', fallback=5.0),
+        config.config.getfloat('HTTP', 'READ_TIMEOUT', fallback=30.0),
+    ),
+    retries=config.config.getint('HTTP', 'RETRIES', fallback=2),
+    http2_hosts=config.config.get('HTTP', 'HTTP2_HOSTS', fallback='').split(','),
+)
+_bootstrap_http.close()
+
+db_manager = get_db_manager(config.db_config)
+lead_service = LeadService(
+    db_manager,
+    cache_ttl=config.config.getint('APP', 'LEAD_CACHE_TTL', fallback=30)
+)
+conversation_windows = ConversationWindowIndex(
+    db_manager,
+    enabled=config.config.getboolean('APP', 'CONVERSATION_WINDOWS', fallback=True)
+)
+conversation_windows.ensure_table()
+message_service = MessageService(db_manager, lead_service, window_index=conversation_windows)
+message_service.ensure_schema()
+company_cache.credentials_ttl = config.config.getint('APP', 'CREDENTIALS_CACHE_TTL', fallback=300)
+company_cache.negative_ttl = config.config.getint('APP', 'CREDENTIALS_NEGATIVE_TTL', fallback=60)
+company_cache.reload_interval = config.config.getint('APP', 'COMPANY_RELOAD_INTERVAL', fallback=company_cache.reload_interval)
+company_cache.start_background_refresh(db_manager)
+_phone_company_cache.max_size = config.config.getint('APP', 'PHONE_ROUTING_MAX_SIZE', fallback=_phone_company_cache.max_size)
+_phone_company_cache.ttl = config.config.getint('APP', 'PHONE_ROUTING_TTL', fallback=_phone_company_cache.ttl)
+if config.config.getboolean('APP', 'PHONE_ROUTING_WARMUP', fallback=True):
+    _phone_company_cache.warm_up_async(db_manager)
+template_catalog.ttl = config.config.getint('TEMPLATES', 'CATALOG_TTL', fallback=template_catalog.ttl)
+template_catalog.max_stale = config.config.getint('TEMPLATES', 'CATALOG_MAX_STALE', fallback=template_catalog.max_stale)
+# Nº de procesos de serve.py que comparten tokens/cuotas (1 con python CloudAPI2.py)
+SERVE_WORKERS = max(1, int(os.getenv('SERVE_WORKERS') or 1))
+# Estado compartido entre esos procesos: progreso de campañas/jobs, invalidaciones y stats
+worker_state = WorkerState(
+    config.config.get('SERVER', 'SHARED_STATE', fallback='worker_state.db' if SERVE_WORKERS > 1 else None) or None,
+    workers=SERVE_WORKERS,
+    poll_interval=config.config.getfloat('SERVER', 'SHARED_STATE_POLL', fallback=0.2),
+    gather_timeout=config.config.getfloat('SERVER', 'SHARED_STATE_GATHER_TIMEOUT', fallback=2.0),
+).start()
+template_catalog.shared_dir = config.config.get(
+    'TEMPLATES', 'CATALOG_SHARED_DIR', fallback='template_catalog_shared' if SERVE_WORKERS > 1 else None
+) or None
+if config.config.getboolean('OUTBOUND', 'ENABLED', fallback=True):
+    # El límite de Graph es por número, no por proceso: cada worker se queda con su parte
+    outbound_dispatcher = OutboundDispatcher(
+        rate_per_sec=config.config.getfloat('OUTBOUND', 'RATE_PER_SEC', fallback=80.0) / SERVE_WORKERS,
+        burst=max(1.0, config.config.getfloat('OUTBOUND', 'BURST', fallback=80.0) / SERVE_WORKERS),
+        max_retries=config.config.getint('OUTBOUND', 'MAX_RETRIES', fallback=5),
+        max_backoff=config.config.getfloat('OUTBOUND', 'MAX_BACKOFF', fallback=60.0),
+        concurrency=config.config.getint('OUTBOUND', 'CONCURRENCY', fallback=16),
+        reply_slots=config.config.getint('OUTBOUND', 'REPLY_SLOTS', fallback=2),
+    )
+    if worker_state.enabled:
+        outbound_dispatcher.shared_state = worker_state
+
+
+def _send_flow_exit_event(payload: dict) -> bool:
+    """Sender del outbox para kind='flow_exit'."""
+    return flow_exit_client.send_exit(
+        payload['id'],
+        flow_name=payload.get('flow_name', 'welcome_email_flow'),
+        motivo=payload.get('motivo', 'Usuario quiere salir del flow'),
+    )
+
+
+# Outbox durable (public.scheduler_outbox, compartido con task_engine_webhook); si no está
+# disponible, los exits van por la cola en memoria (FlowExitOutbox) o síncronos.
+scheduler_outbox = None
+if config.config.getboolean('OUTBOX', 'ENABLED', fallback=True):
+    try:
+        scheduler_outbox = SchedulerOutbox(
+            db_manager._connect,
+            senders={'flow_exit': _send_flow_exit_event},
+            batch_size=config.config.getint('OUTBOX', 'BATCH_SIZE', fallback=50),
+            concurrency=config.config.getint('OUTBOX', 'CONCURRENCY', fallback=4),
+            max_attempts=config.config.getint('OUTBOX', 'MAX_ATTEMPTS', fallback=8),
+            lease_timeout=config.config.getint('OUTBOX', 'LEASE_TIMEOUT', fallback=120),
+            retention_days=config.config.getint('OUTBOX', 'RETENTION_DAYS', fallback=7),
+        )
+        scheduler_outbox.ensure_table()
+        scheduler_outbox.start()
+    except Exception as e:
+        logger.error(f"[OUTBOX] No disponible ({e}); flow-exit sin outbox durable")
+        scheduler_outbox = None
+flow_exit_outbox = FlowExitOutbox(
+    flow_exit_client,
+    max_attempts=config.flow_config.get('max_attempts', 6),
+) if scheduler_outbox is None and config.flow_config.get('async_exit', True) else None
+
+
+def _bind_etd_rec_cita_presencial(td: dict, values: list) -> list:
+    """etd_rec_cita_presencial: oficina asignada al lead y fecha de la cita desde BD."""
+    _, dbm = _get_cfg_db()
+    office_str = get_office_for_lead(dbm, td.get("lead_id"))
+    fecha_ddmm = get_call_date_ddmm_for_lead(td.get("lead_id"))
+    return [
+        values[0],                           # {{1}} cliente
+        safe_text(office_str or values[2]),  # {{2}} oficina
+        safe_text(fecha_ddmm),               # {{3}} fecha
+        " ",                                 # {{4}}
+    ]
+
+
+template_registry = TemplateRegistry(etd_company_ids=ETD_COMPANY_IDS)
+template_registry.register_binder("etd_rec_cita_presencial", _bind_etd_rec_cita_presencial)
+_template_registry_file = config.config.get('TEMPLATES', 'REGISTRY_FILE', fallback=None)
+if _template_registry_file:
+    try:
+        template_registry.load_json(_template_registry_file)
+    except Exception as e:
+        logger.error(f"[TEMPLATES] No se pudo cargar {_template_registry_file}: {e}; se usan las plantillas por defecto")
 whatsapp_service = WhatsAppService(config)
-auto_reply_service = AutoReplyService(db_manager)
+auto_reply_service = AutoReplyService(
+    db_manager,
+    store=build_ttl_store(
+        config.auto_reply_config['backend'],
+        config.auto_reply_config['store_path'],
+        config.auto_reply_config['max_size'],
+    ),
+    ttl=config.auto_reply_config['ttl'],
+    db_check=config.auto_reply_config['db_check'],
+)
+message_service.on_outbound = auto_reply_service.note_outbound
 
 # --- Inicialización del FileService extendido ---
 try:
@@ -5218,7 +7585,7 @@ def send_file_endpoint():
 
         def _head_ct(url: str) -> str:
             try:
-                r = requests.head(url, timeout=10)
+                r = graph_http.head(url, timeout=10)
                 return (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
             except Exception:
                 return ""
@@ -5888,6 +8255,196 @@ def config_debug():
         'services_initialized': True
     }), 200
 
+@app.route('/db_pool_stats', methods=['GET'])
+@all_workers
+def db_pool_stats():
+    """Métricas del pool de conexiones a BD"""
+    return jsonify({
+        'status': 'ok',
+        'timestamp': now_madrid().isoformat(),
+        'pool': db_manager.pool_stats()
+    }), 200
+
+@app.route('/dedupe_stats', methods=['GET'])
+@all_workers
+def dedupe_stats():
+    """Aciertos/fallos del índice de dedupe de wamids entrantes"""
+    return jsonify({
+        'status': 'ok',
+        'incoming_dedupe': message_service.incoming_dedupe.stats(),
+        'media': file_service.media_index.stats() if file_service else None,
+        'media_fetch': file_service.media_fetcher.stats() if file_service else None
+    }), 200
+
+# Invalidaciones: el endpoint las aplica en su worker y las publica en worker_state; el resto
+# de workers de serve.py las aplican desde su hilo de eventos con la misma función.
+def _invalidate_tenant_credentials(data: dict) -> dict:
+    company_id = data.get('company_id')
+    removed = company_cache.invalidate_credentials(str(company_id) if company_id else None)
+    # Releer también la config del tenant: si no, se reconstruirían desde el snapshot con el token viejo
+    if company_id:
+        reloaded = company_cache.refresh_company(db_manager, str(company_id))
+    else:
+        reloaded = bool(company_cache.preload_all_companies(db_manager).get('loaded'))
+    logger.info(f"[CREDENTIALS] Invalidated {removed} entries (company_id={company_id or 'ALL'}, reloaded={reloaded})")
+    return {'removed': removed, 'reloaded': reloaded}
+
+def _invalidate_phone_routing(data: dict) -> dict:
+    phone = data.get('phone')
+    phone_norm = PhoneUtils.strip_34(str(phone)) if phone else None
+    removed = _phone_company_cache.invalidate(phone=phone_norm, company_id=data.get('company_id'))
+    if phone_norm:
+        lead_service.invalidate_phone(phone_norm)
+    return {'removed': removed}
+
+def _invalidate_template_catalog(data: dict) -> dict:
+    # La copia de shared_dir ya la borra el worker que recibió la petición
+    return {'removed': template_catalog.invalidate(data.get('waba_id'), shared=data.get('shared', True))}
+
+worker_state.subscribe('tenant_credentials.invalidate', _invalidate_tenant_credentials)
+worker_state.subscribe('phone_routing.invalidate', _invalidate_phone_routing)
+worker_state.subscribe('template_catalog.invalidate', lambda data: _invalidate_template_catalog({**data, 'shared': False}))
+
+@app.route('/tenant_credentials/invalidate', methods=['POST'])
+@admin_only
+def invalidate_tenant_credentials():
+    """
+    Invalida las credenciales cacheadas de un tenant (tras rotar token/PNID) en todos los workers.
+    Body: {"company_id": "..."}; sin company_id invalida todos.
+    """
+    data = request.get_json(silent=True) or {}
+    company_id = data.get('company_id')
+    result = _invalidate_tenant_credentials({'company_id': company_id})
+    worker_state.publish('tenant_credentials.invalidate', {'company_id': company_id})
+    return jsonify({
+        'status': 'ok',
+        'company_id': company_id,
+        **result,
+        'credentials': company_cache.credentials_stats()
+    }), 200
+
+@app.route('/phone_routing/invalidate', methods=['POST'])
+@admin_only
+def invalidate_phone_routing():
+    """
+    Invalida el enrutado phone -> tenant (p.ej. cuando un deal cambia de compañía) en todos los workers.
+    Body: {"phone": "..."} o {"company_id": "..."}; vacío invalida todo.
+    """
+    data = request.get_json(silent=True) or {}
+    event = {'phone': data.get('phone'), 'company_id': data.get('company_id')}
+    result = _invalidate_phone_routing(event)
+    worker_state.publish('phone_routing.invalidate', event)
+    return jsonify({
+        'status': 'ok',
+        **result,
+        'phone_routing': _phone_company_cache.stats()
+    }), 200
+
+@app.route('/phone_routing/stats', methods=['GET'])
+@all_workers
+def phone_routing_stats():
+    return jsonify({'status': 'ok', 'phone_routing': _phone_company_cache.stats()}), 200
+
+@app.route('/outbound/jobs/<job_id>', methods=['GET'])
+@admin_only
+def outbound_job_status(job_id):
+    """Estado de un envío encolado (async=true)"""
+    if outbound_dispatcher is None:
+        return jsonify({'status': 'error', 'message': 'Outbound dispatcher disabled'}), 404
+    job = outbound_dispatcher.job_status(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    return jsonify({'status': 'ok', 'job': job}), 200
+
+@app.route('/outbound/stats', methods=['GET'])
+@admin_only
+@all_workers
+def outbound_stats():
+    """Colas por phone_number_id: pendientes, enviados, throttling"""
+    if outbound_dispatcher is None:
+        return jsonify({'status': 'ok', 'enabled': False}), 200
+    return jsonify({'status': 'ok', 'enabled': True, 'outbound': outbound_dispatcher.stats()}), 200
+
+@app.route('/tenant_credentials/stats', methods=['GET'])
+@all_workers
+def tenant_credentials_stats():
+    """Aciertos/fallos del store de credenciales por tenant"""
+    return jsonify({'status': 'ok', 'credentials': company_cache.credentials_stats()}), 200
+
+@app.route('/template_catalog/invalidate', methods=['POST'])
+@admin_only
+def invalidate_template_catalog():
+    """
+    Fuerza la recarga del catálogo de plantillas en todos los workers.
+    Body: {"waba_id": "..."} o {"company_id": "..."}; vacío invalida todos los WABA.
+    """
+    data = request.get_json(silent=True) or {}
+    waba_id = data.get('waba_id')
+    if not waba_id and data.get('company_id'):
+        waba_id = get_whatsapp_credentials_for_company(data['company_id']).get('business_id')
+        if not waba_id:
+            return jsonify({'status': 'error', 'message': 'Company without WABA configured'}), 404
+    result = _invalidate_template_catalog({'waba_id': waba_id})
+    worker_state.publish('template_catalog.invalidate', {'waba_id': waba_id})
+    return jsonify({'status': 'ok', 'waba_id': waba_id, **result}), 200
+
+@app.route('/template_catalog/stats', methods=['GET'])
+@all_workers
+def template_catalog_stats():
+    """Catálogos por WABA en memoria: tamaño, edad, aciertos y refrescos"""
+    return jsonify({'status': 'ok', 'template_catalog': template_catalog.stats()}), 200
+
+@app.route('/http/stats', methods=['GET'])
+@all_workers
+def http_client_stats():
+    """Latencias por endpoint saliente (Graph, Supabase, API interna); ?reset=true las pone a cero"""
+    stats = graph_http.stats()
+    if (request.args.get('reset') or '').lower() in ('1', 'true', 'yes'):
+        graph_http.reset_stats()
+    return jsonify({'status': 'ok', 'http': stats}), 200
+
+@app.route('/flow_exit/stats', methods=['GET'])
+@all_workers
+def flow_exit_stats():
+    """Outbox de flow-exit (pendientes, reintentos, salud por URL) y caché de contextos de template"""
+    return jsonify({
+        'status': 'ok',
+        'durable': scheduler_outbox is not None,
+        'async': scheduler_outbox is not None or flow_exit_outbox is not None,
+        'outbox': flow_exit_outbox.stats() if flow_exit_outbox is not None else {'endpoints': flow_exit_client.health()},
+        'context_cache': message_service.flow_exit_context.stats(),
+    }), 200
+
+@app.route('/scheduler_outbox/stats', methods=['GET'])
+@all_workers
+def scheduler_outbox_stats():
+    """Eventos del outbox por kind/estado (pending, sending, sent, dead) y contadores del worker"""
+    if scheduler_outbox is None:
+        return jsonify({'status': 'ok', 'enabled': False}), 200
+    return jsonify({'status': 'ok', 'enabled': True, 'outbox': scheduler_outbox.stats()}), 200
+
+@app.route('/scheduler_outbox/requeue', methods=['POST'])
+@admin_only
+def scheduler_outbox_requeue():
+    """Reencola eventos en dead-letter. Body opcional: {"kind": "flow_exit", "ids": [1, 2]}"""
+    if scheduler_outbox is None:
+        return jsonify({'status': 'error', 'message': 'Outbox disabled'}), 404
+    data = request.get_json(silent=True) or {}
+    count = scheduler_outbox.requeue_dead(kind=data.get('kind'), ids=data.get('ids'))
+    return jsonify({'status': 'ok', 'requeued': count}), 200
+
+@app.route('/conversation_windows/stats', methods=['GET'])
+@all_workers
+def conversation_windows_stats():
+    """Índice de ventanas de conversación: actualizaciones, lecturas, siembras y fallbacks"""
+    return jsonify({'status': 'ok', 'conversation_windows': conversation_windows.stats()}), 200
+
+@app.route('/auto_reply/stats', methods=['GET'])
+@all_workers
+def auto_reply_stats():
+    """Store TTL del auto-reply: backend, tamaño, claims/conflictos y consultas a BD"""
+    return jsonify({'status': 'ok', 'auto_reply': auto_reply_service.stats()}), 200
+
 @app.route('/send_message', methods=['POST'])
 @rate_limit(max_calls=30, window=60)
 def send_direct_message():
@@ -5951,34 +8508,319 @@ def send_template_endpoint():
         if not PhoneUtils.validate_spanish_phone(customer_phone):
             return jsonify({'status': 'error', 'message': 'Invalid phone number'}), 400
 
-        # ✅ Ahora el lead se resuelve dentro del tenant correcto si llega company_id
-        lead_data = lead_service.get_lead_data_by_phone(customer_phone, company_id=company_id)
-        if not lead_data:
-            return jsonify({'status': 'error', 'message': 'Lead not found'}), 404
+        # ✅ Ahora el lead se resuelve dentro del tenant correcto si llega company_id
+        lead_data = lead_service.get_lead_data_by_phone(customer_phone, company_id=company_id)
+        if not lead_data:
+            return jsonify({'status': 'error', 'message': 'Lead not found'}), 404
+
+        destination = PhoneUtils.add_34(customer_phone)
+        tenant_id = company_id or lead_data.get('company_id')  # fallback seguro
+
+        # Envío asíncrono: se encola y se guarda el mensaje cuando Meta confirme
+        if data.get('async') and outbound_dispatcher is not None:
+            def _on_sent(job):
+                if job['status'] == 'sent' and job['message_id']:
+                    sent_payload = job['_request'][2]
+                    message_service.save_template_message(sent_payload, job['message_id'], company_id=tenant_id)
+
+            job_id, _ = whatsapp_service.submit_template_message(
+                destination, template_name, lead_data, company_id=tenant_id, on_done=_on_sent
+            )
+            return jsonify({
+                'status': 'queued',
+                'job_id': job_id,
+                'sent_to': f'+{destination}',
+                'company_id': tenant_id
+            }), 202
+
+        success, message_id, payload = whatsapp_service.send_template_message(
+            destination,
+            template_name,
+            lead_data,
+            company_id=tenant_id
+        )
+
+        if success:
+            message_service.save_template_message(payload, message_id, company_id=company_id or lead_data.get('company_id'))
+            return jsonify({
+                'status': 'success',
+                'message_id': message_id,
+                'sent_to': f'+{destination}',
+                'company_id': company_id or lead_data.get('company_id')
+            }), 200
+        else:
+            return jsonify({'status': 'error', 'message': 'Failed to send template'}), 500
+
+    except Exception:
+        logger.exception('Error in send_template_endpoint')
+        return jsonify({'status': 'error', 'message': 'Internal error'}), 500
+
+BULK_TEMPLATE_MAX_RECIPIENTS = 5000
+BULK_TEMPLATE_MAX_WORKERS = 16
+BULK_TEMPLATE_SAVE_CHUNK = 200
+BULK_TEMPLATE_MAX_CAMPAIGNS = 200
+BULK_TEMPLATE_SHARE_INTERVAL = 1.0     # s entre copias del progreso en worker_state
+BULK_TEMPLATE_SHARED_TTL = 86400
+
+
+class BulkTemplateCampaign:
+    """
+    Estado de un /send_template_bulk en curso (en memoria del proceso que lo recibió).
+    Cada envío terminado llama a record(); los enviados se guardan en external_messages
+    en lotes de `save_chunk` según van llegando, no al final. El resumen se copia a
+    worker_state (cada BULK_TEMPLATE_SHARE_INTERVAL y al terminar) para que el GET de
+    progreso responda desde cualquier worker.
+    """
+    def __init__(self, template_name: str, company_id: str, total: int, save_chunk: int = BULK_TEMPLATE_SAVE_CHUNK):
+        self.id = uuid4().hex
+        self.template_name = template_name
+        self.company_id = company_id
+        self.total = total
+        self.save_chunk = save_chunk
+        self.created_at = time.time()
+        self.finished_at = None
+        self.results = [None] * total
+        self.done = 0
+        self.sent = 0
+        self.saved = 0
+        self._to_save = []
+        self._shared_at = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, index: int, result: dict, item=None):
+        with self._lock:
+            if self.results[index] is not None:
+                return
+            self.results[index] = result
+            self.done += 1
+            if result['status'] == 'sent':
+                self.sent += 1
+            if item:
+                self._to_save.append(item)
+            finished = self.done == self.total
+            if finished:
+                self.finished_at = time.time()
+            batch = []
+            if self._to_save and (finished or len(self._to_save) >= self.save_chunk):
+                batch, self._to_save = self._to_save, []
+            share = finished or time.time() - self._shared_at >= BULK_TEMPLATE_SHARE_INTERVAL
+            if share:
+                self._shared_at = time.time()
+        if batch:
+            self._save(batch)
+        if share:
+            self.share()
+        if finished:
+            logger.info(
+                f"[BULK TEMPLATE] {self.template_name} company={self.company_id}: {self.sent}/{self.total} enviados "
+                f"en {self.finished_at - self.created_at:.2f}s (campaign={self.id})"
+            )
+
+    def on_job_done(self, job: dict):
+        """on_done del OutboundDispatcher."""
+        meta = job.get('meta') or {}
+        result = {'index': meta.get('index'), 'phone': meta.get('phone'), 'status': 'error'}
+        item = None
+        if job['status'] == 'sent' and job.get('message_id'):
+            result.update({'status': 'sent', 'message_id': job['message_id']})
+            item = (job['_request'][2], job['message_id'])
+        else:
+            result['error'] = job.get('error') or job['status']
+            if job.get('http_status'):
+                result['http_status'] = job['http_status']
+        self.record(meta['index'], result, item)
+
+    def _save(self, items: list):
+        try:
+            saved = message_service.save_template_messages_batch(items, company_id=self.company_id)
+        except Exception:
+            logger.exception(f"[BULK TEMPLATE] Error guardando lote de {len(items)} mensajes (campaign={self.id})")
+            return
+        with self._lock:
+            self.saved += saved or 0
+
+    def share(self):
+        if not worker_state.enabled:
+            return
+        try:
+            worker_state.put('bulk_campaign', self.id, self.summary(include_results=True), BULK_TEMPLATE_SHARED_TTL)
+        except Exception as e:
+            logger.warning(f"[BULK TEMPLATE] No se pudo compartir el progreso (campaign={self.id}): {e}")
+
+    def summary(self, include_results: bool = True) -> dict:
+        with self._lock:
+            elapsed = (self.finished_at or time.time()) - self.created_at
+            out = {
+                'campaign_id': self.id,
+                'status': 'done' if self.done == self.total else 'running',
+                'template_name': self.template_name,
+                'company_id': self.company_id,
+                'total': self.total,
+                'done': self.done,
+                'sent': self.sent,
+                'failed': self.done - self.sent,
+                'saved': self.saved,
+                'elapsed_seconds': round(elapsed, 3),
+                'messages_per_second': round(self.sent / elapsed, 2) if elapsed > 0 else None,
+            }
+            if include_results:
+                out['results'] = [r for r in self.results if r is not None]
+            return out
+
+
+_bulk_campaigns: OrderedDict = OrderedDict()
+_bulk_campaigns_lock = threading.Lock()
+
+
+def _register_bulk_campaign(campaign: BulkTemplateCampaign):
+    with _bulk_campaigns_lock:
+        _bulk_campaigns[campaign.id] = campaign
+        while len(_bulk_campaigns) > BULK_TEMPLATE_MAX_CAMPAIGNS:
+            _bulk_campaigns.popitem(last=False)
+    campaign.share()
+
+
+@app.route('/send_template_bulk', methods=['POST'])
+@rate_limit(max_calls=5, window=60)
+def send_template_bulk_endpoint():
+    """
+    Envío de una plantilla a muchos destinatarios en una sola llamada (asíncrono).
+
+    Payload:
+    {
+        "company_id": "<uuid>",
+        "template_name": "retomar_contacto",
+        "language": "es_ES",                 # opcional
+        "max_workers": 8,                     # opcional, solo sin dispatcher (<= BULK_TEMPLATE_MAX_WORKERS)
+        "recipients": [
+            {"phone": "679609016", "params": {"first_name": "Ana", "deal_id": "..."}},
+            ...
+        ]
+    }
+    Responde 202 con campaign_id en cuanto todo está encolado (PRIORITY_BULK en el dispatcher);
+    el progreso se consulta en GET /send_template_bulk/<campaign_id>. Leads en una sola query
+    y guardado en external_messages por lotes según terminan los envíos.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        template_name = (data.get('template_name') or '').strip()
+        company_id = data.get('company_id')
+        recipients = data.get('recipients') or []
+        language = data.get('language')
+
+        if not template_name or not company_id or not isinstance(recipients, list) or not recipients:
+            return jsonify({'status': 'error', 'message': 'template_name, company_id y recipients son requeridos'}), 400
+        if not UUID_RE.match(company_id):
+            return jsonify({'status': 'error', 'message': 'Invalid company_id format'}), 400
+        if len(recipients) > BULK_TEMPLATE_MAX_RECIPIENTS:
+            return jsonify({'status': 'error', 'message': f'Máximo {BULK_TEMPLATE_MAX_RECIPIENTS} destinatarios por llamada'}), 400
+
+        # 1) Credenciales del tenant: una sola vez para toda la campaña
+        creds = get_whatsapp_credentials_for_company(company_id)
+        request_url = creds['base_url']
+        headers = creds['headers']
+        pnid = _extract_pnid_from_base_url(request_url)
+
+        # 2) Teléfonos válidos y sus leads en una sola query
+        normalized = []
+        for recipient in recipients:
+            recipient = recipient if isinstance(recipient, dict) else {'phone': recipient}
+            phone = recipient.get('phone') or recipient.get('customer_phone')
+            normalized.append((recipient, phone, PhoneUtils.strip_34(str(phone or ''))))
+        leads = lead_service.get_leads_data_by_phones(
+            [clean for _, _, clean in normalized if PhoneUtils.validate_spanish_phone(clean)],
+            company_id=company_id
+        )
+
+        campaign = BulkTemplateCampaign(template_name, company_id, len(recipients))
+        _register_bulk_campaign(campaign)
+
+        # 3) Payloads y encolado (sin esperar a Graph)
+        jobs = []
+        for idx, (recipient, phone, clean_phone) in enumerate(normalized):
+            if not PhoneUtils.validate_spanish_phone(clean_phone):
+                campaign.record(idx, {'index': idx, 'phone': phone, 'status': 'error', 'error': 'Invalid phone number'})
+                continue
+            try:
+                # Datos del lead + parámetros explícitos del destinatario (estos mandan)
+                template_data = dict(leads.get(clean_phone) or {}, **(recipient.get('params') or recipient.get('template_data') or {}))
+                template_data.setdefault('company_id', company_id)
+
+                to_e164 = PhoneUtils.add_34(clean_phone)
+                payload = whatsapp_service._build_template_payload(template_name, template_data, to_e164, company_id=company_id)
+                payload['to'] = to_e164
+                if language:
+                    payload['template']['language']['code'] = language
+            except Exception as e:
+                logger.exception(f"[BULK TEMPLATE] Error preparando envío a {phone}")
+                campaign.record(idx, {'index': idx, 'phone': phone, 'status': 'error', 'error': str(e)})
+                continue
+            jobs.append((idx, phone, payload))
+
+        if outbound_dispatcher is not None:
+            for idx, phone, payload in jobs:
+                outbound_dispatcher.submit(
+                    pnid, request_url, headers, payload, priority=OutboundDispatcher.PRIORITY_BULK,
+                    on_done=campaign.on_job_done, meta={'index': idx, 'phone': phone, 'campaign_id': campaign.id}
+                )
+        elif jobs:
+            # Sin dispatcher ([OUTBOUND] ENABLED=false): pool acotado en segundo plano
+            def _send_direct(job):
+                idx, phone, payload = job
+                result = {'index': idx, 'phone': phone, 'status': 'error'}
+                try:
+                    r = whatsapp_service.http.post(request_url, headers=headers, json=payload, timeout=15)
+                    if r.status_code // 100 == 2:
+                        wamid = ((r.json() or {}).get('messages') or [{}])[0].get('id')
+                        result.update({'status': 'sent', 'message_id': wamid})
+                        campaign.record(idx, result, (payload, wamid) if wamid else None)
+                        return
+                    result['http_status'] = r.status_code
+                    result['error'] = r.text[:500]
+                except Exception as e:
+                    logger.exception(f"[BULK TEMPLATE] Error enviando a {phone}")
+                    result['error'] = str(e)
+                campaign.record(idx, result)
 
-        destination = PhoneUtils.add_34(customer_phone)
-        success, message_id, payload = whatsapp_service.send_template_message(
-            destination,
-            template_name,
-            lead_data,
-            company_id=company_id or lead_data.get('company_id')  # fallback seguro
-        )
+            max_workers = max(1, min(int(data.get('max_workers') or 8), BULK_TEMPLATE_MAX_WORKERS, len(jobs)))
+            pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk-template')
+            for job in jobs:
+                pool.submit(_send_direct, job)
+            pool.shutdown(wait=False)
 
-        if success:
-            message_service.save_template_message(payload, message_id, company_id=company_id or lead_data.get('company_id'))
-            return jsonify({
-                'status': 'success',
-                'message_id': message_id,
-                'sent_to': f'+{destination}',
-                'company_id': company_id or lead_data.get('company_id')
-            }), 200
-        else:
-            return jsonify({'status': 'error', 'message': 'Failed to send template'}), 500
+        logger.info(f"[BULK TEMPLATE] {template_name} company={company_id}: {len(jobs)}/{len(recipients)} encolados (campaign={campaign.id})")
+        return jsonify({
+            'status': 'queued',
+            'campaign_id': campaign.id,
+            'template_name': template_name,
+            'company_id': company_id,
+            'total': len(recipients),
+            'queued': len(jobs),
+            'rejected': len(recipients) - len(jobs),
+            'status_url': f"/send_template_bulk/{campaign.id}",
+        }), 202
 
     except Exception:
-        logger.exception('Error in send_template_endpoint')
+        logger.exception('Error in send_template_bulk_endpoint')
         return jsonify({'status': 'error', 'message': 'Internal error'}), 500
 
+
+@app.route('/send_template_bulk/<campaign_id>', methods=['GET'])
+def send_template_bulk_status(campaign_id):
+    """Progreso de una campaña (?results=false para omitir el detalle por destinatario)"""
+    with _bulk_campaigns_lock:
+        campaign = _bulk_campaigns.get(campaign_id)
+    include_results = request.args.get('results', 'true').strip().lower() not in ('0', 'false', 'no')
+    if campaign is not None:
+        return jsonify({'status': 'ok', 'campaign': campaign.summary(include_results)}), 200
+    # Lanzada por otro worker: su última copia compartida
+    summary = worker_state.get('bulk_campaign', campaign_id)
+    if summary is None:
+        return jsonify({'status': 'error', 'message': 'Campaign not found'}), 404
+    if not include_results:
+        summary.pop('results', None)
+    return jsonify({'status': 'ok', 'campaign': summary}), 200
+
 @app.route('/WBhook', methods=['POST'])
 @rate_limit(max_calls=50, window=60)
 def handle_template():
@@ -6113,11 +8955,31 @@ def get_cover_wb_for_phone(phone: str) -> str:
     except Exception:
         logger.exception(f"[get_whatsapp_credentials_for_phone] Error resolving credentials for phone {phone}")
         return default
+def _default_tenant_credentials(company_id: str = "Default", company_name: str = "Default") -> TenantCredentials:
+    return TenantCredentials(
+        company_id=company_id,
+        company_name=company_name,
+        access_token=ACCESS_TOKEN,
+        phone_number_id=PHONE_NUMBER_ID,
+        business_id=WABA_ID,
+    )
+
+
 def get_whatsapp_credentials_for_company(company_id: str) -> dict:
     """
     Lee credenciales de properties/object_property_values para el tenant.
     Devuelve dict con headers, base_url y metadatos. Hace fallback a DEFAULT_* si falta algo.
+    Orden: store en memoria (TTL, incl. negativos) -> custom_properties de company_cache -> BD.
     """
+    cached = company_cache.get_credentials(company_id)
+    if cached:
+        return cached.to_dict()
+
+    creds = company_cache.credentials_from_config(company_id)
+    if creds:
+        company_cache.put_credentials(creds)
+        return creds.to_dict()
+
     try:
         sql = """
             SELECT p.property_name, opv.value
@@ -6130,12 +8992,12 @@ def get_whatsapp_credentials_for_company(company_id: str) -> dict:
         rows = db_manager.execute_query(sql, [company_id], fetch_all=True) or []
         kv = {name: val for (name, val) in rows if name}
 
-        access_token    = kv.get('WHATSAPP_ACCESS_TOKEN')    or ACCESS_TOKEN
-        phone_number_id = kv.get('WHATSAPP_PHONE_NUMBER_ID') or PHONE_NUMBER_ID
-        business_id     = kv.get('WHATSAPP_BUSINESS_ID')     or WABA_ID
         company_name    = kv.get('COMPANY_NAME')
 
         # Fallback para company_name desde tabla companies si no hay property
+        if not company_name:
+            entry = company_cache.get(company_id)
+            company_name = entry.get('name') if entry else None
         if not company_name:
             row = db_manager.execute_query(
                 "SELECT name FROM public.companies WHERE id = %s LIMIT 1",
@@ -6147,21 +9009,21 @@ def get_whatsapp_credentials_for_company(company_id: str) -> dict:
         if not company_name:
             company_name = "Default"
 
-        base_url = f"https://graph.facebook.com/{GRAPH_API_VERSION}/{phone_number_id}/messages"
-        headers  = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
+        # Tenant sin credenciales propias -> caché negativa (usa DEFAULT_* sin volver a BD)
+        if not kv.get('WHATSAPP_ACCESS_TOKEN') and not kv.get('WHATSAPP_PHONE_NUMBER_ID'):
+            creds = _default_tenant_credentials(company_id, company_name)
+            company_cache.put_negative(creds)
+            return creds.to_dict()
 
-        return {
-            "business_id":   business_id,      # <— antes devolvías 'waba_id'
-            "access_token":  access_token,
-            "phone_number_id": phone_number_id,
-            "base_url":      base_url,
-            "headers":       headers,
-            "company_id":    company_id,
-            "company_name":  company_name,
-        }
+        creds = TenantCredentials(
+            company_id=company_id,
+            company_name=company_name,
+            access_token=kv.get('WHATSAPP_ACCESS_TOKEN')    or ACCESS_TOKEN,
+            phone_number_id=kv.get('WHATSAPP_PHONE_NUMBER_ID') or PHONE_NUMBER_ID,
+            business_id=kv.get('WHATSAPP_BUSINESS_ID')     or WABA_ID,   # <— antes devolvías 'waba_id'
+        )
+        company_cache.put_credentials(creds)
+        return creds.to_dict()
     except Exception:
         logging.exception("Error getting company credentials")
         # Fallback absoluto a defaults
@@ -6290,36 +9152,28 @@ def get_templates():
         creds = get_whatsapp_credentials_for_phone(resolved_phone, company_id=query_id)
         used_company_name = creds.get('company_name')
         used_company_id = creds.get('company_id')
-        headers = creds.get('headers') or WHATSAPP_HEADERS
         waba_id = creds.get('business_id') or WABA_ID
 
         logger.info(f"📌 Usando WABA_ID: {waba_id} | phone_number_id: {creds.get('phone_number_id')} | company: {used_company_name}")
 
-        # Llamada a Facebook para obtener templates (usando credenciales resueltas)
-        templates_resp = requests.get(
-            f'https://graph.facebook.com/v22.0/{waba_id}/message_templates',
-            headers=headers,
-            params={'fields': 'name,status,category,language,components,id,rejected_reason', 'limit': 100},
-            timeout=15
-        )
-
-        logger.info(f"📊 Templates response status: {templates_resp.status_code}")
-
-        if templates_resp.status_code != 200:
-            error_detail = templates_resp.text
+        # Catálogo del WABA desde memoria (stale-while-revalidate); Graph solo en frío
+        try:
+            data_js, catalog_info = template_catalog.get_catalog(waba_id, creds.get('access_token') or ACCESS_TOKEN)
+        except HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else 502
+            error_detail = e.response.text if e.response is not None else str(e)
             logger.error(f"❌ Error obteniendo templates: {error_detail}")
             return jsonify({
                 'status': 'error',
-                'message': f'Error obteniendo templates: {templates_resp.status_code}',
+                'message': f'Error obteniendo templates: {status_code}',
                 'details': error_detail,
                 'waba_id_used': waba_id,
                 'phone_used': resolved_phone,
                 'company': used_company_name,
                 'company_id': used_company_id
-            }), templates_resp.status_code
+            }), status_code
 
-        data_js = templates_resp.json().get('data', [])
-        logger.info(f"✅ Se encontraron {len(data_js)} templates")
+        logger.info(f"✅ Se encontraron {len(data_js)} templates (catálogo: {catalog_info['source']}, edad {catalog_info['age']}s)")
 
         processed = []
         for t in data_js:
@@ -6361,6 +9215,7 @@ def get_templates():
             'total_templates': len(processed),
             'statistics': stats,
             'templates': processed,
+            'catalog': catalog_info,
             'extended_mime_support': True
         }
 
@@ -6511,35 +9366,255 @@ import json, re
 # Acepta UUID con guiones (validación rápida; Flask también tiene converter uuid, pero así no rompes nada)
 UUID_RE = re.compile(r"^[0-9a-fA-F-]{36}$")
 
-@app.route('/<company_id>/webhook', methods=['GET', 'POST'], strict_slashes=False)
-def webhook_company(company_id):
-    method = request.method
-    logger.info(f"Webhook called for company_id={company_id} with method={method}")
-    # --- Validación de ruta ---
-    if not UUID_RE.match(company_id):
-        abort(404)
-    print(f"Webhook called for company_id={company_id} with method={request.method}")
-    # --- Verificación Webhook (GET) ---
-    if request.method == 'GET':
-        token = request.args.get('hub.verify_token')
-        challenge = request.args.get('hub.challenge')
-        mode = request.args.get('hub.mode')
-        print(f"Webhook verify: company_id={company_id}, mode={mode}, token={token}, challenge={challenge}")
-        ok = (mode == 'subscribe' and token == VERIFY_TOKEN and challenge)
-        logger.info(f"[{company_id}] Webhook verify -> ok={bool(ok)} mode={mode}")
-        return (challenge, 200) if ok else ('Verify token incorrect', 403)
+class WebhookIngestQueue:
+    """
+    Cola durable (SQLite en modo WAL) para los eventos de /<company_id>/webhook.
+    - enqueue(): persiste el payload y vuelve en milisegundos (el endpoint responde 200 a Meta).
+    - Un pool de workers drena la cola y ejecuta el handler (process_company_webhook_event).
+    - Backpressure: con max_pending eventos pendientes enqueue() devuelve False (-> 503, Meta reintenta).
+      El nº de pendientes se lee del fichero (compartido por los workers de serve.py), cacheado ~1 s.
+    - Replay: los eventos pendientes, o en 'processing' con el lease caducado (proceso caído),
+      se vuelven a procesar tras un reinicio.
+    """
+    def __init__(self, path, handler, workers=4, max_pending=10000, max_attempts=5,
+                 lease_timeout=300, poll_interval=1.0, pending_cache_ttl=1.0):
+        self.path = path
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.max_pending = int(max_pending)
+        self.max_attempts = max(1, int(max_attempts))
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.pending_cache_ttl = pending_cache_ttl
+        self._pending_cached = (0, 0.0)  # (count, leído en monotonic)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._stats = {'enqueued': 0, 'rejected': 0, 'processed': 0, 'retried': 0, 'failed': 0}
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                company_id   TEXT NOT NULL,
+                payload      TEXT NOT NULL,
+                status       TEXT NOT NULL DEFAULT 'pending',
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                claimed_at   REAL,
+                created_at   REAL NOT NULL,
+                last_error   TEXT
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_webhook_events_status ON webhook_events (status, available_at, id)"
+        )
 
-    # --- Recepción de eventos (POST) ---
-    try:
-        data = request.get_json(silent=True) or {}
-        if not data or 'entry' not in data:
-            logger.info(f"[{company_id}] Empty/invalid payload")
-            return 'ok', 200
+    def _count(self, status: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM webhook_events WHERE status = ?", (status,)).fetchone()
+        return row[0] if row else 0
+
+    def pending_count(self) -> int:
+        """Pendientes + en proceso de todos los procesos que comparten el fichero (cacheado pending_cache_ttl)."""
+        count, read_at = self._pending_cached
+        now = time.monotonic()
+        if now - read_at < self.pending_cache_ttl:
+            return count
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM webhook_events WHERE status IN ('pending', 'processing')"
+            ).fetchone()
+        count = row[0] if row else 0
+        self._pending_cached = (count, now)
+        return count
+
+    def enqueue(self, company_id: str, payload: dict) -> bool:
+        """Guarda el evento. Devuelve False si la cola está llena (backpressure)."""
+        pending = self.pending_count()
+        if pending >= self.max_pending:
+            self._stats['rejected'] += 1
+            logger.warning(f"[INGEST] Queue full ({pending}/{self.max_pending}), rejecting event for {company_id}")
+            return False
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO webhook_events (company_id, payload, available_at, created_at) VALUES (?, ?, ?, ?)",
+                (company_id, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            count, read_at = self._pending_cached
+            self._pending_cached = (count + 1, read_at)
+            self._stats['enqueued'] += 1
+        self._wakeup.set()
+        return True
+
+    def _claim(self):
+        """Reserva el siguiente evento disponible (atómico también entre procesos: BEGIN IMMEDIATE)."""
+        now = time.time()
+        with self._lock:
+            began = False
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                began = True
+                row = self._conn.execute("""
+                    SELECT id, company_id, payload, attempts
+                    FROM webhook_events
+                    WHERE (status = 'pending' AND available_at <= ?)
+                       OR (status = 'processing' AND claimed_at < ?)
+                    ORDER BY id
+                    LIMIT 1
+                """, (now, now - self.lease_timeout)).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE webhook_events SET status = 'processing', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                        (now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                # Si falló el propio BEGIN ("database is locked") no hay transacción que deshacer
+                if began:
+                    try:
+                        self._conn.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        logger.exception("[INGEST] ROLLBACK failed")
+                raise
+        return row
+
+    def _complete(self, event_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+            self._stats['processed'] += 1
+
+    def _fail(self, event_id: int, attempts: int, error: str):
+        with self._lock:
+            if attempts >= self.max_attempts:
+                self._conn.execute(
+                    "UPDATE webhook_events SET status = 'failed', last_error = ? WHERE id = ?",
+                    (error[:2000], event_id)
+                )
+                self._stats['failed'] += 1
+            else:
+                # backoff exponencial: 2, 4, 8... segundos (máx 5 min)
+                delay = min(300, 2 ** attempts)
+                self._conn.execute(
+                    "UPDATE webhook_events SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?",
+                    (time.time() + delay, error[:2000], event_id)
+                )
+                self._stats['retried'] += 1
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                row = self._claim()
+            except Exception:
+                logger.exception("[INGEST] Error claiming event")
+                row = None
+            if not row:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._process(row)
+
+    def _process(self, row):
+        event_id, company_id, payload, attempts = row
+        attempts += 1
+        try:
+            self.handler(company_id, json.loads(payload))
+            self._complete(event_id)
+        except Exception as e:
+            logger.exception(f"[INGEST] Event {event_id} for {company_id} failed (attempt {attempts}/{self.max_attempts})")
+            self._fail(event_id, attempts, str(e))
+
+    def _async_dispatcher(self, core):
+        """Modo async: un solo hilo reclama eventos y los lanza al core mientras haya hueco."""
+        while not self._stop.is_set():
+            if not core.has_capacity():
+                self._wakeup.wait(0.01)
+                self._wakeup.clear()
+                continue
+            try:
+                row = self._claim()
+            except Exception:
+                logger.exception("[INGEST] Error claiming event")
+                row = None
+            if not row:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            core.submit_blocking(self._process, row).add_done_callback(lambda _f: self._wakeup.set())
+
+    def start_async(self, core):
+        """Procesa con el AsyncEventCore: hasta core.max_in_flight eventos en vuelo en lugar de N workers."""
+        if self._threads:
+            return
+        self._stop.clear()
+        t = Thread(target=self._async_dispatcher, args=(core,), name="webhook-ingest-async", daemon=True)
+        t.start()
+        self._threads.append(t)
+        logger.info(f"[INGEST] Async dispatcher on {self.path}: max_in_flight={core.max_in_flight} "
+                    f"({self.pending_count()} events to replay)")
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            t = Thread(target=self._worker, name=f"webhook-ingest-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"[INGEST] Started {self.workers} workers on {self.path} ({self.pending_count()} events to replay)")
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def replay_failed(self) -> int:
+        """Vuelve a poner en cola los eventos que agotaron sus reintentos."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE webhook_events SET status = 'pending', attempts = 0, available_at = ? WHERE status = 'failed'",
+                (time.time(),)
+            )
+            self._pending_cached = (0, 0.0)
+        self._wakeup.set()
+        return cur.rowcount
 
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            'pending': self._count('pending'),
+            'processing': self._count('processing'),
+            'failed_stored': self._count('failed'),
+            'max_pending': self.max_pending,
+            'workers': len(self._threads),
+        }
+
+
+def process_company_webhook_event(company_id, data):
+    """
+    Procesa un payload de /<company_id>/webhook ya validado.
+    Se llama inline desde el endpoint o desde los workers de WebhookIngestQueue.
+    """
+    # Memo de leads para todo el evento; las escrituras de cada mensaje van en su propio unit of work
+    # (commit antes de descargar media o mandar el auto-reply: nada de HTTP con la transacción abierta)
+    with lead_service.request_scope():
         for entry in data['entry']:
             for change in entry.get('changes', []):
                 value = change.get('value', {})
 
+                # -------- PLANTILLAS (estado / calidad / categoría) --------
+                if change.get('field') in TemplateCatalogCache.WEBHOOK_FIELDS:
+                    template_catalog.on_template_webhook(entry.get('id'), change.get('field'), value)
+                    continue
+
                 # -------- MENSAJES ENTRANTES --------
                 if 'messages' in value:
                     contacts = value.get('contacts', [])
@@ -6555,140 +9630,47 @@ def webhook_company(company_id):
                         # -------- MENSAJES DE TEXTO --------
                         if msg.get('type') == 'text':
                             log_received_message(msg, wa_id)
-                            # 🔍 1) Resolver lead y company_id REAL (el de negocio, FORUM / KEY / etc.)
-                            lead = None
-                            company_id_db = company_id  # por defecto, el de la ruta (tenant)
+                            # Reentrega ya procesada: ni se guarda otra vez ni repite flow-exit / auto-reply
+                            if message_service.is_redelivery(msg, company_id):
+                                logger.info(f"[{company_id}] ⏭️ Redelivered message {msg.get('id')} skipped")
+                                continue
+                            with db_manager.unit_of_work():
+                                # 🔍 1) Resolver lead y company_id REAL (el de negocio, FORUM / KEY / etc.)
+                                lead = None
+                                company_id_db = company_id  # por defecto, el de la ruta (tenant)
 
-                            try:
-                                lead = lead_service.get_lead_data_by_phone(sender_phone, company_id=company_id)
-                                if lead and lead.get('company_id'):
-                                    company_id_db = lead['company_id']  # ← aquí pisamos con el de FORUM 2000, etc.
-                                logger.info(f"[{company_id}] lead resuelto para {sender_phone}: {lead} (company_id_db={company_id_db})")
-                            except Exception:
-                                logger.exception(f"[{company_id}] Error resolviendo lead para {sender_phone}")
+                                try:
+                                    lead = lead_service.get_lead_data_by_phone(sender_phone, company_id=company_id)
+                                    if lead and lead.get('company_id'):
+                                        company_id_db = lead['company_id']  # ← aquí pisamos con el de FORUM 2000, etc.
+                                    logger.info(f"[{company_id}] lead resuelto para {sender_phone}: {lead} (company_id_db={company_id_db})")
+                                except Exception:
+                                    logger.exception(f"[{company_id}] Error resolviendo lead para {sender_phone}")
 
-                            # 💾 2) Guardar mensaje entrante usando company_id_db (NO el de la URL si hay lead)
-                            try:
-                                message_service.save_incoming_message(msg, wa_id, company_id=company_id_db)
-                            except TypeError:
-                                # compat si la firma antigua no acepta company_id
-                                message_service.save_incoming_message(msg, wa_id)                            
-                            # MINIMO: pasar company_id (haz que el método lo acepte como opcional)
-                            try:
-                                message_service.save_incoming_message(msg, wa_id, company_id=company_id)
-                            except TypeError:
-                                # compat si aún no acepta el parámetro
-                                message_service.save_incoming_message(msg, wa_id)
+                                # 💾 2) Guardar mensaje entrante usando company_id_db (NO el de la URL si hay lead)
+                                try:
+                                    message_service.save_incoming_message(msg, wa_id, company_id=company_id_db)
+                                except TypeError:
+                                    # compat si la firma antigua no acepta company_id
+                                    message_service.save_incoming_message(msg, wa_id)                            
+                                # MINIMO: pasar company_id (haz que el método lo acepte como opcional)
+                                try:
+                                    message_service.save_incoming_message(msg, wa_id, company_id=company_id)
+                                except TypeError:
+                                    # compat si aún no acepta el parámetro
+                                    message_service.save_incoming_message(msg, wa_id)
 
-                            # Flow EXIT logic (con filtro por tenant)
-                            try:
-                                context = msg.get('context') or {}
-                                context_id = context.get('id')
-                                madrid_ahora = now_madrid_naive()
-
-                                if not context_id:
-                                    query_last_template = """
-                                        SELECT last_message_uid
-                                        FROM public.external_messages
-                                        WHERE sender_phone = %s
-                                        AND company_id   = %s
-                                        AND from_me      = 'true'
-                                        AND status       = 'template_sent'
-                                        AND created_at   > %s
-                                        AND last_message_uid IS NOT NULL
-                                        ORDER BY created_at DESC
-                                        LIMIT 1
-                                    """
-                                    umbral = madrid_ahora - timedelta(minutes=15)
-                                    row = db_manager.execute_query(
-                                        query_last_template, [sender_phone, company_id_db, umbral], fetch_one=True
-                                    )
-                                    if row and row[0]:
-                                        context_id = row[0]
-                                    else:
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service , company_id=company_id
-                                            )
-                                        continue
-
-                                if context_id:
-                                    chk_template = """
-                                        SELECT 1
-                                        FROM public.external_messages
-                                        WHERE last_message_uid = %s
-                                        AND sender_phone     = %s
-                                        AND company_id       = %s
-                                        AND status           = 'flow_exit_triggered'
-                                        LIMIT 1
-                                    """
-                                    ok_template = db_manager.execute_query(chk_dedup, [context_id, sender_phone, company_id_db], fetch_one=True)
-                                    if not ok_template:
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service , company_id=company_id
-                                            )
-                                        continue
-
-                                    chk_dedup = """
-                                        SELECT 1
-                                          FROM public.external_messages
-                                         WHERE last_message_uid = %s
-                                           AND sender_phone     = %s
-                                           AND company_id       = %s
-                                           AND status           = 'flow_exit_triggered'
-                                         LIMIT 1
-                                    """
-                                    ya_triggered = db_manager.execute_query(
-                                        chk_dedup, [context_id, sender_phone, company_id], fetch_one=True
+                                # Flow EXIT logic (con filtro por tenant); el POST al scheduler va por flow_exit_outbox
+                                exit_already_triggered = False
+                                try:
+                                    exit_already_triggered = process_flow_exit_reply(
+                                        sender_phone, (msg.get('context') or {}).get('id'), company_id_db, lead=lead
                                     )
-                                    if ya_triggered:
-                                        continue
-
-                                    lead = lead_service.get_lead_data_by_phone(sender_phone, company_id=company_id)
-                                    if not lead or not lead.get('lead_id'):
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service , company_id=company_id
-                                            )
-                                        continue
-
-                                    lead_id = lead['lead_id']
-                                    ok = flow_exit_client.send_exit(lead_id)
-                                    if ok:
-                                        flow_name = "welcome_email_flow"
-                                        motivo = "Usuario quiere salir del flow"
-                                        exit_message = f"Exit Flow: {flow_name} por: {motivo}"
-
-                                        # MINIMO: añadir company_id al INSERT
-                                        mark_sql = """
-                                            INSERT INTO public.external_messages (
-                                                id, message, sender_phone, responsible_email,
-                                                last_message_uid, last_message_timestamp,
-                                                from_me, status, created_at, updated_at, is_deleted,
-                                                chat_id, chat_url, assigned_to_id, company_id
-                                            ) VALUES (
-                                                %s, %s, %s, %s,
-                                                %s, %s,
-                                                %s, %s, NOW(), NOW(), FALSE,
-                                                %s, %s, %s, %s
-                                            )
-                                        """
-                                        params = [
-                                            str(uuid4()),
-                                            json.dumps({'text': exit_message}, ensure_ascii=False),
-                                            sender_phone, '', context_id, madrid_ahora,
-                                            'true', 'flow_exit_triggered',
-                                            sender_phone, sender_phone, None,
-                                            company_id
-                                        ]
-                                        db_manager.execute_query(mark_sql, params)
-
-                            except Exception:
-                                logger.exception(f"[{company_id}] Error procesando disparo de flow exit")
+                                except Exception:
+                                    logger.exception(f"[{company_id}] Error procesando disparo de flow exit")
 
                             # Auto-reply si es fuera de horario
-                            if not auto_reply_service.is_office_hours():
+                            if not exit_already_triggered and not auto_reply_service.is_office_hours():
                                 auto_reply_service.send_auto_reply(
                                     sender_phone, whatsapp_service, message_service , company_id=company_id
                                 )
@@ -6822,7 +9804,8 @@ def webhook_company(company_id):
                 # -------- ESTADOS DE MENSAJE --------
                 elif 'statuses' in value:
                     # (mínimo: lo dejamos igual; si tu handler soporta company_id, pásaselo)
-                    handle_message_statuses_webhook(value, db_manager)
+                    with db_manager.unit_of_work():
+                        handle_message_statuses_webhook(value, db_manager)
 
                 # -------- LLAMADAS (CALLS) --------
                 elif 'calls' in value:
@@ -6838,6 +9821,39 @@ def webhook_company(company_id):
                 else:
                     logger.info(f"[{company_id}] 📱 Webhook event not processed: {list(value.keys())}")
 
+
+@app.route('/<company_id>/webhook', methods=['GET', 'POST'], strict_slashes=False)
+def webhook_company(company_id):
+    method = request.method
+    logger.info(f"Webhook called for company_id={company_id} with method={method}")
+    # --- Validación de ruta ---
+    if not UUID_RE.match(company_id):
+        abort(404)
+    print(f"Webhook called for company_id={company_id} with method={request.method}")
+    # --- Verificación Webhook (GET) ---
+    if request.method == 'GET':
+        token = request.args.get('hub.verify_token')
+        challenge = request.args.get('hub.challenge')
+        mode = request.args.get('hub.mode')
+        print(f"Webhook verify: company_id={company_id}, mode={mode}, token={token}, challenge={challenge}")
+        ok = (mode == 'subscribe' and token == VERIFY_TOKEN and challenge)
+        logger.info(f"[{company_id}] Webhook verify -> ok={bool(ok)} mode={mode}")
+        return (challenge, 200) if ok else ('Verify token incorrect', 403)
+
+    # --- Recepción de eventos (POST) ---
+    try:
+        data = request.get_json(silent=True) or {}
+        if not data or 'entry' not in data:
+            logger.info(f"[{company_id}] Empty/invalid payload")
+            return 'ok', 200
+
+        if webhook_ingest_queue is not None:
+            # Modo ingest: persistimos y respondemos ya; los workers procesan en segundo plano
+            if not webhook_ingest_queue.enqueue(company_id, data):
+                return 'busy', 503
+            return 'ok', 200
+
+        process_company_webhook_event(company_id, data)
         return 'ok', 200
 
     except Exception:
@@ -6845,6 +9861,66 @@ def webhook_company(company_id):
         return 'error', 500
 
 
+# --- Cola de ingest (solo si [INGEST] enabled=true) ---
+webhook_ingest_queue = None
+async_core = None
+if config.ingest_config.get('enabled'):
+    try:
+        webhook_ingest_queue = WebhookIngestQueue(
+            config.ingest_config['queue_path'],
+            process_company_webhook_event,
+            workers=config.ingest_config['workers'],
+            max_pending=config.ingest_config['max_pending'],
+            max_attempts=config.ingest_config['max_attempts'],
+            lease_timeout=config.ingest_config['lease_timeout'],
+        )
+        if config.ingest_config['mode'] == 'async':
+            # [INGEST] mode=async: eventos en vuelo acotados por max_in_flight en un event loop.
+            # Los handlers siguen siendo bloqueantes: más eventos en vuelo que conexiones del pool
+            # solo esperan checkout y acaban en TimeoutError.
+            _pool_size = db_manager.pool.max_size
+            _max_in_flight = config.ingest_config['max_in_flight'] or _pool_size
+            if _max_in_flight > _pool_size:
+                logger.warning(f"[INGEST] max_in_flight={_max_in_flight} > DB_POOL_MAX_SIZE={_pool_size}; se limita a {_pool_size}")
+                _max_in_flight = _pool_size
+            async_core = AsyncEventCore(max_in_flight=_max_in_flight).start(
+                db_manager=db_manager,
+                sync_http=graph_http,
+                http2=bool(graph_http.http2_hosts),
+            )
+            webhook_ingest_queue.start_async(async_core)
+        else:
+            webhook_ingest_queue.start()
+    except Exception:
+        logger.exception("[INGEST] No se pudo iniciar la cola de ingest; procesando webhooks inline")
+        webhook_ingest_queue = None
+
+
+@app.route('/ingest_stats', methods=['GET'])
+@all_workers
+def ingest_stats():
+    """Estado de la cola de ingest del webhook"""
+    if webhook_ingest_queue is None:
+        return jsonify({'status': 'ok', 'ingest_enabled': False}), 200
+    return jsonify({
+        'status': 'ok',
+        'ingest_enabled': True,
+        'mode': 'async' if async_core is not None else 'threads',
+        'queue': webhook_ingest_queue.stats(),
+        'async_core': async_core.stats() if async_core is not None else None
+    }), 200
+
+
+@app.route('/ingest_replay', methods=['POST'])
+@admin_only
+def ingest_replay():
+    """Reencola los eventos que agotaron sus reintentos"""
+    if webhook_ingest_queue is None:
+        return jsonify({'status': 'error', 'message': 'Ingest mode disabled'}), 400
+    replayed = webhook_ingest_queue.replay_failed()
+    return jsonify({'status': 'success', 'replayed': replayed}), 200
+
+
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     # --- Verificación Webhook (GET) ---
@@ -6870,6 +9946,11 @@ def webhook():
             for change in entry.get('changes', []):
                 value = change.get('value', {})
 
+                # -------- PLANTILLAS (estado / calidad / categoría) --------
+                if change.get('field') in TemplateCatalogCache.WEBHOOK_FIELDS:
+                    template_catalog.on_template_webhook(entry.get('id'), change.get('field'), value)
+                    continue
+
                 # -------- MENSAJES ENTRANTES --------
                 if 'messages' in value:
                     contacts = value.get('contacts', [])
@@ -6885,112 +9966,21 @@ def webhook():
                         # -------- MENSAJES DE TEXTO --------
                         if msg.get('type') == 'text':
                             log_received_message(msg, wa_id)
+                            if message_service.is_redelivery(msg):
+                                logger.info(f"⏭️ Redelivered message {msg.get('id')} skipped")
+                                continue
                             message_service.save_incoming_message(msg, wa_id)
-                            # Flow EXIT logic
+                            # Flow EXIT logic; el POST al scheduler va por flow_exit_outbox
+                            exit_already_triggered = False
                             try:
-                                context = msg.get('context') or {}
-                                context_id = context.get('id')
-                                madrid_ahora = now_madrid_naive()
-
-                                if not context_id:
-                                    query_last_template = """
-                                        SELECT last_message_uid
-                                        FROM public.external_messages
-                                        WHERE sender_phone = %s
-                                          AND from_me = 'true'
-                                          AND status = 'template_sent'
-                                          AND created_at > %s
-                                          AND last_message_uid IS NOT NULL
-                                        ORDER BY created_at DESC
-                                        LIMIT 1
-                                    """
-                                    umbral = madrid_ahora - timedelta(minutes=15)
-                                    row = db_manager.execute_query(
-                                        query_last_template, [sender_phone, umbral], fetch_one=True
-                                    )
-                                    if row and row[0]:
-                                        context_id = row[0]
-                                    else:
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service , company_id=company_id
-                                            )
-                                        continue
-
-                                if context_id:
-                                    chk_template = """
-                                        SELECT 1
-                                        FROM public.external_messages
-                                        WHERE last_message_uid = %s
-                                          AND status = 'template_sent'
-                                        LIMIT 1
-                                    """
-                                    ok_template = db_manager.execute_query(
-                                        chk_template, [context_id], fetch_one=True
-                                    )
-                                    if not ok_template:
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service , company_id=company_id
-                                            )
-                                        continue
-
-                                    chk_dedup = """
-                                        SELECT 1
-                                        FROM public.external_messages
-                                        WHERE last_message_uid = %s
-                                          AND sender_phone = %s
-                                          AND status = 'flow_exit_triggered'
-                                        LIMIT 1
-                                    """
-                                    ya_triggered = db_manager.execute_query(
-                                        chk_dedup, [context_id, sender_phone], fetch_one=True
-                                    )
-                                    if ya_triggered:
-                                        continue
-
-                                    lead = lead_service.get_lead_data_by_phone(sender_phone, company_id=company_id)
-                                    if not lead or not lead.get('lead_id'):
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service , company_id=company_id
-                                            )
-                                        continue
-                                    
-                                    lead_id = lead['lead_id']
-                                    ok = flow_exit_client.send_exit(lead_id)
-                                    if ok:
-                                        flow_name = "welcome_email_flow"
-                                        motivo = "Usuario quiere salir del flow"
-                                        exit_message = f"Exit Flow: {flow_name} por: {motivo}"
-
-                                        mark_sql = """
-                                            INSERT INTO public.external_messages (
-                                                id, message, sender_phone, responsible_email,
-                                                last_message_uid, last_message_timestamp,
-                                                from_me, status, created_at, updated_at, is_deleted,
-                                                chat_id, chat_url, assigned_to_id
-                                            ) VALUES (
-                                                %s, %s, %s, %s,
-                                                %s, %s,
-                                                %s, %s, NOW(), NOW(), FALSE,
-                                                %s, %s, %s
-                                            )
-                                        """
-                                        params = [
-                                            str(uuid4()),
-                                            json.dumps({'text': exit_message}, ensure_ascii=False),
-                                            sender_phone, '', context_id, madrid_ahora,
-                                            'true', 'flow_exit_triggered',
-                                            sender_phone, sender_phone, None
-                                        ]
-                                        db_manager.execute_query(mark_sql, params)
-
+                                exit_already_triggered = process_flow_exit_reply(
+                                    sender_phone, (msg.get('context') or {}).get('id'), None
+                                )
                             except Exception:
                                 logger.exception("Error procesando disparo de flow exit")
 
                             # Auto-reply si es fuera de horario
-                            if not auto_reply_service.is_office_hours():
+                            if not exit_already_triggered and not auto_reply_service.is_office_hours():
                                 auto_reply_service.send_auto_reply(
                                     sender_phone, whatsapp_service, message_service , company_id=company_id
                                 )
@@ -7330,7 +10320,7 @@ def send_messenger_text(page_access_token: str, psid: str, text: str):
             "recipient": {"id": psid},
             "message": {"text": text}
         }
-        r = requests.post(url, params=params, json=payload, timeout=10)
+        r = graph_http.post(url, params=params, json=payload, timeout=10)
         r.raise_for_status()
         logger.info(f"[Messenger] Sent echo to {psid}: {text!r}")
     except Exception:
@@ -7348,7 +10338,7 @@ def fetch_messenger_profile(page_access_token: str, psid: str) -> dict:
             "fields": "first_name,last_name,profile_pic",
             "access_token": page_access_token
         }
-        r = requests.get(url, params=params, timeout=10)
+        r = graph_http.get(url, params=params, timeout=10)
         r.raise_for_status()
         data = r.json() or {}
         return {
@@ -7372,7 +10362,7 @@ def fetch_messenger_profile_simple(page_access_token: str, psid: str) -> dict:
             "fields": "first_name,last_name",
             "access_token": page_access_token
         }
-        r = requests.get(url, params=params, timeout=10)
+        r = graph_http.get(url, params=params, timeout=10)
         r.raise_for_status()
         data = r.json() or {}
         return {
@@ -7432,7 +10422,7 @@ def send_messenger_text_simple(page_access_token: str, psid: str, text: str) ->
             "recipient": {"id": psid},
             "message": {"text": text}
         }
-        r = requests.post(url, params=params, json=payload, timeout=10)
+        r = graph_http.post(url, params=params, json=payload, timeout=10)
         # no frenamos el flujo por un 400, sólo lo dejamos en logs
         print("[Messenger] send reply status:", r.status_code, r.text)
     except Exception as e:
@@ -7843,7 +10833,7 @@ def create_portal_user(data, source=None, config_obj=None):
             "form_name": form_name
         }
         try:
-            response = requests.post(url, data=json.dumps(payload), headers=HEADERS)
+            response = graph_http.post(url, data=json.dumps(payload), headers=HEADERS)
             if response.status_code in [200, 201]:
                 return response.json()
             else:
@@ -7885,7 +10875,7 @@ def create_portal_user(data, source=None, config_obj=None):
         "form_name": form_name
     }
     try:
-        response = requests.post(url, data=json.dumps(payload), headers=HEADERS)
+        response = graph_http.post(url, data=json.dumps(payload), headers=HEADERS)
         if response.status_code in [200, 201]:
             return response.json()
         else:
@@ -8303,16 +11293,12 @@ def _now():
     return datetime.now(TZ)
 
 def _get_cfg_db():
-    global config, db
+    global config
     try:
         cfg = config
     except NameError:
         cfg = Config()
-    try:
-        dbm = db
-    except NameError:
-        dbm = DatabaseManager(cfg.db_config)
-    return cfg, dbm
+    return cfg, get_db_manager(cfg.db_config)
 
 def _normalize_phone_candidates(phone: str | None) -> list[str]:
     if not phone:
@@ -8350,7 +11336,11 @@ def _get_lead_phone(dbm, lead_id: str) -> str | None:
 def _last_user_message_ts(dbm, phone: str) -> datetime | None:
     """
     En tu DDL, from_me es TEXT -> hay que comparar con 'false' (string), no boolean.
+    Primero el índice de ventanas (todos los tenants); la query solo si está desactivado.
     """
+    window = conversation_windows.get(None, phone)
+    if window is not None:
+        return window['last_inbound_at']
     cands = _normalize_phone_candidates(phone)
     if not cands:
         return None
@@ -8500,20 +11490,7 @@ def get_message_status(message_id):
         
         # Determinar posibles próximos estados
         current_status = result[1]
-        possible_next = []
-        
-        if current_status == 'template_sent':
-            possible_next = ['template_delivered', 'template_failed']
-        elif current_status == 'template_delivered':
-            possible_next = ['template_read', 'template_failed']
-        elif current_status == 'sent':
-            possible_next = ['message_delivered', 'message_failed']
-        elif current_status == 'message_delivered':
-            possible_next = ['message_read', 'message_failed']
-        elif current_status == 'media_sent':
-            possible_next = ['media_delivered', 'media_failed']
-        elif current_status == 'media_delivered':
-            possible_next = ['media_read', 'media_failed']
+        possible_next = possible_next_statuses(current_status)
         
         msg_info['possible_next_statuses'] = possible_next
         
@@ -8603,7 +11580,8 @@ def send_text_direct():
     Payload:
     {
         "phone": "679609016",
-        "message": "Hola, este es un mensaje directo"
+        "message": "Hola, este es un mensaje directo",
+        "async": false   # opcional: true -> 202 con job_id (GET /outbound/jobs/<job_id>)
     }
     """
     try:
@@ -8628,11 +11606,21 @@ def send_text_direct():
         }
         
         logger.info(f"[DIRECT TEXT] Enviando texto a {destination}: {message[:50]}...")
-        
-        response = requests.post(
+
+        if data.get('async') and outbound_dispatcher is not None:
+            job_id = outbound_dispatcher.submit(
+                _extract_pnid_from_base_url(config.whatsapp_config['base_url']),
+                config.whatsapp_config['base_url'],
+                config.whatsapp_config['headers'],
+                payload,
+                meta={'to': destination}
+            )
+            return jsonify({'status': 'queued', 'job_id': job_id, 'sent_to': destination}), 202
+
+        response = _outbound_post(
             config.whatsapp_config['base_url'],
-            headers=config.whatsapp_config['headers'],
-            json=payload,
+            config.whatsapp_config['headers'],
+            payload,
             timeout=15
         )
         
@@ -8703,7 +11691,21 @@ def get_available_templates_direct():
             "optional_params": ["responsible_first_name", "responsible_name", "company_name"]
         }
     ]
-    
+
+    # ?company_id=<uuid> → estado real de cada plantilla en el WABA del tenant (catálogo en memoria)
+    company_id = _sanitize_arg(request.args.get("company_id"))
+    if company_id:
+        try:
+            creds = get_whatsapp_credentials_for_company(company_id)
+            waba_id = creds.get('business_id') or WABA_ID
+            access_token = creds.get('access_token') or ACCESS_TOKEN
+            for t in templates:
+                found = template_catalog.find(waba_id, access_token, t["name"])
+                t["status"] = found.get("status") if found else "NOT_FOUND"
+                t["language"] = found.get("language") if found else None
+        except Exception as e:
+            logger.warning(f"[TEMPLATES_DIRECT] No se pudo consultar el catálogo de {company_id}: {e}")
+
     return jsonify({
         'status': 'success',
         'available_templates': templates,
@@ -8813,6 +11815,9 @@ def _get_lead_phone_tenant(dbm, lead_id: str, company_id: str) -> str | None:
 
 def _last_template_sent_ts_tenant(dbm, phone: str, company_id: str):
     # Último template OUT por tenant y teléfono (normalizado)
+    window = conversation_windows.get(company_id, phone)
+    if window is not None:
+        return window['last_template_at']
     candidates = _normalize_phone_candidates(phone)  # p.ej. ['608684495','34608684495']
 
     # Opción A: usando ANY con array (si tu driver admite listas -> text[])
@@ -8846,6 +11851,9 @@ def _last_template_sent_ts_tenant(dbm, phone: str, company_id: str):
 
 
 def _last_user_message_ts_tenant(dbm, phone: str, company_id: str):
+    window = conversation_windows.get(company_id, phone)
+    if window is not None:
+        return window['last_inbound_at']
     candidates = _normalize_phone_candidates(phone)
 
     sql = """
@@ -8891,6 +11899,11 @@ def _last_template_sent_ts(dbm, phone: str) -> datetime | None:
     Obtiene el timestamp del último template enviado a un teléfono específico.
     Busca CUALQUIER status de template (template_sent, template_delivered, template_read, template_failed).
     """
+    window = conversation_windows.get(None, phone)
+    if window is not None:
+        logger.info(f"[TEMPLATE CHECK] Phone: {phone} -> last template (índice): {window['last_template_at']}")
+        return window['last_template_at']
+
     cands = _normalize_phone_candidates(phone)
     logger.info(f"[TEMPLATE CHECK] Phone: {phone} -> Candidates: {cands}")
     
@@ -8898,35 +11911,12 @@ def _last_template_sent_ts(dbm, phone: str) -> datetime | None:
         logger.warning(f"[TEMPLATE CHECK] No valid phone candidates for: {phone}")
         return None
     
-    # Primero, veamos qué templates hay en la BD para este teléfono
-    debug_query = """
-        SELECT status, from_me, sender_phone, last_message_timestamp, message
-        FROM public.external_messages
-        WHERE sender_phone IN (%s, %s)
-          AND (status LIKE '%template%' OR from_me = 'true')
-        ORDER BY last_message_timestamp DESC
-        LIMIT 5
-    """
-    debug_rows = dbm.execute_query(
-        debug_query,
-        [cands[0], cands[1] if len(cands) > 1 else cands[0]],
-        fetch_all=True
-    )
-    
-    logger.info(f"[TEMPLATE CHECK] Debug - Recent messages for {phone}:")
-    if debug_rows:
-        for i, row in enumerate(debug_rows):
-            logger.info(f"  [{i+1}] Status: {row[0]}, From_me: {row[1]}, Phone: {row[2]}, Time: {row[3]}, Message: {str(row[4])[:100]}...")
-    else:
-        logger.info("  No messages found")
-    
-    # 🔧 CAMBIO PRINCIPAL: Buscar cualquier template, no solo template_sent
     row = dbm.execute_query(
         """
-        SELECT last_message_timestamp, message, status
+        SELECT last_message_timestamp, status
         FROM public.external_messages
         WHERE from_me = 'true'
-          AND message LIKE '%template%'
+          AND status ILIKE '%template%'
           AND sender_phone IN (%s, %s)
         ORDER BY last_message_timestamp DESC
         LIMIT 1
@@ -8936,7 +11926,7 @@ def _last_template_sent_ts(dbm, phone: str) -> datetime | None:
     )
     
     if row and row[0]:
-        logger.info(f"[TEMPLATE CHECK] Last template found: {row[0]} (status: {row[2]}) - Message: {str(row[1])[:100]}...")
+        logger.info(f"[TEMPLATE CHECK] Last template found: {row[0]} (status: {row[1]})")
         return row[0]
     else:
         logger.info(f"[TEMPLATE CHECK] No templates found for candidates: {cands}")
@@ -9173,6 +12163,105 @@ def time_to_template():
     }), 200
 
 
+def _window_eligibility(last_user_ts, last_template_ts) -> dict:
+    """Mismas reglas que /canSendMessage y /canSendTemplate a partir de los dos timestamps."""
+    can_send_message, secs_message = _can_send_message(last_user_ts)
+    if can_send_message:
+        can_send_template, secs_template = True, 0
+    elif last_template_ts is not None:
+        if last_template_ts.tzinfo is None:
+            last_template_ts = last_template_ts.replace(tzinfo=TZ)
+        delta = (_now() - last_template_ts).total_seconds()
+        can_send_template = delta >= WABA_WINDOW_SEC
+        secs_template = 0 if can_send_template else int(WABA_WINDOW_SEC - delta)
+    else:
+        can_send_template, secs_template = True, 0
+    return {
+        "can_send_message": can_send_message,
+        "can_send_template": can_send_template,
+        "seconds_until_template_only": secs_message,
+        "seconds_until_next_template": secs_template,
+    }
+
+
+@app.route("/canSend/batch", methods=["POST"])
+def can_send_batch():
+    """
+    /canSendMessage + /canSendTemplate para muchos destinatarios en una llamada (multi-tenant).
+    Body: {"company_id": "...", "ids": ["<lead uuid>", ...], "phones": ["346...", ...]}
+    Los teléfonos de los leads salen de 1 query y las ventanas de conversation_windows (1-2 queries),
+    independientemente del número de destinatarios.
+    """
+    _, dbm = _get_cfg_db()
+    data = request.get_json(silent=True) or {}
+    company_id = data.get("company_id")
+    ids = data.get("ids") or []
+    phones = data.get("phones") or []
+
+    if not company_id:
+        return jsonify({"ok": False, "error": "Falta company_id"}), 400
+    if not _is_valid_uuid(company_id):
+        return jsonify({"ok": False, "error": "company_id inválido"}), 400
+    if not isinstance(ids, list) or not isinstance(phones, list):
+        return jsonify({"ok": False, "error": "ids y phones deben ser listas"}), 400
+    if not ids and not phones:
+        return jsonify({"ok": False, "error": "Falta ids o phones"}), 400
+    max_batch = config.config.getint('APP', 'CAN_SEND_BATCH_MAX', fallback=10000)
+    if len(ids) + len(phones) > max_batch:
+        return jsonify({"ok": False, "error": f"Máximo {max_batch} destinatarios por llamada"}), 400
+
+    # 1) Teléfonos de los leads (una sola query)
+    valid_ids = list({str(i) for i in ids if _is_valid_uuid(i)})
+    lead_phones = {}
+    if valid_ids:
+        rows = dbm.execute_query(
+            """
+            SELECT id::text, phone
+            FROM public.leads
+            WHERE company_id = %s
+              AND id = ANY(CAST(%s AS uuid[]))
+            """,
+            [company_id, valid_ids], fetch_all=True
+        ) or []
+        lead_phones = {str(r[0]).lower(): r[1] for r in rows if r[1]}
+
+    recipients = []
+    for id_ in ids:
+        phone = lead_phones.get(str(id_).lower())
+        if phone:
+            recipients.append({"id": id_, "phone": phone})
+        else:
+            error = "id no es UUID válido" if not _is_valid_uuid(id_) else "No se encontró teléfono para el id"
+            recipients.append({"id": id_, "phone": None, "ok": False, "error": error})
+    for phone in phones:
+        if ConversationWindowIndex.phone_key(phone):
+            recipients.append({"phone": phone})
+        else:
+            recipients.append({"phone": phone, "ok": False, "error": "Teléfono inválido"})
+
+    # 2) Ventanas de todos los teléfonos a la vez
+    windows = conversation_windows.get_many(company_id, [r["phone"] for r in recipients if r.get("ok") is not False])
+
+    allowed = {"message": 0, "template": 0}
+    for r in recipients:
+        if r.get("ok") is False:
+            continue
+        window = windows.get(ConversationWindowIndex.phone_key(r["phone"])) or {}
+        r["ok"] = True
+        r.update(_window_eligibility(window.get("last_inbound_at"), window.get("last_template_at")))
+        allowed["message"] += r["can_send_message"]
+        allowed["template"] += r["can_send_template"]
+
+    return jsonify({
+        "ok": True,
+        "company_id": company_id,
+        "count": len(recipients),
+        "can_send_message_count": allowed["message"],
+        "can_send_template_count": allowed["template"],
+        "results": recipients
+    }), 200
+
+
 
 @app.route('/test_whatsapp_curl', methods=['POST'])
 def test_whatsapp_curl():
@@ -9202,7 +12291,7 @@ def test_whatsapp_curl():
         logger.info(f"[CURL TEST] Headers: {headers}")
         logger.info(f"[CURL TEST] Payload: {payload}")
         
-        response = requests.post(url, headers=headers, json=payload, timeout=15)
+        response = graph_http.post(url, headers=headers, json=payload, timeout=15)
         
         return jsonify({
             'status': 'success' if response.ok else 'error',
@@ -9243,6 +12332,54 @@ def root():
         ]
     }), 200
 
+def warm_up_worker() -> dict:
+    """
+    Warm-up de un worker antes de aceptar tráfico (serve.py): configuraciones de compañías
+    y catálogo de plantillas de cada WABA.
+    """
+    t0 = time.monotonic()
+    result = {'companies': 0, 'template_catalogs': 0, 'phones': 0}
+    try:
+        if not company_cache._cache:
+            company_cache.preload_all_companies(db_manager)
+        result['companies'] = len(company_cache._cache)
+    except Exception:
+        logger.exception("[WARMUP] Error precargando compañías")
+
+    warmed = set()
+    for company_id in list(company_cache._cache.keys()):
+        try:
+            creds = get_whatsapp_credentials_for_company(company_id)
+            waba_id = creds.get('business_id')
+            if waba_id and creds.get('access_token') and waba_id not in warmed:
+                template_catalog.get_catalog(waba_id, creds['access_token'])
+                warmed.add(waba_id)
+        except Exception as e:
+            logger.warning(f"[WARMUP] Catálogo de plantillas de {company_id} no disponible: {e}")
+    result['template_catalogs'] = len(warmed)
+
+    # El enrutado phone -> tenant ya se precarga al importar ([APP] PHONE_ROUTING_WARMUP)
+    result['phones'] = _phone_company_cache.stats()['size']
+    result['elapsed_s'] = round(time.monotonic() - t0, 2)
+    logger.info(f"[WARMUP] Worker listo: {result}")
+    return result
+
+def shutdown_worker(timeout: float = 10):
+    """Para los hilos de fondo del proceso (colas, dispatcher, refrescos) antes de salir."""
+    company_cache.stop_background_refresh()
+    if webhook_ingest_queue is not None:
+        webhook_ingest_queue.stop(timeout)
+    if async_core is not None:
+        async_core.stop(timeout)
+    if outbound_dispatcher is not None:
+        outbound_dispatcher.stop()
+    if flow_exit_outbox is not None:
+        flow_exit_outbox.stop()
+    if scheduler_outbox is not None:
+        scheduler_outbox.stop(timeout)
+    worker_state.close()
+    graph_http.close()
+
 def start_http_server():
     app.run(host=config.server_config['host'], port=config.server_config['http_port'], debug=False)
 
@@ -12,7 +12,9 @@ import time
 from uuid import uuid4
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
+import threading
 from threading import Thread
+from contextlib import contextmanager
 from functools import wraps
 from urllib.parse import urlparse, urlunparse
 from flask import Flask, request, jsonify
@@ -1188,8 +1190,7 @@ class Config:
         # Precargar configs si es la primera instancia
         global company_cache
         if not company_cache._last_reload:
-            db_manager = DatabaseManager(self.db_config)
-            company_cache.preload_all_companies(db_manager)
+            company_cache.preload_all_companies(get_db_manager(self.db_config))
         
         # Si hay company_id, cargar de caché
         if self.company_id:
@@ -1412,6 +1413,12 @@ class Config:
             'user': db_cfg.get('DB_USER'),
             'password': db_cfg.get('DB_PASS'),
             'search_path': db_cfg.get('DB_SEARCH_PATH', None),
+            # Pool de conexiones
+            'pool_min_size': int(db_cfg.get('DB_POOL_MIN_SIZE', '1')),
+            'pool_max_size': int(db_cfg.get('DB_POOL_MAX_SIZE', '10')),
+            'pool_idle_timeout': int(db_cfg.get('DB_POOL_IDLE_TIMEOUT', '300')),
+            'pool_checkout_timeout': int(db_cfg.get('DB_POOL_CHECKOUT_TIMEOUT', '10')),
+            'pool_health_check_interval': int(db_cfg.get('DB_POOL_HEALTH_CHECK_INTERVAL', '30')),
         }
         missing = [k for k, v in self.db_config.items() if k != 'search_path' and v in (None, '')]
         if missing:
@@ -1563,13 +1570,178 @@ class Config:
         except Exception:
             logging.exception("[Config] No se pudo loguear flow_config")
 
+class ConnectionPool:
+    """
+    Pool de conexiones pg8000 thread-safe.
+    - min_size/max_size: conexiones físicas que se mantienen / máximo abierto.
+    - Health check (SELECT 1) al hacer checkout si la conexión lleva ociosa más de health_check_interval.
+    - Las conexiones ociosas más de idle_timeout se cierran (respetando min_size).
+    """
+    def __init__(self, connect_fn, min_size=1, max_size=10, idle_timeout=300,
+                 checkout_timeout=10, health_check_interval=30):
+        self._connect = connect_fn
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size), self.min_size)
+        self.idle_timeout = float(idle_timeout)
+        self.checkout_timeout = float(checkout_timeout)
+        self.health_check_interval = float(health_check_interval)
+
+        self._cond = threading.Condition()
+        self._idle = []      # [(conn, last_used_monotonic)] LIFO
+        self._size = 0       # conexiones físicas abiertas (incluye las que se están creando)
+        self._in_use = 0
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+        }
+
+    def acquire(self):
+        """Obtiene una conexión del pool (bloquea hasta checkout_timeout si está lleno)"""
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        waited = False
+
+        while True:
+            conn, last_used, to_close = None, None, []
+            with self._cond:
+                to_close = self._evict_idle_locked()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise TimeoutError(
+                            f"DB pool exhausted: {self._size}/{self.max_size} in use after {self.checkout_timeout}s"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1  # reservamos el hueco antes de conectar fuera del lock
+
+            self._close_all(to_close)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+            elif time.monotonic() - last_used >= self.health_check_interval and not self._is_healthy(conn):
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                    self._stats['wait_time_ms'] += (time.monotonic() - start) * 1000
+            return conn
+
+    def release(self, conn, discard=False):
+        """Devuelve la conexión al pool (o la cierra si está rota)"""
+        with self._cond:
+            self._in_use -= 1
+        if discard:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            to_close = self._evict_idle_locked()
+            self._cond.notify()
+        self._close_all(to_close)
+
+    def stats(self) -> dict:
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                **self._stats,
+                'wait_time_ms': round(self._stats['wait_time_ms'], 2),
+                'avg_wait_ms': round(self._stats['wait_time_ms'] / self._stats['waits'], 2) if self._stats['waits'] else 0.0,
+                'reuse_ratio': round(1 - self._stats['created'] / checkouts, 4) if checkouts else 0.0,
+            }
+
+    def close(self):
+        """Cierra todas las conexiones ociosas"""
+        with self._cond:
+            to_close = [c for c, _ in self._idle]
+            self._idle = []
+            self._size -= len(to_close)
+            self._cond.notify_all()
+        self._close_all(to_close)
+
+    def _evict_idle_locked(self) -> list:
+        """Saca del pool las conexiones ociosas caducadas (llamar con el lock cogido)"""
+        if not self._idle or self.idle_timeout <= 0:
+            return []
+        now = time.monotonic()
+        evicted = []
+        # _idle es LIFO: las más antiguas están al principio
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            evicted.append(self._idle.pop(0)[0])
+            self._size -= 1
+        return evicted
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.warning(f"[DB POOL] Health check failed, discarding connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close_all([conn])
+
+    def _close_all(self, conns):
+        for c in conns:
+            try:
+                c.close()
+            except Exception:
+                pass
+            with self._cond:
+                self._stats['closed'] += 1
+
+
 class DatabaseManager:
     """Database operations manager"""
     def __init__(self, db_config):
         self.db_config = db_config
+        self.pool = ConnectionPool(
+            self._connect,
+            min_size=db_config.get('pool_min_size', 1),
+            max_size=db_config.get('pool_max_size', 10),
+            idle_timeout=db_config.get('pool_idle_timeout', 300),
+            checkout_timeout=db_config.get('pool_checkout_timeout', 10),
+            health_check_interval=db_config.get('pool_health_check_interval', 30),
+        )
+        self._local = threading.local()  # unit of work activo por hilo
 
-    def get_connection(self):
-        """Get database connection with retry logic"""
+    def _connect(self):
+        """Open a physical connection with retry logic (session setup runs once per connection)"""
         max_retries = 3
         for attempt in range(max_retries):
             try:
@@ -1601,6 +1773,115 @@ class DatabaseManager:
                     raise
                 time.sleep(1)
 
+    @contextmanager
+    def get_connection(self):
+        """
+        Checkout de una conexión del pool. Uso: `with db_manager.get_connection() as conn:`
+        Al salir la conexión vuelve al pool (rollback si quedó una transacción abierta).
+        Dentro de un unit_of_work() devuelve la conexión de la unidad de trabajo.
+        """
+        uow = getattr(self._local, 'uow', None)
+        if uow is not None:
+            yield uow['conn']
+            return
+
+        conn = self.pool.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            if not broken and getattr(conn, 'in_transaction', True):
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            self.pool.release(conn, discard=broken)
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Agrupa todas las execute_query del hilo actual en una sola conexión y una sola transacción.
+
+            with db_manager.unit_of_work():
+                lead = lead_service.get_lead_data_by_phone(phone)
+                message_service.save_incoming_message(msg, wa_id)
+
+        - Commit único al salir; rollback completo si sale una excepción.
+        - Tras cada escritura se marca un SAVEPOINT: si una consulta posterior falla (y el
+          llamador captura la excepción), se vuelve al último savepoint en lugar de perder
+          las escrituras anteriores o dejar la transacción abortada.
+        - Anidable: un unit_of_work() interno reutiliza la transacción exterior.
+        - on_commit(fn): efectos en memoria (dedupe, índices) solo si la transacción se confirma.
+        - No meter HTTP dentro: la conexión queda "idle in transaction" mientras dura.
+        """
+        if getattr(self._local, 'uow', None) is not None:
+            yield self._local.uow['conn']
+            return
+
+        start = time.time()
+        conn = self.pool.acquire()
+        uow = {'conn': conn, 'savepoint': False, 'statements': 0, 'on_commit': []}
+        self._local.uow = uow
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self._local.uow = None
+            self.pool.release(conn, discard=broken)
+            logging.debug({
+                'event': 'db.uow.done',
+                'elapsed_ms': int((time.time() - start) * 1000),
+                'statements': uow['statements']
+            })
+        for fn in uow['on_commit']:
+            try:
+                fn()
+            except Exception:
+                logging.exception("[DB] on_commit callback failed")
+
+    def on_commit(self, fn):
+        """Ejecuta fn tras el commit del unit_of_work activo; sin unit of work, en el acto."""
+        uow = getattr(self._local, 'uow', None)
+        if uow is None:
+            fn()
+            return
+        uow['on_commit'].append(fn)
+
+    def _mark_savepoint(self, conn, uow, query):
+        """SAVEPOINT tras cada sentencia que puede escribir (INSERT ... RETURNING incluido)"""
+        if (query or '').lstrip()[:6].lower() == 'select':
+            return
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT uow_sp")
+        uow['savepoint'] = True
+
+    def _recover_unit_of_work(self, conn, uow):
+        """Deja la transacción del unit of work usable tras un error de sentencia"""
+        try:
+            if uow['savepoint']:
+                with conn.cursor() as cur:
+                    cur.execute("ROLLBACK TO SAVEPOINT uow_sp")
+            else:
+                conn.rollback()
+        except Exception:
+            logging.exception("[DB] unit of work recovery failed")
+
+    def pool_stats(self) -> dict:
+        return self.pool.stats()
+
     def execute_query(self, query, params=None, fetch_one=False, fetch_all=False):
         """
         Ejecuta una consulta con logging robusto y manejo opcional de escritura deshabilitada.
@@ -1625,6 +1906,7 @@ class DatabaseManager:
                 })
                 return 0
 
+            uow = getattr(self._local, 'uow', None)
             with self.get_connection() as conn:
                 with conn.cursor() as cur:
                     logging.debug({
@@ -1632,14 +1914,26 @@ class DatabaseManager:
                         'query_preview': q_preview,
                         'params_type': type(params).__name__,
                         'fetch_one': fetch_one,
-                        'fetch_all': fetch_all
+                        'fetch_all': fetch_all,
+                        'unit_of_work': uow is not None
                     })
 
-                    cur.execute(query, params)
+                    try:
+                        cur.execute(query, params)
+                    except Exception:
+                        if uow is not None:
+                            self._recover_unit_of_work(conn, uow)
+                        raise
+
+                    if uow is not None:
+                        uow['statements'] += 1
 
                     if fetch_one:
                         row = cur.fetchone()
-                        conn.commit()
+                        if uow is None:
+                            conn.commit()
+                        else:
+                            self._mark_savepoint(conn, uow, query)
                         logging.debug({
                             'event': 'db.execute.done',
                             'elapsed_ms': int((time.time() - start) * 1000),
@@ -1650,7 +1944,10 @@ class DatabaseManager:
 
                     if fetch_all:
                         rows = cur.fetchall()
-                        conn.commit()
+                        if uow is None:
+                            conn.commit()
+                        else:
+                            self._mark_savepoint(conn, uow, query)
                         logging.debug({
                             'event': 'db.execute.done',
                             'elapsed_ms': int((time.time() - start) * 1000),
@@ -1660,7 +1957,10 @@ class DatabaseManager:
                         return rows
 
                     affected_rows = cur.rowcount
-                    conn.commit()
+                    if uow is None:
+                        conn.commit()
+                    else:
+                        self._mark_savepoint(conn, uow, query)
                     logging.info({
                         'event': 'db.execute.done',
                         'elapsed_ms': int((time.time() - start) * 1000),
@@ -1674,6 +1974,20 @@ class DatabaseManager:
             raise
 
 
+db_manager = None
+
+
+def get_db_manager(db_config=None):
+    """
+    DatabaseManager del proceso (un único pool de conexiones). Se crea con db_config la primera
+    vez; Config, el preload y los endpoints lo reutilizan en vez de abrir un pool propio.
+    """
+    global db_manager
+    if db_manager is None:
+        db_manager = DatabaseManager(db_config)
+    return db_manager
+
+
 class PhoneUtils:
     """Phone number utilities"""
     @staticmethod
@@ -3737,8 +4051,8 @@ if supabase_client:
         temp_config_obj = Config(company_id=None, supabase_client=supabase_client)
         logger.info("[PRELOAD] Temporary Config object created successfully")
         logger.debug(f"[PRELOAD] temp_config_obj.whatsapp_config: {getattr(temp_config_obj, 'whatsapp_config', None)}")
-        db_manager_for_cache = DatabaseManager(temp_config_obj.db_config)
-        logger.info("[PRELOAD] DatabaseManager for cache created")
+        db_manager_for_cache = get_db_manager(temp_config_obj.db_config)
+        logger.info("[PRELOAD] Shared DatabaseManager ready for cache")
         company_cache.preload_all_companies(db_manager_for_cache)
         logger.info("[PRELOAD] Finished preload_all_companies")
     except Exception as e:
@@ -3830,7 +4144,7 @@ logger.info(f"   • BASE_URL: {WHATSAPP_BASE_URL}")
 logger.info(f"   • HTTP Port: {config.server_config['http_port']}")
 logger.info(f"   • HTTPS Port: {config.server_config['https_port']}")
 
-db_manager = DatabaseManager(config.db_config)
+db_manager = get_db_manager(config.db_config)
 lead_service = LeadService(db_manager)
 message_service = MessageService(db_manager, lead_service)
 whatsapp_service = WhatsAppService(config)
@@ -4414,6 +4728,15 @@ def config_debug():
         'services_initialized': True
     }), 200
 
+@app.route('/db_pool_stats', methods=['GET'])
+def db_pool_stats():
+    """Métricas del pool de conexiones a BD"""
+    return jsonify({
+        'status': 'ok',
+        'timestamp': now_madrid().isoformat(),
+        'pool': db_manager.pool_stats()
+    }), 200
+
 @app.route('/send_message', methods=['POST'])
 @rate_limit(max_calls=30, window=60)
 def send_direct_message():
@@ -4912,6 +5235,92 @@ import json, re
 # Acepta UUID con guiones (validación rápida; Flask también tiene converter uuid, pero así no rompes nada)
 UUID_RE = re.compile(r"^[0-9a-fA-F-]{36}$")
 
+def flow_exit_target_for_reply(sender_phone: str, context_id: str | None, company_id: str):
+    """
+    Solo consultas de BD (va dentro del unit of work del webhook). Devuelve (target, ya_disparado):
+    target = (lead_id, context_id) si hay que mandar el exit al scheduler, o None.
+    """
+    if not context_id:
+        query_last_template = """
+            SELECT last_message_uid
+              FROM public.external_messages
+             WHERE sender_phone = %s
+               AND company_id   = %s
+               AND from_me      = 'true'
+               AND status       = 'template_sent'
+               AND created_at   > %s
+               AND last_message_uid IS NOT NULL
+             ORDER BY created_at DESC
+             LIMIT 1
+        """
+        umbral = now_madrid_naive() - timedelta(minutes=15)
+        row = db_manager.execute_query(
+            query_last_template, [sender_phone, company_id, umbral], fetch_one=True
+        )
+        if not row or not row[0]:
+            return None, False
+        context_id = row[0]
+
+    chk_template = """
+        SELECT 1
+          FROM public.external_messages
+         WHERE last_message_uid = %s
+           AND company_id       = %s
+           AND status           = 'template_sent'
+         LIMIT 1
+    """
+    if not db_manager.execute_query(chk_template, [context_id, company_id], fetch_one=True):
+        return None, False
+
+    chk_dedup = """
+        SELECT 1
+          FROM public.external_messages
+         WHERE last_message_uid = %s
+           AND sender_phone     = %s
+           AND company_id       = %s
+           AND status           = 'flow_exit_triggered'
+         LIMIT 1
+    """
+    if db_manager.execute_query(chk_dedup, [context_id, sender_phone, company_id], fetch_one=True):
+        return None, True
+
+    lead = lead_service.get_lead_data_by_phone(sender_phone)
+    if not lead or not lead.get('lead_id'):
+        return None, False
+    return (lead['lead_id'], context_id), False
+
+
+def mark_flow_exit_triggered(context_id: str, sender_phone: str, company_id: str):
+    """Marcador 'flow_exit_triggered' tras el POST al scheduler (fuera del unit of work: commit inmediato)."""
+    flow_name = "welcome_email_flow"
+    motivo = "Usuario quiere salir del flow"
+    exit_message = f"Exit Flow: {flow_name} por: {motivo}"
+
+    # MINIMO: añadir company_id al INSERT
+    mark_sql = """
+        INSERT INTO public.external_messages (
+            id, message, sender_phone, responsible_email,
+            last_message_uid, last_message_timestamp,
+            from_me, status, created_at, updated_at, is_deleted,
+            chat_id, chat_url, assigned_to_id, company_id
+        ) VALUES (
+            %s, %s, %s, %s,
+            %s, %s,
+            %s, %s, NOW(), NOW(), FALSE,
+            %s, %s, %s, %s
+        )
+    """
+    params = [
+        str(uuid4()),
+        json.dumps({'text': exit_message}, ensure_ascii=False),
+        sender_phone, '', context_id, now_madrid_naive(),
+        'true', 'flow_exit_triggered',
+        sender_phone, sender_phone, None,
+        company_id
+    ]
+    db_manager.execute_query(mark_sql, params)
+
+
 @app.route('/<company_id>/webhook', methods=['GET', 'POST'], strict_slashes=False)
 def webhook_company(company_id):
     # --- Validación de ruta ---
@@ -4954,123 +5363,34 @@ def webhook_company(company_id):
                         # -------- MENSAJES DE TEXTO --------
                         if msg.get('type') == 'text':
                             log_received_message(msg, wa_id)
-                            # MINIMO: pasar company_id (haz que el método lo acepte como opcional)
-                            try:
-                                message_service.save_incoming_message(msg, wa_id, company_id=company_id)
-                            except TypeError:
-                                # compat si aún no acepta el parámetro
-                                message_service.save_incoming_message(msg, wa_id)
-
-                            # Flow EXIT logic (con filtro por tenant)
-                            try:
-                                context = msg.get('context') or {}
-                                context_id = context.get('id')
-                                madrid_ahora = now_madrid_naive()
-
-                                if not context_id:
-                                    query_last_template = """
-                                        SELECT last_message_uid
-                                          FROM public.external_messages
-                                         WHERE sender_phone = %s
-                                           AND company_id   = %s
-                                           AND from_me      = 'true'
-                                           AND status       = 'template_sent'
-                                           AND created_at   > %s
-                                           AND last_message_uid IS NOT NULL
-                                         ORDER BY created_at DESC
-                                         LIMIT 1
-                                    """
-                                    umbral = madrid_ahora - timedelta(minutes=15)
-                                    row = db_manager.execute_query(
-                                        query_last_template, [sender_phone, company_id, umbral], fetch_one=True
-                                    )
-                                    if row and row[0]:
-                                        context_id = row[0]
-                                    else:
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service
-                                            )
-                                        continue
-
-                                if context_id:
-                                    chk_template = """
-                                        SELECT 1
-                                          FROM public.external_messages
-                                         WHERE last_message_uid = %s
-                                           AND company_id       = %s
-                                           AND status           = 'template_sent'
-                                         LIMIT 1
-                                    """
-                                    ok_template = db_manager.execute_query(
-                                        chk_template, [context_id, company_id], fetch_one=True
-                                    )
-                                    if not ok_template:
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service
-                                            )
-                                        continue
+                            # Solo BD dentro del unit of work; el POST al scheduler y el auto-reply van tras el commit
+                            exit_target, exit_already_triggered = None, False
+                            with db_manager.unit_of_work():
+                                # MINIMO: pasar company_id (haz que el método lo acepte como opcional)
+                                try:
+                                    message_service.save_incoming_message(msg, wa_id, company_id=company_id)
+                                except TypeError:
+                                    # compat si aún no acepta el parámetro
+                                    message_service.save_incoming_message(msg, wa_id)
 
-                                    chk_dedup = """
-                                        SELECT 1
-                                          FROM public.external_messages
-                                         WHERE last_message_uid = %s
-                                           AND sender_phone     = %s
-                                           AND company_id       = %s
-                                           AND status           = 'flow_exit_triggered'
-                                         LIMIT 1
-                                    """
-                                    ya_triggered = db_manager.execute_query(
-                                        chk_dedup, [context_id, sender_phone, company_id], fetch_one=True
+                                # Flow EXIT logic (con filtro por tenant)
+                                try:
+                                    exit_target, exit_already_triggered = flow_exit_target_for_reply(
+                                        sender_phone, (msg.get('context') or {}).get('id'), company_id
                                     )
-                                    if ya_triggered:
-                                        continue
-
-                                    lead = lead_service.get_lead_data_by_phone(sender_phone)
-                                    if not lead or not lead.get('lead_id'):
-                                        if not auto_reply_service.is_office_hours():
-                                            auto_reply_service.send_auto_reply(
-                                                sender_phone, whatsapp_service, message_service
-                                            )
-                                        continue
-
-                                    lead_id = lead['lead_id']
-                                    ok = flow_exit_client.send_exit(lead_id)
-                                    if ok:
-                                        flow_name = "welcome_email_flow"
-                                        motivo = "Usuario quiere salir del flow"
-                                        exit_message = f"Exit Flow: {flow_name} por: {motivo}"
-
-                                        # MINIMO: añadir company_id al INSERT
-                                        mark_sql = """
-                                            INSERT INTO public.external_messages (
-                                                id, message, sender_phone, responsible_email,
-                                                last_message_uid, last_message_timestamp,
-                                                from_me, status, created_at, updated_at, is_deleted,
-                                                chat_id, chat_url, assigned_to_id, company_id
-                                            ) VALUES (
-                                                %s, %s, %s, %s,
-                                                %s, %s,
-                                                %s, %s, NOW(), NOW(), FALSE,
-                                                %s, %s, %s, %s
-                                            )
-                                        """
-                                        params = [
-                                            str(uuid4()),
-                                            json.dumps({'text': exit_message}, ensure_ascii=False),
-                                            sender_phone, '', context_id, madrid_ahora,
-                                            'true', 'flow_exit_triggered',
-                                            sender_phone, sender_phone, None,
-                                            company_id
-                                        ]
-                                        db_manager.execute_query(mark_sql, params)
+                                except Exception:
+                                    logger.exception(f"[{company_id}] Error procesando disparo de flow exit")
 
-                            except Exception:
-                                logger.exception(f"[{company_id}] Error procesando disparo de flow exit")
+                            if exit_target:
+                                try:
+                                    lead_id, context_id = exit_target
+                                    if flow_exit_client.send_exit(lead_id):
+                                        mark_flow_exit_triggered(context_id, sender_phone, company_id)
+                                except Exception:
+                                    logger.exception(f"[{company_id}] Error procesando disparo de flow exit")
 
                             # Auto-reply si es fuera de horario
-                            if not auto_reply_service.is_office_hours():
+                            if not exit_already_triggered and not auto_reply_service.is_office_hours():
                                 auto_reply_service.send_auto_reply(
                                     sender_phone, whatsapp_service, message_service
                                 )
@@ -5204,7 +5524,8 @@ def webhook_company(company_id):
                 # -------- ESTADOS DE MENSAJE --------
                 elif 'statuses' in value:
                     # (mínimo: lo dejamos igual; si tu handler soporta company_id, pásaselo)
-                    handle_message_statuses_webhook(value, db_manager)
+                    with db_manager.unit_of_work():
+                        handle_message_statuses_webhook(value, db_manager)
 
                 # -------- LLAMADAS (CALLS) --------
                 elif 'calls' in value:
@@ -6681,16 +7002,12 @@ def _now():
     return datetime.now(TZ)
 
 def _get_cfg_db():
-    global config, db
+    global config
     try:
         cfg = config
     except NameError:
         cfg = Config()
-    try:
-        dbm = db
-    except NameError:
-        dbm = DatabaseManager(cfg.db_config)
-    return cfg, dbm
+    return cfg, get_db_manager(cfg.db_config)
 
 def _normalize_phone_candidates(phone: str | None) -> list[str]:
     if not phone:
@@ -0,0 +1,329 @@
+"""
+Núcleo asyncio para procesar eventos de webhook y llamadas salientes.
+
+Un único event loop en un hilo propio mantiene cientos de eventos en vuelo:
+- submit(coro) / submit_blocking(fn, ...) desde cualquier hilo (p.ej. los de Flask),
+  con un límite global de eventos en vuelo (backpressure).
+- AsyncDatabase: wrapper async sobre el pool pg8000 existente; las queries bloqueantes van a
+  un executor del tamaño del pool, así nunca hay más queries concurrentes que conexiones.
+- AsyncHttpClient: httpx.AsyncClient (HTTP/2 opcional) para Graph; sin httpx delega en el
+  cliente HTTP compartido en el executor.
+
+Flask sigue siendo el frontal: los endpoints encolan y el core procesa.
+
+Benchmark (modelo de hilos vs core asyncio, I/O simulado; un unit of work = una conexión por evento):
+    python async_core.py --events 2000 --db-ms 15 --graph-ms 120 --db-pool 10
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import httpx
+except ImportError:  # el cliente async es opcional
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase:
+    """Fachada async de DatabaseManager.execute_query / unit_of_work sobre un executor acotado."""
+
+    def __init__(self, db_manager, max_concurrency: int = None):
+        self.db_manager = db_manager
+        pool = getattr(db_manager, 'pool', None)
+        self.max_concurrency = max_concurrency or getattr(pool, 'max_size', 10)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='async-db')
+
+    async def execute_query(self, query, params=None, fetch_one=False, fetch_all=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            lambda: self.db_manager.execute_query(query, params, fetch_one=fetch_one, fetch_all=fetch_all)
+        )
+
+    async def run(self, fn, *args, **kwargs):
+        """Ejecuta fn(*args) (p.ej. varias queries dentro de un unit_of_work) en el executor de BD."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class AsyncHttpClient:
+    """get/post async. Con httpx usa un AsyncClient keep-alive; si no, el cliente síncrono en executor."""
+
+    def __init__(self, sync_client=None, http2: bool = False, max_connections: int = 200, timeout=(5, 30)):
+        self.sync_client = sync_client
+        self.timeout = timeout
+        self._client = None
+        self._executor = None
+        if httpx is not None:
+            try:
+                self._client = httpx.AsyncClient(
+                    http2=http2,
+                    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                    timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+                )
+            except ImportError:  # http2=True sin h2
+                self._client = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                    timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+                )
+        if self._client is None:
+            if sync_client is None:
+                raise RuntimeError("AsyncHttpClient necesita httpx o un cliente síncrono")
+            self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='async-http')
+
+    @property
+    def native(self) -> bool:
+        return self._client is not None
+
+    async def request(self, method: str, url: str, **kwargs):
+        if self._client is not None:
+            return await self._client.request(method, url, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self.sync_client.request(method, url, **kwargs)
+        )
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class AsyncEventCore:
+    """
+    Event loop en un hilo dedicado con límite de eventos en vuelo.
+    Los handlers pueden ser corrutinas (I/O con core.db / core.http) o funciones bloqueantes,
+    que se ejecutan en un executor acotado al mismo límite.
+    """
+
+    def __init__(self, max_in_flight: int = 256, blocking_workers: int = None, name: str = 'async-core'):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.blocking_workers = blocking_workers or self.max_in_flight
+        self.name = name
+        self.loop = None
+        self.db = None
+        self.http = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._slots = None
+        self._blocking = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'busy_ms': 0.0}
+        self._peak_in_flight = 0
+
+    # ---------- Ciclo de vida ----------
+    def start(self, db_manager=None, sync_http=None, http2: bool = False):
+        if self._thread is not None:
+            return self
+        self._blocking = ThreadPoolExecutor(max_workers=self.blocking_workers, thread_name_prefix=f'{self.name}-blk')
+        if db_manager is not None:
+            self.db = AsyncDatabase(db_manager)
+        self._thread = threading.Thread(target=self._run, args=(sync_http, http2), name=self.name, daemon=True)
+        self._thread.start()
+        self._ready.wait(10)
+        logger.info(f"[ASYNC CORE] Iniciado: max_in_flight={self.max_in_flight} "
+                    f"http={'httpx' if self.http and self.http.native else 'executor'}")
+        return self
+
+    def _run(self, sync_http, http2):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        if sync_http is not None or httpx is not None:
+            self.http = AsyncHttpClient(sync_client=sync_http, http2=http2, max_connections=self.max_in_flight)
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self, timeout: float = 10):
+        if self.loop is None:
+            return
+        if self.http is not None:
+            asyncio.run_coroutine_threadsafe(self.http.aclose(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._blocking.shutdown(wait=False)
+        if self.db is not None:
+            self.db.close()
+        self._thread = None
+        self.loop = None
+
+    # ---------- Envío de trabajo ----------
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def has_capacity(self) -> bool:
+        return self._in_flight < self.max_in_flight
+
+    def submit(self, coro_fn, *args, **kwargs):
+        """Programa coro_fn(*args) en el loop. Devuelve concurrent.futures.Future."""
+        with self._lock:
+            self._in_flight += 1
+            self._stats['submitted'] += 1
+            if self._in_flight > self._peak_in_flight:
+                self._peak_in_flight = self._in_flight
+        return asyncio.run_coroutine_threadsafe(self._guarded(coro_fn, args, kwargs), self.loop)
+
+    def submit_blocking(self, fn, *args, **kwargs):
+        """Igual que submit() para una función bloqueante (código síncrono existente)."""
+        async def _call():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._blocking, lambda: fn(*args, **kwargs))
+        return self.submit(_call)
+
+    async def _guarded(self, coro_fn, args, kwargs):
+        async with self._slots:
+            t0 = time.perf_counter()
+            ok = False
+            try:
+                result = await coro_fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._stats['completed' if ok else 'failed'] += 1
+                    self._stats['busy_ms'] += (time.perf_counter() - t0) * 1000
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self._stats['completed'] + self._stats['failed']
+            return {
+                'running': self.loop is not None,
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self._in_flight,
+                'peak_in_flight': self._peak_in_flight,
+                'submitted': self._stats['submitted'],
+                'completed': self._stats['completed'],
+                'failed': self._stats['failed'],
+                'avg_event_ms': round(self._stats['busy_ms'] / done, 1) if done else None,
+                'http_backend': ('httpx' if self.http.native else 'executor') if self.http else None,
+                'db_concurrency': self.db.max_concurrency if self.db else None,
+            }
+
+
+# ---------------------------------------------------------------------------
+# Benchmark: eventos/s del modelo de hilos actual vs el core asyncio
+# ---------------------------------------------------------------------------
+def _benchmark(events: int, db_ms: float, graph_ms: float, threads: int, in_flight: int, db_pool: int,
+               async_in_flight: int):
+    class _FakeDB:
+        """pg8000 simulado: max_size conexiones; un unit_of_work retiene la suya hasta el commit."""
+        def __init__(self, size):
+            self.pool = type('P', (), {'max_size': size})()
+            self._sem = threading.BoundedSemaphore(size)
+            self._local = threading.local()
+
+        @contextmanager
+        def unit_of_work(self):
+            with self._sem:
+                self._local.uow = True
+                try:
+                    yield
+                finally:
+                    self._local.uow = False
+
+        def execute_query(self, query, params=None, fetch_one=False, fetch_all=False):
+            if getattr(self._local, 'uow', False):
+                time.sleep(db_ms / 1000)
+                return None
+            with self._sem:
+                time.sleep(db_ms / 1000)
+            return None
+
+    db = _FakeDB(db_pool)
+
+    def _db_part():
+        # lead lookup + insert del mensaje, en el unit of work del evento (una conexión)
+        with db.unit_of_work():
+            db.execute_query("SELECT 1")
+            db.execute_query("INSERT 1")
+
+    def sync_event():
+        _db_part()
+        time.sleep(graph_ms / 1000)   # Graph (auto-reply / media) tras el commit
+
+    def run_threaded():
+        done = threading.Semaphore(0)
+        queue = list(range(events))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    queue.pop()
+                sync_event()
+                done.release()
+
+        t0 = time.perf_counter()
+        ws = [threading.Thread(target=worker) for _ in range(threads)]
+        for w in ws:
+            w.start()
+        for w in ws:
+            w.join()
+        return time.perf_counter() - t0
+
+    def run_core(native: bool, max_in_flight: int):
+        core = AsyncEventCore(max_in_flight=max_in_flight).start(db_manager=db)
+
+        async def async_event():
+            await core.db.run(_db_part)
+            await asyncio.sleep(graph_ms / 1000)   # httpx.AsyncClient: no ocupa hilo
+
+        t0 = time.perf_counter()
+        futures = [core.submit(async_event) if native else core.submit_blocking(sync_event) for _ in range(events)]
+        for f in futures:
+            f.result()
+        elapsed = time.perf_counter() - t0
+        core.stop()
+        return elapsed
+
+    # Como en CloudAPI2 ([INGEST] mode=async): MAX_IN_FLIGHT nunca pasa de DB_POOL_MAX_SIZE
+    shipped_in_flight = min(in_flight or db_pool, db_pool)
+    print(f"events={events} db={db_ms}ms x2 en un unit of work (pool={db_pool}) graph={graph_ms}ms")
+    for label, fn in (
+        (f"threaded ({threads} workers)", run_threaded),
+        (f"async core, handler síncrono (in_flight={shipped_in_flight}, producción)",
+         lambda: run_core(False, shipped_in_flight)),
+        (f"async core, handler async (in_flight={async_in_flight}, no en producción)",
+         lambda: run_core(True, async_in_flight)),
+    ):
+        elapsed = fn()
+        print(f"{label:65} {events / elapsed:9.1f} events/s  ({elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark eventos/s: hilos vs core asyncio")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--db-ms", type=float, default=15.0)
+    parser.add_argument("--graph-ms", type=float, default=120.0)
+    parser.add_argument("--threads", type=int, default=4, help="workers del modelo actual ([INGEST] workers)")
+    parser.add_argument("--in-flight", type=int, default=None,
+                        help="[INGEST] MAX_IN_FLIGHT (por defecto y como máximo, --db-pool)")
+    parser.add_argument("--db-pool", type=int, default=10)
+    parser.add_argument("--async-in-flight", type=int, default=256,
+                        help="en vuelo con handlers async (core.db/core.http), aún no usados en producción")
+    a = parser.parse_args()
+    _benchmark(a.events, a.db_ms, a.graph_ms, a.threads, a.in_flight, a.db_pool, a.async_in_flight)
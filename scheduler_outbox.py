@@ -0,0 +1,482 @@
+"""
+Outbox transaccional compartido para las llamadas al scheduler (flow-exit, customer journey).
+
+En vez de hacer el POST dentro de la petición (si falla se pierde, si tarda bloquea), se guarda
+una fila en public.scheduler_outbox EN LA MISMA TRANSACCIÓN que el cambio que la provoca
+(p.ej. el marcador 'flow_exit_triggered'). Un hilo la drena después:
+- Lotes: reserva hasta batch_size filas con FOR UPDATE SKIP LOCKED (varios procesos/workers a la vez).
+- Backoff exponencial con jitter entre intentos; lease: una fila 'sending' de un proceso caído se retoma.
+  Mientras un lote está en vuelo se renueva el lease de sus filas pendientes (cada lease_timeout/3),
+  y el resultado solo se escribe en las filas que este worker sigue teniendo reservadas.
+- dedupe_key UNIQUE: el mismo evento no se encola dos veces.
+- Dead-letter: tras max_attempts (o un error permanente) la fila queda en status='dead';
+  requeue_dead() la vuelve a poner en cola.
+- Cada servicio registra los "kinds" que sabe enviar y solo drena esos.
+
+Senders: fn(payload: dict) -> bool. True = enviado; False o excepción = reintento;
+OutboxPermanentError = directo a dead-letter.
+
+Scheduler de pruebas (responde 200 / fallos / latencia configurables):
+    python scheduler_outbox.py stub --port 5199 --fail-rate 0.3 --latency-ms 200
+"""
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS public.scheduler_outbox (
+        id           BIGSERIAL PRIMARY KEY,
+        kind         TEXT NOT NULL,
+        dedupe_key   TEXT UNIQUE,
+        payload      JSONB NOT NULL,
+        status       TEXT NOT NULL DEFAULT 'pending',
+        attempts     INTEGER NOT NULL DEFAULT 0,
+        available_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        claimed_at   TIMESTAMPTZ,
+        claimed_by   TEXT,
+        last_error   TEXT,
+        created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        sent_at      TIMESTAMPTZ
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_scheduler_outbox_ready
+        ON public.scheduler_outbox (kind, status, available_at)
+        WHERE status IN ('pending', 'sending')
+    """,
+)
+
+
+class OutboxPermanentError(Exception):
+    """El evento no se puede entregar nunca (p.ej. 4xx del scheduler): va a dead-letter sin reintentos."""
+
+
+ENQUEUE_SQL = """
+    INSERT INTO public.scheduler_outbox (kind, dedupe_key, payload, available_at)
+    VALUES (%s, %s, CAST(%s AS JSONB), NOW() + make_interval(secs => %s))
+    ON CONFLICT (dedupe_key) DO NOTHING
+    RETURNING id
+"""
+
+
+def enqueue_params(kind: str, payload: dict, dedupe_key: str = None, delay: float = 0) -> tuple:
+    """Parámetros de ENQUEUE_SQL, para encolar con el ejecutor del llamador (p.ej. DatabaseManager.execute_query)."""
+    return (kind, dedupe_key, json.dumps(payload, ensure_ascii=False, default=str), float(delay))
+
+
+def enqueue(conn, kind: str, payload: dict, dedupe_key: str = None, delay: float = 0) -> bool:
+    """
+    Inserta el evento usando la conexión (y transacción) del llamador; el commit es suyo.
+    Devuelve False si ya existía un evento con el mismo dedupe_key.
+    """
+    with conn.cursor() as cur:
+        cur.execute(ENQUEUE_SQL, enqueue_params(kind, payload, dedupe_key, delay))
+        return cur.fetchone() is not None
+
+
+def http_json_sender(http, url: str, headers: dict = None, timeout: float = 10):
+    """
+    Sender genérico: POST JSON a url. 2xx = enviado; 408/429/5xx/red = reintento;
+    resto de 4xx = OutboxPermanentError.
+    """
+    def _send(payload: dict) -> bool:
+        resp = http.post(url, json=payload, headers=headers or {}, timeout=timeout)
+        if 200 <= resp.status_code < 300:
+            return True
+        detail = f"HTTP {resp.status_code}: {(resp.text or '')[:300]}"
+        if 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+            raise OutboxPermanentError(detail)
+        raise RuntimeError(detail)
+    return _send
+
+
+class SchedulerOutbox:
+    """
+    Drena public.scheduler_outbox para los kinds registrados.
+    connect(): abre una conexión DB-API nueva (el worker mantiene una propia y la rehace si se rompe).
+    """
+
+    def __init__(self, connect, senders: dict = None, batch_size: int = 50, concurrency: int = 4,
+                 max_attempts: int = 8, base_backoff: float = 5.0, max_backoff: float = 900.0,
+                 lease_timeout: int = 120, poll_interval: float = 1.0, retention_days: int = 7,
+                 name: str = 'scheduler-outbox'):
+        self.connect = connect
+        self.senders = dict(senders or {})
+        self.batch_size = max(1, int(batch_size))
+        self.concurrency = max(1, int(concurrency))
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_timeout = int(lease_timeout)
+        self.poll_interval = poll_interval
+        self.retention_days = int(retention_days)
+        self.name = name
+        # pid: tras el fork de serve.py, id(self) puede repetirse entre workers
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+
+        self._conn = None
+        self._thread = None
+        self._executor = None
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {'claimed': 0, 'sent': 0, 'retried': 0, 'dead': 0, 'batches': 0, 'errors': 0,
+                       'lease_renewals': 0, 'lease_lost': 0}
+
+    # ---------- Preparación ----------
+    def register(self, kind: str, sender):
+        self.senders[kind] = sender
+
+    def ensure_table(self):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                for ddl in OUTBOX_DDL:
+                    cur.execute(ddl)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def enqueue_now(self, kind: str, payload: dict, dedupe_key: str = None, delay: float = 0) -> bool:
+        """enqueue() en su propia transacción, para cuando no hay un cambio de BD al que atarlo."""
+        conn = self.connect()
+        try:
+            inserted = enqueue(conn, kind, payload, dedupe_key, delay)
+            conn.commit()
+        finally:
+            conn.close()
+        self.wake()
+        return inserted
+
+    # ---------- Ciclo de vida ----------
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f'{self.name}-send')
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info(f"[OUTBOX] Iniciado ({', '.join(sorted(self.senders)) or 'sin kinds'}) batch={self.batch_size}")
+        return self
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._close()
+
+    def wake(self):
+        """Avisa al worker de que hay eventos nuevos (sin esperar al siguiente poll)."""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                drained = self.drain_once()
+                if time.time() - self._last_purge > 3600:
+                    self._purge()
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.exception("[OUTBOX] Error drenando el outbox")
+                self._close()
+                drained = 0
+            if drained < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+    # ---------- Drenado ----------
+    def _cursor(self):
+        if self._conn is None:
+            self._conn = self.connect()
+        return self._conn.cursor()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def drain_once(self) -> int:
+        """Reserva un lote, lo envía (concurrency en paralelo) y registra el resultado. Devuelve filas tratadas."""
+        kinds = sorted(self.senders)
+        if not kinds:
+            return 0
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE public.scheduler_outbox o
+                   SET status = 'sending', claimed_at = NOW(), claimed_by = %s, attempts = o.attempts + 1
+                 WHERE o.id IN (
+                        SELECT id FROM public.scheduler_outbox
+                         WHERE kind = ANY(%s)
+                           AND ((status = 'pending' AND available_at <= NOW())
+                             OR (status = 'sending' AND claimed_at < NOW() - make_interval(secs => %s)))
+                         ORDER BY available_at, id
+                         LIMIT %s
+                         FOR UPDATE SKIP LOCKED
+                 )
+                RETURNING o.id, o.kind, o.payload, o.attempts
+                """,
+                (self.worker_id, kinds, self.lease_timeout, self.batch_size)
+            )
+            rows = cur.fetchall() or []
+        self._conn.commit()
+        if not rows:
+            return 0
+
+        futures = {self._executor.submit(self._deliver, row): row for row in rows}
+        sent, retry, dead = [], [], []
+        pending = set(futures)
+        renew_every = max(1.0, self.lease_timeout / 3)
+        renewed_at = time.monotonic()
+        while pending:
+            done, pending = wait(pending, timeout=renew_every, return_when=FIRST_COMPLETED)
+            for future in done:
+                outcome, error = future.result()
+                {'sent': sent, 'retry': retry, 'dead': dead}[outcome].append((futures[future], error))
+            if pending and time.monotonic() - renewed_at >= renew_every:
+                # Lote más largo que el lease (URLs lentas, reintentos del sender): que no lo retome otro
+                self._renew_lease([futures[f][0] for f in pending])
+                renewed_at = time.monotonic()
+
+        # Solo las filas que siguen siendo nuestras: si el lease venció y otro worker las retomó, el resultado es suyo
+        owned = "AND status = 'sending' AND claimed_by = %s"
+        updated = 0
+        with self._cursor() as cur:
+            if sent:
+                cur.execute(
+                    "UPDATE public.scheduler_outbox SET status = 'sent', sent_at = NOW(), last_error = NULL "
+                    f"WHERE id = ANY(%s) {owned}",
+                    ([row[0] for row, _ in sent], self.worker_id)
+                )
+                updated += cur.rowcount
+            for row, error in retry:
+                cur.execute(
+                    f"""
+                    UPDATE public.scheduler_outbox
+                       SET status = 'pending', last_error = %s,
+                           available_at = NOW() + make_interval(secs => %s)
+                     WHERE id = %s {owned}
+                    """,
+                    (error, self._delay(row[3]), row[0], self.worker_id)
+                )
+                updated += cur.rowcount
+            for row, error in dead:
+                cur.execute(
+                    f"UPDATE public.scheduler_outbox SET status = 'dead', last_error = %s WHERE id = %s {owned}",
+                    (error, row[0], self.worker_id)
+                )
+                updated += cur.rowcount
+        self._conn.commit()
+
+        lost = len(rows) - updated
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['claimed'] += len(rows)
+            self._stats['sent'] += len(sent)
+            self._stats['retried'] += len(retry)
+            self._stats['dead'] += len(dead)
+            self._stats['lease_lost'] += lost
+        if lost:
+            logger.warning(f"[OUTBOX] {lost}/{len(rows)} eventos del lote ya no eran de {self.worker_id} (lease vencido)")
+        for row, error in dead:
+            logger.error(f"[OUTBOX] Evento {row[0]} ({row[1]}) a dead-letter tras {row[3]} intentos: {error}")
+        return len(rows)
+
+    def _renew_lease(self, ids: list):
+        with self._cursor() as cur:
+            cur.execute(
+                "UPDATE public.scheduler_outbox SET claimed_at = NOW() "
+                "WHERE id = ANY(%s) AND status = 'sending' AND claimed_by = %s",
+                (ids, self.worker_id)
+            )
+            renewed = cur.rowcount
+        self._conn.commit()
+        with self._lock:
+            self._stats['lease_renewals'] += 1
+        if renewed < len(ids):
+            logger.warning(f"[OUTBOX] Lease renovado en {renewed}/{len(ids)} eventos en vuelo de {self.worker_id}")
+
+    def _deliver(self, row):
+        """(outcome, error) con outcome en sent | retry | dead."""
+        event_id, kind, payload, attempts = row
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        sender = self.senders.get(kind)
+        try:
+            if sender(payload):
+                return 'sent', None
+            error = 'sender devolvió False'
+        except OutboxPermanentError as e:
+            return 'dead', str(e)[:1000]
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:1000]
+        if attempts >= self.max_attempts:
+            return 'dead', error
+        logger.warning(f"[OUTBOX] Evento {event_id} ({kind}) intento {attempts}/{self.max_attempts} fallido: {error}")
+        return 'retry', error
+
+    def _delay(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * (2 ** (attempts - 1)))
+        return delay + random.uniform(0, delay / 4)
+
+    def _purge(self):
+        """Borra los eventos enviados más antiguos que retention_days (los dead se quedan)."""
+        self._last_purge = time.time()
+        with self._cursor() as cur:
+            cur.execute(
+                "DELETE FROM public.scheduler_outbox WHERE status = 'sent' AND sent_at < NOW() - make_interval(days => %s)",
+                (self.retention_days,)
+            )
+        self._conn.commit()
+
+    # ---------- Operación ----------
+    def requeue_dead(self, kind: str = None, ids: list = None) -> int:
+        """Vuelve a poner en cola eventos en dead-letter (todos, por kind o por ids)."""
+        sql = "UPDATE public.scheduler_outbox SET status = 'pending', attempts = 0, available_at = NOW() WHERE status = 'dead'"
+        params = []
+        if kind:
+            sql += " AND kind = %s"
+            params.append(kind)
+        if ids:
+            sql += " AND id = ANY(%s)"
+            params.append([int(i) for i in ids])
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, tuple(params))
+                count = cur.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        self.wake()
+        return count
+
+    def stats(self) -> dict:
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT kind, status, COUNT(*), MIN(available_at) FILTER (WHERE status = 'pending')
+                    FROM public.scheduler_outbox
+                    GROUP BY kind, status
+                    """
+                )
+                rows = cur.fetchall() or []
+            conn.commit()
+        finally:
+            conn.close()
+        queue = {}
+        for kind, status, count, oldest in rows:
+            entry = queue.setdefault(kind, {})
+            entry[status] = count
+            if oldest is not None:
+                entry['oldest_pending'] = oldest.isoformat()
+        with self._lock:
+            local = dict(self._stats)
+        return {
+            'worker_id': self.worker_id,
+            'running': self._thread is not None,
+            'kinds': sorted(self.senders),
+            'max_attempts': self.max_attempts,
+            'queue': queue,
+            'worker': local,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Scheduler de pruebas
+# ---------------------------------------------------------------------------
+class StubScheduler:
+    """
+    Scheduler falso en local: acepta POST JSON en cualquier ruta y los guarda en .received.
+    fail_rate: fracción de peticiones que devuelven fail_status; latency_ms: espera por petición.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, fail_rate: float = 0.0,
+                 fail_status: int = 503, latency_ms: float = 0.0):
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.latency_ms = latency_ms
+        self.received = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if stub.latency_ms:
+                    time.sleep(stub.latency_ms / 1000)
+                failed = random.random() < stub.fail_rate
+                with stub._lock:
+                    stub.received.append({
+                        'path': self.path,
+                        'api_key': self.headers.get('X-API-Key'),
+                        'json': json.loads(body or b'null'),
+                        'status': stub.fail_status if failed else 200,
+                    })
+                out = json.dumps({'ok': not failed}).encode()
+                self.send_response(stub.fail_status if failed else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, fmt, *args):
+                logger.debug(f"[STUB SCHEDULER] {fmt % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stub-scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Scheduler de pruebas para el outbox")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    stub_cmd = sub.add_parser('stub', help="arranca un scheduler falso")
+    stub_cmd.add_argument('--host', default='127.0.0.1')
+    stub_cmd.add_argument('--port', type=int, default=5199)
+    stub_cmd.add_argument('--fail-rate', type=float, default=0.0)
+    stub_cmd.add_argument('--fail-status', type=int, default=503)
+    stub_cmd.add_argument('--latency-ms', type=float, default=0.0)
+    a = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    s = StubScheduler(a.host, a.port, a.fail_rate, a.fail_status, a.latency_ms).start()
+    print(f"Stub scheduler en {s.url} (fail_rate={a.fail_rate}, latency={a.latency_ms}ms); Ctrl+C para parar")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"  recibidas: {len(s.received)}")
+    except KeyboardInterrupt:
+        s.stop()
@@ -0,0 +1,299 @@
+"""
+Servidor de producción pre-fork para CloudAPI2 (sustituye a app.run).
+
+- El master abre los sockets (HTTP y, si hay TLS, HTTPS) y hace fork de N workers.
+- Cada worker importa CloudAPI2 DESPUÉS del fork: pool de BD, cachés, colas, dispatcher
+  e hilos propios. Hace warm-up (compañías + catálogo de plantillas) y solo entonces
+  avisa al master y empieza a aceptar conexiones.
+- Recarga en caliente: SIGHUP arranca una generación nueva de workers; cuando están
+  listos, los viejos terminan lo que tienen en vuelo y salen. Si la nueva no arranca
+  (import o config rota) se descarta y sigue la vieja.
+- SIGTERM / SIGINT: parada ordenada (drain de las peticiones en curso).
+- Si un worker muere se relanza.
+- A los workers se les pasa CLOUDAPI_CONFIG (--config) y SERVE_WORKERS: CloudAPI2 reparte
+  entre ellos el ritmo de envío a Graph por número y comparte el catálogo de plantillas.
+
+Configuración ([SERVER] en scripts.conf; host/puertos/certificados de [WEBHOOK]):
+    WORKERS           nº de procesos (por defecto, nº de CPUs)
+    TLS               auto | off     (off si el TLS lo termina un proxy delante)
+    GRACEFUL_TIMEOUT  segundos para drenar peticiones al parar/recargar (30)
+    WARMUP_TIMEOUT    segundos máximos de warm-up antes de dar el worker por listo (120)
+
+Uso: python serve.py [--workers N] [--config scripts.conf]
+"""
+import argparse
+import configparser
+import logging
+import os
+import pathlib
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+logger = logging.getLogger("serve")
+
+BASE_DIR = pathlib.Path(__file__).parent.resolve()
+
+
+def load_server_settings(config_path: str, workers: int = None) -> dict:
+    cfg = configparser.ConfigParser()
+    cfg.read(config_path)
+    webhook_cfg = cfg['WEBHOOK'] if cfg.has_section('WEBHOOK') else {}
+    server_cfg = cfg['SERVER'] if cfg.has_section('SERVER') else {}
+
+    ssl_cert = os.getenv('SSL_CERT_PATH') or webhook_cfg.get('SSL_CERT_PATH')
+    ssl_key = os.getenv('SSL_KEY_PATH') or webhook_cfg.get('SSL_KEY_PATH')
+    if ssl_cert and not pathlib.Path(ssl_cert).is_absolute():
+        ssl_cert = str((BASE_DIR / ssl_cert).resolve())
+    if ssl_key and not pathlib.Path(ssl_key).is_absolute():
+        ssl_key = str((BASE_DIR / ssl_key).resolve())
+    tls = (server_cfg.get('TLS', 'auto') or 'auto').strip().lower()
+    if tls == 'off' or not (ssl_cert and ssl_key):
+        ssl_cert = ssl_key = None
+
+    return {
+        'host': webhook_cfg.get('WEBHOOK_HOST', '0.0.0.0'),
+        'http_port': int(webhook_cfg.get('HTTP_PORT', webhook_cfg.get('WEBHOOK_HTTP', '5041'))),
+        'https_port': int(webhook_cfg.get('WEBHOOK_PORT', '5042')),
+        'ssl_cert': ssl_cert,
+        'ssl_key': ssl_key,
+        'workers': workers or int(server_cfg.get('WORKERS', os.cpu_count() or 2)),
+        'graceful_timeout': float(server_cfg.get('GRACEFUL_TIMEOUT', 30)),
+        'warmup_timeout': float(server_cfg.get('WARMUP_TIMEOUT', 120)),
+    }
+
+
+def _listen(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+# ---------------------------------------------------------------------------
+# Worker
+# ---------------------------------------------------------------------------
+def run_worker(settings: dict, listeners: list, ready_fd: int):
+    """Proceso hijo: importa la app, warm-up, avisa al master y sirve hasta SIGTERM."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    from werkzeug.serving import make_server
+    import CloudAPI2  # noqa: E402  (import post-fork: recursos propios del worker)
+
+    warm = threading.Thread(target=CloudAPI2.warm_up_worker, name='worker-warmup', daemon=True)
+    warm.start()
+    warm.join(settings['warmup_timeout'])
+    if warm.is_alive():
+        logger.warning(f"[SERVE] pid={os.getpid()} warm-up > {settings['warmup_timeout']}s; se acepta tráfico igualmente")
+
+    servers = []
+    for sock, ssl_context in listeners:
+        server = make_server(
+            settings['host'], sock.getsockname()[1], CloudAPI2.app,
+            threaded=True, ssl_context=ssl_context, fd=sock.fileno(),
+        )
+        # Hilos de petición no-daemon: server_close() espera a que terminen (drain)
+        server.daemon_threads = False
+        server.block_on_close = True
+        servers.append(server)
+
+    stopping = threading.Event()
+
+    def _graceful(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, _graceful)
+
+    threads = [threading.Thread(target=s.serve_forever, name=f'serve-{i}', daemon=True) for i, s in enumerate(servers)]
+    for t in threads:
+        t.start()
+    os.write(ready_fd, b'1')
+    os.close(ready_fd)
+    logger.info(f"[SERVE] Worker pid={os.getpid()} aceptando conexiones")
+
+    stopping.wait()
+    logger.info(f"[SERVE] Worker pid={os.getpid()} drenando peticiones")
+    for s in servers:
+        s.shutdown()
+    for s in servers:
+        s.server_close()
+    CloudAPI2.shutdown_worker()
+    os._exit(0)
+
+
+# ---------------------------------------------------------------------------
+# Master
+# ---------------------------------------------------------------------------
+class PreforkMaster:
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.listeners = []
+        self.generation = 0
+        self.workers = {}            # pid -> {'generation', 'ready', 'ready_fd', 'started'}
+        self._reload = False
+        self._stop = False
+        self._crashes = []
+
+    def bind(self):
+        s = self.settings
+        self.listeners.append((_listen(s['host'], s['http_port']), None))
+        logger.info(f"[SERVE] HTTP en {s['host']}:{s['http_port']}")
+        if s['ssl_cert'] and s['ssl_key']:
+            self.listeners.append((_listen(s['host'], s['https_port']), (s['ssl_cert'], s['ssl_key'])))
+            logger.info(f"[SERVE] HTTPS en {s['host']}:{s['https_port']}")
+        else:
+            logger.info("[SERVE] TLS desactivado (TLS=off o sin certificados)")
+
+    def spawn(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                run_worker(self.settings, self.listeners, w)
+            except Exception:
+                logger.exception("[SERVE] Worker abortado")
+            os._exit(1)
+        os.close(w)
+        self.workers[pid] = {'generation': self.generation, 'ready': False, 'ready_fd': r, 'started': time.time()}
+        return pid
+
+    def _poll_ready(self, timeout: float):
+        fds = {info['ready_fd']: pid for pid, info in self.workers.items() if info['ready_fd'] is not None}
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in readable:
+            pid = fds[fd]
+            if os.read(fd, 1):
+                self.workers[pid]['ready'] = True
+                logger.info(f"[SERVE] Worker pid={pid} (gen {self.workers[pid]['generation']}) listo")
+            os.close(fd)
+            self.workers[pid]['ready_fd'] = None
+
+    def _reap(self):
+        respawn = 0
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            info = self.workers.pop(pid, None)
+            if info is None:
+                continue
+            if info['ready_fd'] is not None:
+                os.close(info['ready_fd'])
+            if not self._stop and info['generation'] == self.generation:
+                logger.warning(f"[SERVE] Worker pid={pid} terminó (status={status}); relanzando")
+                self._crashes = [t for t in self._crashes if time.time() - t < 60] + [time.time()]
+                respawn += 1
+        # Relanzar fuera del bucle de waitpid: con un worker que muere al arrancar, no volvería nunca
+        if respawn and len(self._crashes) > self.settings['workers'] * 3:
+            logger.error("[SERVE] Demasiados fallos de workers en 60s; esperando antes de relanzar")
+            time.sleep(5)
+        for _ in range(respawn):
+            self.spawn()
+
+    def _signal_generation(self, generation_filter, sig):
+        for pid, info in list(self.workers.items()):
+            if generation_filter(info['generation']):
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def reload(self):
+        """
+        Nueva generación; la vieja se retira solo cuando todos los workers nuevos están listos.
+        Si no lo están antes del warm-up timeout (import/config rota, crash en bucle) se mata la
+        generación nueva y sigue sirviendo la vieja.
+        """
+        previous = self.generation
+        self.generation += 1
+        current = self.generation
+        logger.info(f"[SERVE] Recarga: arrancando generación {current}")
+        for _ in range(self.settings['workers']):
+            self.spawn()
+        deadline = time.time() + self.settings['warmup_timeout'] + 10
+        ready = False
+        while time.time() < deadline and not self._stop:
+            new = [i for i in self.workers.values() if i['generation'] == current]
+            if len(new) >= self.settings['workers'] and all(i['ready'] for i in new):
+                ready = True
+                break
+            self._poll_ready(0.5)
+            self._reap()
+        if self._stop:
+            return
+        if not ready:
+            # Primero volver a la generación vieja: _reap ya no relanza los nuevos y sí los viejos
+            self.generation = previous
+            self._signal_generation(lambda g: g == current, signal.SIGKILL)
+            kill_deadline = time.time() + 5
+            while any(i['generation'] == current for i in self.workers.values()) and time.time() < kill_deadline:
+                self._reap()
+                time.sleep(0.1)
+            logger.error(f"[SERVE] Recarga fallida: la generación {current} no quedó lista en "
+                         f"{self.settings['warmup_timeout'] + 10:.0f}s; se mantiene la generación {previous}")
+            return
+        self._signal_generation(lambda g: g < current, signal.SIGTERM)
+        logger.info(f"[SERVE] Generación {current} activa; retirando las anteriores")
+
+    def stop(self):
+        logger.info("[SERVE] Parada ordenada")
+        self._signal_generation(lambda g: True, signal.SIGTERM)
+        deadline = time.time() + self.settings['graceful_timeout']
+        while self.workers and time.time() < deadline:
+            self._reap()
+            time.sleep(0.2)
+        self._signal_generation(lambda g: True, signal.SIGKILL)
+        for sock, _ in self.listeners:
+            sock.close()
+
+    def run(self):
+        self.bind()
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, '_reload', True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, '_stop', True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, '_stop', True))
+        logger.info(f"[SERVE] Master pid={os.getpid()} con {self.settings['workers']} workers")
+        for _ in range(self.settings['workers']):
+            self.spawn()
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            self._poll_ready(1.0)
+            self._reap()
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor pre-fork de CloudAPI2")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--config', default='scripts.conf')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    config_path = os.path.abspath(args.config)
+    settings = load_server_settings(config_path, args.workers)
+    # Heredado por los workers (CloudAPI2 se importa tras el fork)
+    os.environ['CLOUDAPI_CONFIG'] = config_path
+    os.environ['SERVE_WORKERS'] = str(settings['workers'])
+    os.chdir(BASE_DIR)  # certificados y ficheros locales (colas SQLite) relativos al proyecto
+    PreforkMaster(settings).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""
+Cliente HTTP compartido por proceso para Graph API, Supabase y APIs internas.
+
+- Una requests.Session con pools keep-alive por host (HTTPAdapter) en lugar de abrir
+  una conexión TLS nueva en cada requests.get/post.
+- HTTP/2 opcional (httpx + h2) para los hosts indicados; si httpx no está instalado se
+  sigue por requests sin cambiar nada.
+- Timeout por defecto y política de reintentos únicas:
+    * GET/HEAD/OPTIONS/PUT/DELETE: errores de red y status en retry_statuses.
+    * POST/PATCH: solo si la conexión no llegó a establecerse (no se duplican envíos).
+- Histograma de latencias por endpoint (método + host + ruta con ids normalizados).
+
+Las respuestas tienen la interfaz de requests.Response (ok, status_code, json(),
+raise_for_status() con requests.HTTPError, iter_content, context manager).
+"""
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # HTTP/2 es opcional
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_ID_SEGMENT_RE = re.compile(
+    r'^(?:\d{4,}|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[A-Za-z0-9_\-=.]{24,})$'
+)
+
+
+def endpoint_label(method: str, url: str) -> str:
+    """'GET graph.facebook.com/{v}/{id}/message_templates' — sin ids ni query para agrupar."""
+    parts = urlsplit(url)
+    segments = []
+    for seg in parts.path.split('/'):
+        if not seg:
+            continue
+        if seg[0] == 'v' and seg[1:2].isdigit() and '.' in seg:
+            segments.append('{v}')
+        elif _ID_SEGMENT_RE.match(seg):
+            segments.append('{id}')
+        else:
+            segments.append(seg)
+    return f"{method.upper()} {parts.hostname or ''}/{'/'.join(segments)}"
+
+
+class LatencyHistogram:
+    """Histograma de buckets fijos (ms) con contadores por status."""
+    __slots__ = ('counts', 'total', 'sum_ms', 'max_ms', 'errors', 'retries', 'statuses')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        self.errors = 0
+        self.retries = 0
+        self.statuses = {}
+
+    def observe(self, elapsed_ms: float, status=None):
+        i = 0
+        while i < len(LATENCY_BUCKETS_MS) and elapsed_ms > LATENCY_BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+        if status is None:
+            self.errors += 1
+        else:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def quantile(self, q: float) -> float | None:
+        """Cota superior del bucket donde cae el cuantil q."""
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 1)
+        return round(self.max_ms, 1)
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.total,
+            'errors': self.errors,
+            'retries': self.retries,
+            'statuses': {str(k): v for k, v in sorted(self.statuses.items())},
+            'avg_ms': round(self.sum_ms / self.total, 1) if self.total else None,
+            'p50_ms': self.quantile(0.50),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'max_ms': round(self.max_ms, 1),
+            'buckets': dict(zip([f"le_{b}" for b in LATENCY_BUCKETS_MS] + ['le_inf'], self.counts)),
+        }
+
+
+class Http2Response:
+    """Adaptador de httpx.Response a la interfaz de requests.Response que usa el código."""
+
+    def __init__(self, response):
+        self._r = response
+
+    status_code = property(lambda self: self._r.status_code)
+    headers = property(lambda self: self._r.headers)
+    content = property(lambda self: self._r.content)
+    text = property(lambda self: self._r.text)
+    reason = property(lambda self: self._r.reason_phrase)
+    url = property(lambda self: str(self._r.url))
+    ok = property(lambda self: self._r.status_code < 400)
+    http_version = property(lambda self: self._r.http_version)
+
+    def json(self, **kwargs):
+        return self._r.json(**kwargs)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.HTTPError(f"{self.status_code} {kind} Error: {self.reason} for url: {self.url}", response=self)
+
+    def iter_content(self, chunk_size: int = 1, decode_unicode: bool = False):
+        return self._r.iter_bytes(chunk_size)
+
+    def close(self):
+        self._r.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedHttpClient:
+    """
+    Cliente HTTP único por proceso. Los métodos get/post/head/put/patch/delete aceptan los
+    mismos kwargs que requests; `retries=` y `timeout=` sobreescriben la política por llamada.
+    """
+
+    def __init__(self, pool_connections: int = 16, pool_maxsize: int = 50,
+                 timeout=(5, 30), retries: int = 2, backoff: float = 0.3, max_backoff: float = 5.0,
+                 retry_statuses=(429, 500, 502, 503, 504), http2_hosts=(), max_endpoints: int = 500):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+        self.max_endpoints = max_endpoints
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.http2_hosts = frozenset(h.strip().lower() for h in http2_hosts if h and h.strip())
+        self._h2 = None
+        if self.http2_hosts:
+            if httpx is None:
+                logger.warning("[HTTP] HTTP/2 pedido pero httpx no está instalado; se usa HTTP/1.1")
+                self.http2_hosts = frozenset()
+            else:
+                try:
+                    self._h2 = httpx.Client(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+                    )
+                except ImportError:  # falta h2
+                    logger.warning("[HTTP] HTTP/2 pedido pero h2 no está instalado; se usa HTTP/1.1")
+                    self.http2_hosts = frozenset()
+
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    # ---------- API estilo requests ----------
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method: str, url: str, retries: int = None, **kwargs):
+        method = method.upper()
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        retries = self.retries if retries is None else retries
+        idempotent = method in IDEMPOTENT_METHODS
+        use_h2 = self._h2 is not None and not kwargs.get('files') and \
+            (urlsplit(url).hostname or '').lower() in self.http2_hosts
+        label = endpoint_label(method, url)
+
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                response = self._send_h2(method, url, kwargs) if use_h2 else \
+                    self.session.request(method, url, **kwargs)
+            except Exception as e:
+                self._observe(label, (time.perf_counter() - t0) * 1000, None, attempt)
+                if attempt < retries and (idempotent or self._is_connect_error(e)):
+                    attempt += 1
+                    delay = self._delay(attempt)
+                    logger.warning(f"[HTTP] {label} falló ({type(e).__name__}); reintento {attempt}/{retries} en {delay:.2f}s")
+                    time.sleep(delay)
+                    continue
+                raise
+            self._observe(label, (time.perf_counter() - t0) * 1000, response.status_code, attempt)
+            if attempt < retries and idempotent and response.status_code in self.retry_statuses:
+                attempt += 1
+                delay = self._delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f"[HTTP] {label} → {response.status_code}; reintento {attempt}/{retries} en {delay:.2f}s")
+                response.close()
+                time.sleep(delay)
+                continue
+            return response
+
+    def _send_h2(self, method, url, kwargs):
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        data = kwargs.get('data')
+        request = self._h2.build_request(
+            method, url,
+            params=kwargs.get('params'),
+            headers=kwargs.get('headers'),
+            json=kwargs.get('json'),
+            content=data if isinstance(data, (str, bytes)) else None,
+            data=data if isinstance(data, dict) else None,
+            timeout=timeout,
+        )
+        response = self._h2.send(
+            request,
+            stream=bool(kwargs.get('stream')),
+            follow_redirects=kwargs.get('allow_redirects', method != 'HEAD'),
+        )
+        return Http2Response(response)
+
+    @staticmethod
+    def _is_connect_error(exc) -> bool:
+        """La petición no llegó a salir: es seguro reintentar incluso un POST."""
+        if isinstance(exc, requests.exceptions.ConnectTimeout):
+            return True
+        if httpx is not None and isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout)):
+            return True
+        return isinstance(exc, requests.exceptions.ConnectionError) and 'NewConnectionError' in repr(exc)
+
+    def _delay(self, attempt: int, retry_after=None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except (TypeError, ValueError):
+                pass
+        return min(self.backoff * (2 ** (attempt - 1)), self.max_backoff) * (0.5 + random.random() / 2)
+
+    # ---------- Métricas ----------
+    def _observe(self, label: str, elapsed_ms: float, status, attempt: int):
+        with self._lock:
+            hist = self._histograms.get(label)
+            if hist is None:
+                if len(self._histograms) >= self.max_endpoints:
+                    label = 'other'
+                    hist = self._histograms.setdefault(label, LatencyHistogram())
+                else:
+                    hist = self._histograms[label] = LatencyHistogram()
+            hist.observe(elapsed_ms, status)
+            if attempt:
+                hist.retries += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            endpoints = {label: h.to_dict() for label, h in self._histograms.items()}
+        return {
+            'http2_hosts': sorted(self.http2_hosts),
+            'timeout': list(self.timeout) if isinstance(self.timeout, tuple) else self.timeout,
+            'retries': self.retries,
+            'endpoints': dict(sorted(endpoints.items(), key=lambda kv: -kv[1]['count'])),
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def close(self):
+        self.session.close()
+        if self._h2 is not None:
+            self._h2.close()
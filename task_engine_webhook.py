@@ -16,6 +16,8 @@ try:
 except Exception:
     requests = None
 
+from scheduler_outbox import SchedulerOutbox, http_json_sender
+
 # ----------------------------------------------------------------------------
 # Configuración básica / logging
 # ----------------------------------------------------------------------------
@@ -223,6 +225,70 @@ def get_task_info(task_id: str) -> Optional[dict]:
             pass
 
 
+# ----------------------------------------------------------------------------
+# Outbox del scheduler (public.scheduler_outbox, compartido con CloudAPI2)
+# ----------------------------------------------------------------------------
+def _scheduler_headers() -> dict:
+    headers = {"Content-Type": "application/json"}
+    if SCHEDULER_API_KEY:
+        headers["X-API-Key"] = SCHEDULER_API_KEY
+    return headers
+
+
+def build_scheduler_outbox() -> Optional[SchedulerOutbox]:
+    """
+    Los triggers al scheduler se guardan en el outbox y un hilo los envía (con reintentos),
+    en vez de bloquear /task-info con el POST. Sección opcional:
+
+    [OUTBOX]
+    ENABLED = true
+    MAX_ATTEMPTS = 8
+    """
+    if requests is None:
+        return None
+    if not config_supabase.getboolean("OUTBOX", "ENABLED", fallback=True):
+        return None
+    try:
+        outbox = SchedulerOutbox(
+            get_db_connection,
+            senders={"customer_journey": http_json_sender(requests.Session(), SCHEDULER_URL, _scheduler_headers())},
+            batch_size=config_supabase.getint("OUTBOX", "BATCH_SIZE", fallback=50),
+            concurrency=config_supabase.getint("OUTBOX", "CONCURRENCY", fallback=4),
+            max_attempts=config_supabase.getint("OUTBOX", "MAX_ATTEMPTS", fallback=8),
+            lease_timeout=config_supabase.getint("OUTBOX", "LEASE_TIMEOUT", fallback=120),
+            retention_days=config_supabase.getint("OUTBOX", "RETENTION_DAYS", fallback=7),
+            name="task-engine-outbox",
+        )
+        outbox.ensure_table()
+        return outbox.start()
+    except Exception as e:
+        app.logger.error(f"❌ Outbox del scheduler no disponible ({e}); se llamará al scheduler en línea")
+        return None
+
+
+scheduler_outbox = build_scheduler_outbox()
+
+
+def dispatch_scheduler_event(payload: dict, dedupe_key: str) -> None:
+    """Encola el trigger en el outbox; sin outbox, POST directo como antes."""
+    if scheduler_outbox is not None:
+        try:
+            if scheduler_outbox.enqueue_now("customer_journey", payload, dedupe_key=dedupe_key):
+                app.logger.info(f"📮 Trigger encolado en outbox (dedupe_key={dedupe_key})")
+            else:
+                app.logger.info(f"⏭️ Trigger ya estaba en el outbox (dedupe_key={dedupe_key})")
+            return
+        except Exception as e:
+            app.logger.error(f"❌ No se pudo encolar en el outbox ({e}); llamando al scheduler en línea")
+
+    try:
+        resp = requests.post(SCHEDULER_URL, json=payload, headers=_scheduler_headers(), timeout=10)
+        app.logger.info(f"📡 Respuesta scheduler: {resp.status_code} - {resp.text}")
+        resp.raise_for_status()
+    except Exception as e:
+        app.logger.error(f"❌ Error llamando a customer_journey: {e}")
+
+
 from werkzeug.exceptions import BadRequest
 import json
 
@@ -383,23 +449,11 @@ def trigger_customer_journey(task: dict) -> None:
         "schedule_at": schedule_at,
     }
 
-    url = SCHEDULER_URL
-    headers = {
-        "Content-Type": "application/json",
-    }
-    if SCHEDULER_API_KEY:
-        headers["X-API-Key"] = SCHEDULER_API_KEY
-
     import json
-    app.logger.info(f"🌊 Llamando a Customer Journey: POST {url}")
+    app.logger.info(f"🌊 Llamando a Customer Journey: POST {SCHEDULER_URL}")
     app.logger.info(f"📦 Payload JSON real: {json.dumps(payload)}")
 
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=10)
-        app.logger.info(f"📡 Respuesta scheduler: {resp.status_code} - {resp.text}")
-        resp.raise_for_status()
-    except Exception as e:
-        app.logger.error(f"❌ Error llamando a customer_journey: {e}")
+    dispatch_scheduler_event(payload, f"customer_journey:{task.get('task_id') or lead_id}:{schedule_at}")
 
 
 def to_utc_iso_z(dt):
@@ -471,26 +525,14 @@ def trigger_call_reminder_flow(task: dict) -> None:
         "schedule_at": schedule_at,
     }
 
-    # Usa tu SCHEDULER_URL ya configurada (en tu código ya la tienes)
-    url = SCHEDULER_URL
-    headers = {
-        "Content-Type": "application/json",
-    }
-    if SCHEDULER_API_KEY:
-        headers["X-API-Key"] = SCHEDULER_API_KEY
-
     import json
     app.logger.info("🌊 Llamando a Customer Journey (recordatorio_llamada)")
     app.logger.info(f"   • lead_id      : {lead_id}")
     app.logger.info(f"   • schedule_at  : {schedule_at}")
     app.logger.info(f"📦 Payload JSON real: {json.dumps(payload)}")
 
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=10)
-        app.logger.info(f"📡 Respuesta scheduler: {resp.status_code} - {resp.text}")
-        resp.raise_for_status()
-    except Exception as e:
-        app.logger.error(f"❌ Error llamando a customer_journey: {e}")
+    # Misma tarea + misma fecha = mismo evento (reenvíos de /task-info no duplican el recordatorio)
+    dispatch_scheduler_event(payload, f"call_reminder:{task.get('task_id') or lead_id}:{schedule_at}")
 
 
 
@@ -500,6 +542,14 @@ def trigger_call_reminder_flow(task: dict) -> None:
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 
+@app.route("/outbox/stats", methods=["GET"])
+def outbox_stats():
+    """Eventos del outbox del scheduler por kind/estado y contadores del worker."""
+    if scheduler_outbox is None:
+        return jsonify({"ok": True, "enabled": False}), 200
+    return jsonify({"ok": True, "enabled": True, "outbox": scheduler_outbox.stats()}), 200
+
+
 @app.before_request
 def log_request_info():
     app.logger.debug(f"--> {request.method} {request.url}")
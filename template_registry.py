@@ -0,0 +1,343 @@
+"""
+Registro de plantillas de WhatsApp compiladas.
+
+Cada plantilla conocida (ETD y resto de tenants) se describe con datos (dict / JSON) y se
+compila UNA vez en una función que rellena los componentes a partir de template_data.
+Construir un payload pasa a ser un lookup + rellenar dicts, en lugar de recorrer la
+cadena de if/elif por nombre en cada envío.
+
+Formato de la definición (ver DEFAULT_TEMPLATE_SPECS):
+  templates: { nombre_sin_version: {
+      body:     [param, ...]                # {{1}}, {{2}}, ...
+      buttons:  [{index, param}]            # botones URL dinámicos
+      language: "en_US"                     # opcional, fuerza idioma
+      drop_header: true                     # opcional, nunca enviar HEADER
+      header_image: "default"|"tenant_cover"
+  }}
+  etd: {                                    # plantillas 'etd_*' de las compañías ETD
+      values:  [param, ...]                 # valores ordenados {{1}}..{{n}}
+      prefixes: [[prefijo, n_params], ...]  # en orden: gana el primer prefijo que encaje
+      button:  {index, param}
+      no_button: [nombre, ...]
+      binders: {prefijo: nombre_binder}     # casos que necesitan lógica Python
+  }
+  param: ["clave", "clave_alternativa"] o {"keys": [...], "default": "", "strip": false}
+
+Microbenchmark:  python template_registry.py --iterations 100000
+"""
+import json
+import logging
+import re
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COVER_URL = "https://app.solvify.es/cover-whats.jpg"
+ETD_DEFAULT_LINK = "https://portal.eliminamostudeuda.com"
+
+_VERSION_SUFFIX_RE = re.compile(r'_v\d+$')
+
+_RESPONSIBLE = ["responsible_name", "responsible_first_name"]
+_COMPANY = {"keys": ["company_name"], "default": "Solvify"}
+_AMOUNT = ["amount", "payment_amount"]
+_ORDER_BUTTON = [{"index": 0, "param": ["order_id", "payment_id"]}]
+_DEAL_BUTTON = [{"index": 0, "param": ["deal_id"]}]
+
+DEFAULT_TEMPLATE_SPECS = {
+    "templates": {
+        # agendar_llamada → SOLO body (botón URL estático en WABA, sin parámetros)
+        "agendar_llamada": {"body": [["first_name"]]},
+        "agendar_llamada_inicial": {"body": [["first_name"]], "buttons": _DEAL_BUTTON},
+        "recordatorio_llamada_agendada": {"body": [["first_name"], _RESPONSIBLE, _COMPANY]},
+        "retomar_contacto": {"body": [["first_name"], _RESPONSIBLE, _COMPANY]},
+        "nuevo_numero": {"body": [["first_name"], _RESPONSIBLE], "buttons": _DEAL_BUTTON},
+        "baja_comercial": {"body": [["first_name"], _RESPONSIBLE, _COMPANY], "buttons": _DEAL_BUTTON},
+        # Header TEXT estático (sin parámetros)
+        "followup_missed_calls": {"body": [["first_name"]], "buttons": _DEAL_BUTTON},
+        "recordatorio_pago_hoy": {"body": [["first_name"], _AMOUNT], "buttons": _ORDER_BUTTON},
+        "recordatorio_pago_vencido": {
+            "body": [["first_name"], ["days_overdue", "days"], _AMOUNT],
+            "buttons": _ORDER_BUTTON,
+        },
+        "recordatorio_pago_anticipado": {"body": [["first_name"], _AMOUNT], "buttons": _ORDER_BUTTON},
+        "recordatorio_pago_vencido_sin_cta": {
+            "body": [["first_name"], ["days_overdue", "days"]],
+            "buttons": _ORDER_BUTTON,
+        },
+        # ⚠️ llamada_perdida está en en_US en WBM; botón URL en index 1 (el 0 es QUICK_REPLY)
+        "llamada_perdida": {
+            "body": [["first_name"]],
+            "buttons": [{"index": 1, "param": ["deal_id"]}],
+            "language": "en_US",
+        },
+        # Plantillas SIN parámetros
+        "contacto_recordatorio_pago": {"drop_header": True},
+        "recordatorio_proximo_pago": {"drop_header": True},
+    },
+    "etd": {
+        "values": [
+            {"keys": ["customer_name", "client_name", "first_name"], "default": "-", "strip": True},
+            {"keys": ["sales_name", "comercial_asignado", "responsible_first_name", "responsible_name"],
+             "default": "Nuestro equipo", "strip": True},
+            {"keys": ["office_name", "office", "oficina", "company_name"], "default": "-", "strip": True},
+            {"keys": ["link", "portal_link", "payment_link", "expediente_link", "url"],
+             "default": ETD_DEFAULT_LINK, "strip": True},
+            {"keys": ["date_ddmm", "fecha_ddmm", "fecha", "date"], "default": "-", "strip": True},
+            {"keys": ["free_text", "texto_libre", "notes"], "default": "-", "strip": True},
+        ],
+        "prefixes": [
+            ["etd_contacto_inicial", 2],
+            ["etd_resp_comovamio_docspendientes", 2],
+            ["etd_pago_vencido_1sem", 2],
+            ["etd_pago_vencido_2sem", 2],
+            ["etd_pago_exp_paralizado", 2],
+            # --- 3P ---
+            ["etd_doc_completa_pago_procurador", 3],
+            ["etd_estado_preparacion_demanda", 3],
+            ["etd_estado_demanda_presentada", 3],
+            ["etd_estado_declarado_concurso", 3],
+            ["etd_estado_epi_solicitado", 3],
+            ["etd_estado_epi_concedido", 3],
+            ["etd_estado_epi_comunicado", 3],
+            ["etd_estado_bajas_ficheros", 3],
+            ["etd_rec_citas_tel", 3],
+            ["etd_pago_por_vencer", 3],
+            ["etd_pago_fecha_acordada", 3],
+            # --- 4P ---
+            ["etd_recaptura_post_entrevista", 4],
+            ["etd_doc_seguimiento_envio", 4],
+            ["etd_rec_cita_presencial", 4],
+            ["etd_pago_varias_cuotas", 4],
+        ],
+        # Todas las ETD salvo 'etd_resp_comovamio_docspendientes' tienen botón URL
+        "button": {"index": 0, "param": ["deal_id"]},
+        "no_button": ["etd_resp_comovamio_docspendientes"],
+        "binders": {"etd_rec_cita_presencial": "etd_rec_cita_presencial"},
+    },
+}
+
+
+def safe_text(value, default: str = "-") -> str:
+    """WhatsApp no acepta parámetros vacíos."""
+    value = (str(value) if value is not None else "").strip()
+    return value if value else default
+
+
+def normalize_template_name(name: str) -> str:
+    """Elimina sufijos de versión como _v2, _v3... del nombre del template."""
+    return _VERSION_SUFFIX_RE.sub('', name or '')
+
+
+def _compile_param(spec):
+    if isinstance(spec, dict):
+        keys = tuple(spec.get("keys") or ())
+        default = spec.get("default", "")
+        strip = bool(spec.get("strip"))
+    else:
+        keys, default, strip = tuple(spec), "", False
+
+    def get(td):
+        for key in keys:
+            value = td.get(key)
+            if value:
+                break
+        else:
+            return default
+        value = str(value)
+        if strip:
+            return value.strip() or default
+        return value
+    return get
+
+
+def _compile_button(spec):
+    index = int(spec.get("index", 0))
+    get = _compile_param(spec.get("param") or ["deal_id"])
+
+    def bind(td):
+        return {
+            "type": "button",
+            "sub_type": "url",
+            "index": index,
+            "parameters": [{"type": "text", "text": get(td)}],
+        }
+    return bind
+
+
+class CompiledTemplate:
+    """Plantilla compilada: bind(template_data, nombre) -> components (sin HEADER)."""
+    __slots__ = ("name", "language", "drop_header", "header_image", "bind", "param_count")
+
+    def __init__(self, name, bind, param_count=0, language=None, drop_header=False, header_image="default"):
+        self.name = name
+        self.bind = bind
+        self.param_count = param_count
+        self.language = language
+        self.drop_header = drop_header
+        self.header_image = header_image
+
+
+class TemplateRegistry:
+    """
+    Plantillas conocidas compiladas una vez. resolve() elige la plantilla para
+    (nombre, compañía) y bind() rellena los componentes.
+    """
+    def __init__(self, specs: dict = None, etd_company_ids=None):
+        self.etd_company_ids = {str(c) for c in (etd_company_ids or ())}
+        self._binders = {}
+        self._templates = {}
+        self._etd_prefixes = []
+        self._etd_fallback = None
+        self._resolved = {}
+        self._specs = {"templates": {}, "etd": {}}
+        self.load(specs if specs is not None else DEFAULT_TEMPLATE_SPECS)
+
+    # ---------- Carga ----------
+    def load(self, specs: dict):
+        """Añade/reemplaza definiciones y recompila."""
+        specs = specs or {}
+        self._specs["templates"].update(specs.get("templates") or {})
+        if specs.get("etd"):
+            self._specs["etd"] = dict(self._specs["etd"], **specs["etd"])
+        self._compile_all()
+
+    def load_json(self, path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            self.load(json.load(f))
+        logger.info(f"[TEMPLATES] Registro cargado desde {path}: {len(self._templates)} plantillas, "
+                    f"{len(self._etd_prefixes)} prefijos ETD")
+
+    def register_binder(self, name: str, fn):
+        """fn(template_data, etd_values) -> lista de valores del BODY. Para casos con lógica (BD, fechas)."""
+        self._binders[name] = fn
+        self._compile_all()
+
+    # ---------- Compilación ----------
+    def _compile_all(self):
+        self._templates = {
+            name: self._compile_template(name, spec)
+            for name, spec in self._specs["templates"].items()
+        }
+        etd = self._specs["etd"] or {}
+        values = [_compile_param(v) for v in etd.get("values") or []]
+        button = _compile_button(etd["button"]) if etd.get("button") else None
+        no_button = set(etd.get("no_button") or ())
+        binders = etd.get("binders") or {}
+        self._etd_prefixes = [
+            (prefix, self._compile_etd(prefix, int(count), values, button, no_button, binders.get(prefix)))
+            for prefix, count in etd.get("prefixes") or []
+        ]
+        self._etd_fallback = self._compile_etd(None, 0, values, button, no_button, None)
+        self._resolved = {}
+
+    def _compile_template(self, name: str, spec: dict) -> CompiledTemplate:
+        body = [_compile_param(p) for p in spec.get("body") or []]
+        buttons = [_compile_button(b) for b in spec.get("buttons") or []]
+
+        def bind(td, name=None):
+            components = []
+            if body:
+                components.append({
+                    "type": "body",
+                    "parameters": [{"type": "text", "text": get(td)} for get in body],
+                })
+            for button in buttons:
+                components.append(button(td))
+            return components
+
+        return CompiledTemplate(
+            name, bind,
+            param_count=len(body),
+            language=spec.get("language"),
+            drop_header=bool(spec.get("drop_header")),
+            header_image=spec.get("header_image", "default"),
+        )
+
+    def _compile_etd(self, prefix, count, values, button, no_button, binder_name) -> CompiledTemplate:
+        value_getters = values[:count]
+        binders = self._binders
+
+        def bind(td, name=None):
+            components = []
+            if count > 0:
+                binder = binders.get(binder_name) if binder_name else None
+                if binder:
+                    body_values = binder(td, [get(td) for get in values])
+                else:
+                    body_values = [get(td) for get in value_getters]
+                components.append({
+                    "type": "body",
+                    "parameters": [{"type": "text", "text": v} for v in body_values],
+                })
+            if button and name not in no_button:
+                components.append(button(td))
+            return components
+
+        # Las plantillas ETD no tienen HEADER definido
+        return CompiledTemplate(prefix or "etd_*", bind, param_count=count, drop_header=True)
+
+    # ---------- Uso ----------
+    def resolve(self, name: str, company_id: str = None) -> Optional[CompiledTemplate]:
+        name = (name or "").strip()
+        is_etd = bool(company_id) and str(company_id) in self.etd_company_ids and name.startswith("etd_")
+        key = (name, is_etd)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        compiled = None
+        if is_etd:
+            compiled = self._etd_fallback
+            for prefix, candidate in self._etd_prefixes:
+                if name.startswith(prefix):
+                    compiled = candidate
+                    break
+        else:
+            compiled = self._templates.get(normalize_template_name(name))
+        if len(self._resolved) < 10000:
+            self._resolved[key] = compiled
+        return compiled
+
+    def build_components(self, name: str, template_data: dict, company_id: str = None):
+        """(compiled | None, components). El nombre completo decide el botón de las ETD."""
+        compiled = self.resolve(name, company_id)
+        if compiled is None:
+            return None, []
+        return compiled, compiled.bind(template_data or {}, (name or "").strip())
+
+    def names(self) -> list:
+        return sorted(self._templates) + [p for p, _ in self._etd_prefixes]
+
+
+def _benchmark(iterations: int):
+    registry = TemplateRegistry(etd_company_ids={"etd"})
+    registry.register_binder(
+        "etd_rec_cita_presencial",
+        lambda td, values: [values[0], values[2], safe_text(td.get("fecha")), " "]
+    )
+    td = {
+        "first_name": "Ana", "responsible_name": "Luis", "company_name": "Solvify",
+        "deal_id": "3f2c9a1e-0000-4000-8000-000000000000", "amount": 120, "order_id": "ord_1",
+        "days_overdue": 7, "customer_name": "Ana", "office": "Madrid", "fecha": "12/05",
+    }
+    cases = [(name, None) for name in sorted(DEFAULT_TEMPLATE_SPECS["templates"])]
+    cases += [(prefix + "_v2", "etd") for prefix, _ in DEFAULT_TEMPLATE_SPECS["etd"]["prefixes"]]
+
+    print(f"{'template':45} {'us/op':>8}")
+    total = 0.0
+    for name, company_id in cases:
+        t0 = time.perf_counter()
+        for _ in range(iterations):
+            registry.build_components(name, td, company_id)
+        per_op = (time.perf_counter() - t0) / iterations * 1e6
+        total += per_op
+        print(f"{name:45} {per_op:8.2f}")
+    print(f"{'mean':45} {total / len(cases):8.2f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Microbenchmark del registro de plantillas")
+    parser.add_argument("--iterations", type=int, default=100000)
+    _benchmark(parser.parse_args().iterations)
@@ -0,0 +1,108 @@
+"""
+Flow-exit de extremo a extremo contra una BD de pruebas: template guardado -> respuesta ->
+marcador 'flow_exit_triggered' + evento en public.scheduler_outbox, sin duplicados.
+
+Necesita un scripts.conf que apunte a una BD de pruebas (con OUTBOX habilitado):
+    CLOUDAPI_TEST_CONFIG=/ruta/scripts.test.conf python -m pytest tests/test_flow_exit_reply.py
+"""
+import os
+import random
+import sys
+from uuid import uuid4
+
+import pytest
+
+TEST_CONFIG = os.getenv('CLOUDAPI_TEST_CONFIG')
+if not TEST_CONFIG:
+    pytest.skip("CLOUDAPI_TEST_CONFIG no definido (hace falta una BD de pruebas)", allow_module_level=True)
+
+os.environ['CLOUDAPI_CONFIG'] = os.path.abspath(TEST_CONFIG)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CloudAPI2 = pytest.importorskip('CloudAPI2')
+
+
+@pytest.fixture
+def outbox():
+    if CloudAPI2.scheduler_outbox is None:
+        pytest.skip("scheduler_outbox no disponible en esta configuración")
+    # Sin drenar: el evento se queda en la tabla para comprobarlo
+    CloudAPI2.scheduler_outbox.stop()
+    return CloudAPI2.scheduler_outbox
+
+
+@pytest.fixture
+def template_reply(outbox):
+    """Template guardado para un teléfono de pruebas; borra sus filas al terminar."""
+    phone = f"6{random.randint(10000000, 99999999)}"
+    wamid = f"wamid.test-{uuid4().hex}"
+    saved = CloudAPI2.message_service.save_template_message(
+        {'phone': phone, 'template_name': 'test_flow_exit', 'template': {'name': 'test_flow_exit', 'components': []}},
+        wamid
+    )
+    assert saved
+    marker_uid = CloudAPI2.message_service.flow_exit_marker_uid(wamid, phone)
+    yield phone, wamid, marker_uid
+    db = CloudAPI2.db_manager
+    db.execute_query("DELETE FROM public.scheduler_outbox WHERE dedupe_key = %s", [marker_uid])
+    db.execute_query("DELETE FROM public.external_messages WHERE last_message_uid = ANY(%s)", [[wamid, marker_uid]])
+
+
+def _count(sql, params):
+    return CloudAPI2.db_manager.execute_query(sql, params, fetch_one=True)[0]
+
+
+def test_reply_to_template_marks_and_enqueues_once(template_reply):
+    phone, wamid, marker_uid = template_reply
+    lead = {'lead_id': str(uuid4())}
+
+    assert CloudAPI2.process_flow_exit_reply(phone, wamid, None, lead=lead) is False
+
+    assert _count(
+        "SELECT COUNT(*) FROM public.external_messages WHERE last_message_uid = %s AND status = 'flow_exit_triggered'",
+        [marker_uid]
+    ) == 1
+    assert _count("SELECT COUNT(*) FROM public.scheduler_outbox WHERE dedupe_key = %s", [marker_uid]) == 1
+    # La fila del template sigue siendo la del template
+    assert _count(
+        "SELECT COUNT(*) FROM public.external_messages WHERE last_message_uid = %s AND status = 'template_sent'",
+        [wamid]
+    ) == 1
+
+    # Otro worker / reinicio: caché en memoria vacía, el marcador en BD corta el duplicado
+    CloudAPI2.message_service.flow_exit_context = CloudAPI2.FlowExitContextCache()
+    assert CloudAPI2.message_service.has_flow_exit_marker(wamid, phone)
+    assert CloudAPI2.process_flow_exit_reply(phone, wamid, None, lead=lead) is True
+    assert _count("SELECT COUNT(*) FROM public.scheduler_outbox WHERE dedupe_key = %s", [marker_uid]) == 1
+
+
+def test_marker_and_event_roll_back_together_inside_webhook_transaction(template_reply, monkeypatch):
+    phone, wamid, marker_uid = template_reply
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError("enqueue failed")
+    monkeypatch.setattr(CloudAPI2, 'outbox_enqueue_params', _fail)
+
+    with CloudAPI2.db_manager.unit_of_work():
+        with pytest.raises(RuntimeError):
+            CloudAPI2.process_flow_exit_reply(phone, wamid, None, lead={'lead_id': str(uuid4())})
+
+    assert _count("SELECT COUNT(*) FROM public.external_messages WHERE last_message_uid = %s", [marker_uid]) == 0
+    assert not CloudAPI2.message_service.flow_exit_context.has_exit(wamid, phone)
+
+
+def test_claim_released_when_webhook_transaction_rolls_back_later(template_reply):
+    phone, wamid, marker_uid = template_reply
+    lead = {'lead_id': str(uuid4())}
+
+    # El exit se encola bien, pero el webhook falla después y deshace su unit of work
+    with pytest.raises(RuntimeError):
+        with CloudAPI2.db_manager.unit_of_work():
+            assert CloudAPI2.process_flow_exit_reply(phone, wamid, None, lead=lead) is False
+            raise RuntimeError("webhook failed after flow-exit")
+
+    assert _count("SELECT COUNT(*) FROM public.scheduler_outbox WHERE dedupe_key = %s", [marker_uid]) == 0
+    assert not CloudAPI2.message_service.flow_exit_context.has_exit(wamid, phone)
+
+    # La reentrega de Meta vuelve a disparar el exit
+    assert CloudAPI2.process_flow_exit_reply(phone, wamid, None, lead=lead) is False
+    assert _count("SELECT COUNT(*) FROM public.scheduler_outbox WHERE dedupe_key = %s", [marker_uid]) == 1
@@ -0,0 +1,211 @@
+"""
+Stores clave -> caducidad (TTL) para estado efímero compartido (p.ej. "ya se mandó auto-reply a este teléfono").
+
+- MemoryTTLStore: dict + heap de caducidades. Purgar cuesta O(k log n) con k claves caducadas,
+  no un recorrido completo del dict en cada llamada. Solo sirve dentro de un proceso.
+- SQLiteTTLStore: fichero SQLite en WAL compartido por todos los procesos de la máquina
+  (workers de serve.py). claim() es atómico entre procesos y siempre va al fichero. Delante lleva
+  un MemoryTTLStore con los positivos ya vistos, así que un "ya respondido" no toca ni el fichero;
+  las claves de otros procesos solo se cachean foreign_ttl segundos (pueden liberarlas con delete()).
+
+API común:
+    get(key) -> expires_at (epoch) | None
+    set(key, ttl)                 marca/renueva
+    claim(key, ttl) -> bool       marca solo si no estaba vigente (True = lo hemos reservado)
+    delete(key)
+    age() -> segundos desde que se creó el store (para saber si aún está "frío")
+    stats() -> dict
+"""
+import heapq
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryTTLStore:
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._expires = {}
+        self._heap = []          # (expires_at, key); entradas obsoletas se descartan al salir
+        self._lock = threading.Lock()
+        self._created_at = time.time()
+        self._stats = {'hits': 0, 'misses': 0, 'claims': 0, 'claim_conflicts': 0, 'expired': 0}
+
+    def _purge_locked(self, now: float):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            if self._expires.get(key) == expires_at:
+                del self._expires[key]
+                self._stats['expired'] += 1
+        # Demasiadas entradas obsoletas (renovaciones): reconstruir
+        if len(heap) > 2 * len(self._expires) + 1024:
+            self._heap = [(exp, key) for key, exp in self._expires.items()]
+            heapq.heapify(self._heap)
+
+    def _set_locked(self, key, expires_at: float):
+        self._expires[key] = expires_at
+        heapq.heappush(self._heap, (expires_at, key))
+        # Lleno: fuera las que caducan antes
+        while len(self._expires) > self.max_size:
+            old_expires, old_key = heapq.heappop(self._heap)
+            if self._expires.get(old_key) == old_expires:
+                del self._expires[old_key]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._purge_locked(now)
+            expires_at = self._expires.get(key)
+            self._stats['hits' if expires_at else 'misses'] += 1
+            return expires_at
+
+    def set(self, key, ttl: float, expires_at: float = None):
+        now = time.time()
+        with self._lock:
+            self._purge_locked(now)
+            self._set_locked(key, expires_at or now + ttl)
+
+    def claim(self, key, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._purge_locked(now)
+            self._stats['claims'] += 1
+            if key in self._expires:
+                self._stats['claim_conflicts'] += 1
+                return False
+            self._set_locked(key, now + ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def age(self) -> float:
+        return time.time() - self._created_at
+
+    def __len__(self):
+        with self._lock:
+            return len(self._expires)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'backend': 'memory', 'size': len(self._expires), 'heap': len(self._heap),
+                    'max_size': self.max_size, **self._stats}
+
+
+class SQLiteTTLStore:
+
+    def __init__(self, path: str, front_size: int = 100000, purge_interval: float = 60.0,
+                 foreign_ttl: float = 5.0):
+        self.path = path
+        self.purge_interval = purge_interval
+        self.foreign_ttl = foreign_ttl
+        self.front = MemoryTTLStore(front_size)
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._stats = {'reads': 0, 'claims': 0, 'claim_conflicts': 0, 'purged': 0}
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ttl_keys (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ttl_keys_expires ON ttl_keys (expires_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ttl_meta (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO ttl_meta (name, value) VALUES ('created_at', ?)", (time.time(),))
+        self._created_at = self._conn.execute("SELECT value FROM ttl_meta WHERE name = 'created_at'").fetchone()[0]
+
+    def _front_foreign(self, key, expires_at: float, now: float):
+        """Clave vista en el fichero pero no puesta por este proceso: en el front solo unos segundos"""
+        if self.foreign_ttl > 0:
+            self.front.set(key, 0, expires_at=min(expires_at, now + self.foreign_ttl))
+
+    def _maybe_purge_locked(self, now: float):
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        cur = self._conn.execute("DELETE FROM ttl_keys WHERE expires_at <= ?", (now,))
+        self._stats['purged'] += cur.rowcount or 0
+
+    def get(self, key):
+        expires_at = self.front.get(key)
+        if expires_at:
+            return expires_at
+        now = time.time()
+        with self._lock:
+            self._stats['reads'] += 1
+            row = self._conn.execute(
+                "SELECT expires_at FROM ttl_keys WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+        if row:
+            self._front_foreign(key, row[0], now)
+            return row[0]
+        return None
+
+    def set(self, key, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO ttl_keys (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at",
+                (key, now + ttl)
+            )
+            self._maybe_purge_locked(now)
+        self.front.set(key, ttl)
+
+    def claim(self, key, ttl: float) -> bool:
+        # Sin atajo por el front: otro proceso puede haber liberado (delete) la clave
+        now = time.time()
+        row = None
+        with self._lock:
+            self._stats['claims'] += 1
+            # Inserta, o pisa solo si la clave existente ya caducó: atómico entre procesos
+            cur = self._conn.execute(
+                "INSERT INTO ttl_keys (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE ttl_keys.expires_at <= ?",
+                (key, now + ttl, now)
+            )
+            claimed = cur.rowcount == 1
+            if not claimed:
+                self._stats['claim_conflicts'] += 1
+                row = self._conn.execute("SELECT expires_at FROM ttl_keys WHERE key = ?", (key,)).fetchone()
+            self._maybe_purge_locked(now)
+        if claimed:
+            self.front.set(key, ttl)
+        elif row:
+            self._front_foreign(key, row[0], now)
+        return claimed
+
+    def delete(self, key):
+        self.front.delete(key)
+        with self._lock:
+            self._conn.execute("DELETE FROM ttl_keys WHERE key = ?", (key,))
+
+    def age(self) -> float:
+        return time.time() - self._created_at
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM ttl_keys WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+            local = dict(self._stats)
+        return {'backend': 'sqlite', 'path': self.path, 'size': size, 'age_s': round(self.age()),
+                **local, 'front': self.front.stats()}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def build_ttl_store(backend: str = 'sqlite', path: str = 'ttl_store.db', max_size: int = 100000):
+    """'sqlite' (compartido entre procesos de la máquina) o 'memory'. Si SQLite falla, memoria."""
+    if (backend or 'sqlite').strip().lower() == 'memory':
+        return MemoryTTLStore(max_size)
+    try:
+        return SQLiteTTLStore(path, front_size=max_size)
+    except Exception as e:
+        logger.error(f"[TTL STORE] No se pudo abrir {path} ({e}); se usa un store en memoria por proceso")
+        return MemoryTTLStore(max_size)
@@ -0,0 +1,214 @@
+"""
+Estado compartido entre los workers de serve.py de una máquina (fichero SQLite en WAL).
+
+Con varios workers cada petición cae en uno cualquiera: lo que un endpoint deja en memoria, o
+invalida, solo existe en ese proceso. WorkerState da:
+
+- put(ns, key, doc, ttl) / get(ns, key): documentos JSON con caducidad, legibles desde cualquier
+  worker (estado de campañas y de envíos asíncronos).
+- publish(kind, payload) / subscribe(kind, fn): eventos que un hilo de cada worker aplica en su
+  proceso (invalidaciones de cachés). El que publica ya lo ha aplicado: no se le reenvía.
+- gather(kind, args) / on_gather(kind, fn): pregunta a todos los workers (stats) y junta
+  {pid: respuesta}; espera hasta tener `workers` respuestas o hasta `gather_timeout`.
+
+Sin path (un solo proceso) es un no-op: get() no encuentra nada, publish() no hace nada y
+gather() devuelve solo la respuesta local.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerState:
+
+    def __init__(self, path: str = None, workers: int = 1, poll_interval: float = 0.2,
+                 gather_timeout: float = 2.0, retention: float = 3600.0):
+        self.path = path
+        self.workers = max(1, int(workers))
+        self.poll_interval = poll_interval
+        self.gather_timeout = gather_timeout
+        self.retention = retention
+        self._handlers = {}
+        self._gatherers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_event = 0
+        self._last_purge = 0.0
+        self._stats = {'published': 0, 'applied': 0, 'apply_errors': 0, 'gathers': 0, 'gather_timeouts': 0}
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS worker_docs (
+                    ns TEXT NOT NULL, key TEXT NOT NULL, doc TEXT NOT NULL, expires_at REAL NOT NULL,
+                    PRIMARY KEY (ns, key)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS worker_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL,
+                    origin INTEGER NOT NULL, created_at REAL NOT NULL
+                )
+            """)
+            # Los eventos anteriores al arranque no aplican: la caché de este proceso nace vacía
+            row = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM worker_events").fetchone()
+            self._last_event = row[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+
+    # ---------- Documentos ----------
+    def put(self, ns: str, key: str, doc: dict, ttl: float):
+        if not self.enabled:
+            return
+        data = json.dumps(doc, ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO worker_docs (ns, key, doc, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(ns, key) DO UPDATE SET doc = excluded.doc, expires_at = excluded.expires_at",
+                (ns, str(key), data, time.time() + ttl)
+            )
+
+    def get(self, ns: str, key: str) -> dict | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT doc FROM worker_docs WHERE ns = ? AND key = ? AND expires_at > ?",
+                (ns, str(key), time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # ---------- Eventos ----------
+    def subscribe(self, kind: str, fn):
+        self._handlers[kind] = fn
+
+    def publish(self, kind: str, payload: dict = None) -> int | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO worker_events (kind, payload, origin, created_at) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload or {}, ensure_ascii=False, default=str), os.getpid(), time.time())
+            )
+            self._stats['published'] += 1
+            return cur.lastrowid
+
+    # ---------- Gather ----------
+    def on_gather(self, kind: str, fn):
+        """fn(args: dict) -> dict serializable, ejecutada en cada worker."""
+        self._gatherers[kind] = fn
+
+    def gather(self, kind: str, args: dict = None, local: dict = None) -> dict:
+        """{pid: respuesta}; `local` evita recalcular la de este worker si ya se tiene."""
+        args = args or {}
+        results = {str(os.getpid()): local if local is not None else self._gatherers[kind](args)}
+        if not self.enabled or self.workers <= 1:
+            return results
+        request_id = uuid4().hex
+        self.publish('_gather', {'kind': kind, 'args': args, 'request_id': request_id})
+        with self._lock:
+            self._stats['gathers'] += 1
+        deadline = time.time() + self.gather_timeout
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT key, doc FROM worker_docs WHERE ns = ? AND key LIKE ?",
+                    ('_gather', f"{request_id}:%")
+                ).fetchall()
+            for key, doc in rows:
+                results[key.split(':', 1)[1]] = json.loads(doc)
+            if len(results) >= self.workers:
+                break
+            if time.time() >= deadline:
+                with self._lock:
+                    self._stats['gather_timeouts'] += 1
+                break
+            time.sleep(self.poll_interval / 2)
+        with self._lock:
+            self._conn.execute("DELETE FROM worker_docs WHERE ns = ? AND key LIKE ?", ('_gather', f"{request_id}:%"))
+        return results
+
+    def _answer_gather(self, payload: dict):
+        fn = self._gatherers.get(payload.get('kind'))
+        if fn is None:
+            return
+        self.put('_gather', f"{payload['request_id']}:{os.getpid()}", fn(payload.get('args') or {}),
+                 ttl=self.gather_timeout * 5)
+
+    # ---------- Hilo de eventos ----------
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return self
+        self._thread = threading.Thread(target=self._run, name='worker-state', daemon=True)
+        self._thread.start()
+        logger.info(f"[WORKER STATE] Compartido en {self.path} ({self.workers} workers)")
+        return self
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("[WORKER STATE] Error leyendo eventos")
+
+    def poll(self) -> int:
+        """Aplica los eventos nuevos de otros workers. Devuelve cuántos."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, payload, origin FROM worker_events WHERE id > ? ORDER BY id",
+                (self._last_event,)
+            ).fetchall()
+            if rows:
+                self._last_event = rows[-1][0]
+            if now - self._last_purge > 60:
+                self._last_purge = now
+                self._conn.execute("DELETE FROM worker_events WHERE created_at < ?", (now - self.retention,))
+                self._conn.execute("DELETE FROM worker_docs WHERE expires_at <= ?", (now,))
+        applied = 0
+        for _, kind, payload, origin in rows:
+            if origin == os.getpid():
+                continue
+            try:
+                if kind == '_gather':
+                    self._answer_gather(json.loads(payload))
+                elif kind in self._handlers:
+                    self._handlers[kind](json.loads(payload))
+                else:
+                    continue
+                applied += 1
+            except Exception:
+                logger.exception(f"[WORKER STATE] Evento {kind} falló")
+                with self._lock:
+                    self._stats['apply_errors'] += 1
+        with self._lock:
+            self._stats['applied'] += applied
+        return applied
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'enabled': self.enabled, 'path': self.path, 'workers': self.workers,
+                    'last_event': self._last_event, **self._stats}
+
+    def close(self):
+        self.stop()
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()